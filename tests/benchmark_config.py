@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+
+    Measure how many metadata documents per second can be validated.
+
+    Usage: PYTHONPATH=. python tests/benchmark_config.py [number of documents]
+"""
+
+
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import time
+import logging
+
+import yaml
+
+from upaas.config.metadata import MetadataConfig
+
+
+def benchmark(content, count):
+    started = time.time()
+    for _ in range(count):
+        MetadataConfig(content)
+    return count / (time.time() - started)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    path = os.path.join(os.path.dirname(__file__), 'mock_metadata.yml')
+    with open(path) as metadata:
+        content = yaml.safe_load(metadata)
+    # first document also compiles schemas
+    MetadataConfig(content)
+    print("Validated %.0f documents per second" % benchmark(content, count))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,18 @@
 from __future__ import unicode_literals
 
 import os
+import time
 
 import pytest
 
 from upaas.config.metadata import MetadataConfig
-from upaas.builder.builder import Builder
+from upaas import distro
+from upaas.builder.builder import Builder, OSBuilder, PoolBuilder
+from upaas.builder.events import BuildEvent
+from upaas.cache import FileLock
+from upaas.storage.lease import StorageLease
+from upaas import utils
+from upaas.utils import load_handler
 
 
 @pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
@@ -29,3 +36,726 @@ def test_builder(builder_config):
     assert build_result.filename
     assert build_result.checksum
     assert build_result.bytes > 0
+    assert build_result.usage['app_actions']['total']['count'] == 2
+    assert build_result.usage['pack']['total']['wall'] > 0
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_session(builder_config):
+    builder_config.commands.session = True
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    assert build_result.checksum
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_batch_install(builder_config):
+    builder_config.commands.install.cmd = '/bin/echo %package%'
+    builder_config.commands.install.batch_cmd = '/bin/false %packages%'
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    commands = [c['cmd'] for c in
+                build_result.usage['install_packages']['commands']]
+    assert commands[0].startswith('/bin/false ')
+    assert '/bin/echo fake-pkg' in commands
+
+
+def test_package_cache_symlink(builder_config, empty_dir):
+    class package_cache:
+        dir = os.path.join(empty_dir, 'cache')
+        path = '/var/cache/apt'
+    builder_config.package_cache = package_cache
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    builder = Builder(builder_config,
+                      MetadataConfig.from_file(metadata_path))
+    workdir = os.path.join(empty_dir, 'workdir')
+    host_dir = os.path.join(empty_dir, 'host')
+    os.makedirs(os.path.join(workdir, 'var'))
+    os.mkdir(host_dir)
+    os.symlink(host_dir, os.path.join(workdir, 'var', 'cache'))
+    with builder.mount_package_cache(workdir):
+        assert os.listdir(host_dir) == []
+        assert utils.mounted_filesystems(empty_dir) == []
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="mounting requires root")
+def test_package_cache_lock(builder_config, empty_dir):
+    class package_cache:
+        dir = os.path.join(empty_dir, 'cache')
+        path = '/var/cache/apt'
+        max_size = 1
+    builder_config.package_cache = package_cache
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    builder = Builder(builder_config,
+                      MetadataConfig.from_file(metadata_path))
+    workdir = os.path.join(empty_dir, 'workdir')
+    os.mkdir(workdir)
+    lock_path = '%s.lock' % package_cache.dir
+    with builder.mount_package_cache(workdir):
+        target = os.path.join(workdir, 'var', 'cache', 'apt')
+        assert utils.mounted_filesystems(empty_dir) == [target]
+        with open(os.path.join(target, 'package.deb'), 'wb') as deb:
+            deb.write(b'x' * 2 * 1024 * 1024)
+        # other builds can mount cache at the same time, cleanup can't run
+        shared = FileLock(lock_path, shared=True, blocking=False)
+        assert shared.acquire() is True
+        shared.release()
+        assert FileLock(lock_path, blocking=False).acquire() is False
+    assert utils.mounted_filesystems(empty_dir) == []
+    # cache was cleaned up once it wasn't used
+    assert os.listdir(package_cache.dir) == []
+
+
+def _dependency_cache_builder(builder_config, url):
+    metadata = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+  versions:
+    - 1.8.7
+repository:
+  url: %s
+  clone: echo "cloning repository to %%destination%%"
+  update: echo "repository update command"
+cache:
+  - path: vendor
+    key:
+      - Gemfile.lock
+''' % url)
+    return Builder(builder_config, metadata)
+
+
+def test_dependency_cache(builder_config, empty_dir):
+    class dependency_cache:
+        dir = os.path.join(empty_dir, 'cache')
+    builder_config.dependency_cache = dependency_cache
+    builder = _dependency_cache_builder(builder_config, 'git://app')
+    workdir = os.path.join(empty_dir, 'workdir')
+    vendor = os.path.join(workdir, 'home', 'vendor')
+    os.makedirs(vendor)
+    with open(os.path.join(workdir, 'home', 'Gemfile.lock'), 'w') as lock:
+        lock.write('gems')
+    with open(os.path.join(vendor, 'gem'), 'w') as gem:
+        gem.write('gem')
+
+    builder.restore_dependency_caches(workdir, '/home')
+    builder.save_dependency_caches()
+    assert len(os.listdir(dependency_cache.dir)) == 1
+
+    os.remove(os.path.join(vendor, 'gem'))
+    builder.restore_dependency_caches(workdir, '/home')
+    assert os.listdir(vendor) == ['gem']
+
+    # other application with the same key files doesn't get cached content
+    os.remove(os.path.join(vendor, 'gem'))
+    other = _dependency_cache_builder(builder_config, 'git://other')
+    other.restore_dependency_caches(workdir, '/home')
+    assert os.listdir(vendor) == []
+
+
+def test_dependency_cache_symlink(builder_config, empty_dir):
+    class dependency_cache:
+        dir = os.path.join(empty_dir, 'cache')
+    builder_config.dependency_cache = dependency_cache
+    builder = _dependency_cache_builder(builder_config, 'git://app')
+    workdir = os.path.join(empty_dir, 'workdir')
+    vendor = os.path.join(workdir, 'home', 'vendor')
+    os.makedirs(vendor)
+    with open(os.path.join(vendor, 'gem'), 'w') as gem:
+        gem.write('gem')
+    builder.restore_dependency_caches(workdir, '/home')
+    builder.save_dependency_caches()
+
+    host_dir = os.path.join(empty_dir, 'host')
+    os.mkdir(host_dir)
+    os.rename(vendor, os.path.join(workdir, 'home', 'old'))
+    os.symlink(host_dir, vendor)
+    builder.restore_dependency_caches(workdir, '/home')
+    assert os.listdir(host_dir) == []
+
+    # directory replaced with symlink after it was restored is not saved
+    os.remove(vendor)
+    os.rename(os.path.join(workdir, 'home', 'old'), vendor)
+    builder.restore_dependency_caches(workdir, '/home')
+    for name in os.listdir(dependency_cache.dir):
+        os.remove(os.path.join(dependency_cache.dir, name))
+    os.rename(vendor, os.path.join(workdir, 'home', 'old'))
+    os.symlink(host_dir, vendor)
+    with open(os.path.join(host_dir, 'secret'), 'w') as secret:
+        secret.write('secret')
+    builder.save_dependency_caches()
+    assert os.listdir(dependency_cache.dir) == []
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_stages(builder_config, empty_dir):
+    class paths:
+        workdir = '/tmp'
+        stage_stats = os.path.join(empty_dir, 'stats.json')
+    builder_config.paths = paths
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    hook_calls = []
+    builder = Builder(builder_config, metadata)
+    builder.add_stage_hook(lambda stage: hook_calls.append(
+        (stage.name, stage.status)))
+    progress = [r.progress for r in builder.build_package()]
+    assert progress == sorted(progress)
+    assert progress[-1] == 100
+    stages = [stage.name for stage in builder.finished_stages]
+    assert stages == [name for (name, _) in Builder.stages]
+    assert hook_calls[0] == ('unpack_os', 'running')
+    assert hook_calls[-1] == ('upload', 'success')
+    assert os.path.isfile(paths.stage_stats)
+
+    # statistics are not stored unless their path is set
+    os.remove(paths.stage_stats)
+    paths.workdir = empty_dir
+    paths.stage_stats = None
+    for build_result in Builder(builder_config, metadata).build_package():
+        continue
+    assert build_result.progress == 100
+    assert not os.path.exists(os.path.join(empty_dir,
+                                           'upaas_stage_stats.json'))
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_snapshot(builder_config):
+    class snapshots:
+        enabled = True
+    builder_config.snapshots = snapshots
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    assert [f for f in os.listdir(builder_config.storage.settings['dir'])
+            if f.startswith('snapshot-')]
+
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    skipped = [s['name'] for s in build_result.stages
+               if s['status'] == 'skipped']
+    assert skipped == ['install_packages', 'interpreter_actions']
+
+    # snapshot made from old OS image is deleted once new one is saved
+    storage_dir = builder_config.storage.settings['dir']
+    old = [f for f in os.listdir(storage_dir) if f.startswith('snapshot-')]
+    image = os.path.join(storage_dir, distro.distro_image_filename())
+    os.utime(image, (time.time() + 60, time.time() + 60))
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    new = [f for f in os.listdir(storage_dir) if f.startswith('snapshot-')]
+    assert len(new) == 1
+    assert new != old
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_base_cache(builder_config, empty_dir):
+    class base_cache:
+        dir = os.path.join(empty_dir, 'base')
+    builder_config.base_cache = base_cache
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    for _ in range(2):
+        builder = Builder(builder_config, metadata)
+        for build_result in builder.build_package():
+            continue
+        assert build_result.progress == 100
+        commands = [c['cmd'] for c in
+                    build_result.usage['unpack_os']['commands']]
+        assert 'cp' in commands
+    assert len(os.listdir(base_cache.dir)) == 1
+
+    # parent packages are unpacked directly
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package(
+            system_filename=build_result.filename):
+        continue
+    assert build_result.progress == 100
+    commands = [c['cmd'] for c in build_result.usage['unpack_os']['commands']]
+    assert 'cp' not in commands
+    assert len(os.listdir(base_cache.dir)) == 1
+
+
+def test_builder_overlay_lock(builder_config, empty_dir, monkeypatch):
+    class base_cache:
+        dir = os.path.join(empty_dir, 'base')
+        overlay = True
+    builder_config.base_cache = base_cache
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    builder = Builder(builder_config,
+                      MetadataConfig.from_file(metadata_path))
+    cache = builder.base_cache()
+    os.mkdir(cache.entry_path('entry'))
+    monkeypatch.setattr(builder, 'cached_base',
+                        lambda directory, filename: (cache, 'entry'))
+    mounted = []
+
+    def mount_overlay(lowerdir, *args, **kwargs):
+        # cleanup must not be able to remove lower layer while mounting
+        assert cache.lock(shared=False, blocking=False).acquire() is False
+        mounted.append(lowerdir)
+    monkeypatch.setattr(utils, 'mount_overlay', mount_overlay)
+    workdir = os.path.join(empty_dir, 'workdir')
+    os.mkdir(workdir)
+    assert builder.mount_overlay(empty_dir, workdir, 'image') is True
+    assert mounted == [cache.entry_path('entry')]
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_warm_pool(builder_config, empty_dir):
+    class pool:
+        dir = os.path.join(empty_dir, 'pool')
+        interpreters = {'ruby': ['1.8.7']}
+    builder_config.pool = pool
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+
+    pool_builder = PoolBuilder(builder_config, 'ruby', '1.8.7')
+    assert pool_builder.envs['UPAAS_FRESH_PACKAGE'] == 'true'
+    assert PoolBuilder.refill(builder_config) == 1
+    assert PoolBuilder.refill(builder_config) == 0
+
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    skipped = [s['name'] for s in build_result.stages
+               if s['status'] == 'skipped']
+    assert skipped == ['unpack_os', 'interpreter_actions']
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_bootstrap_lease(builder_config):
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    builder = Builder(builder_config, metadata)
+    builder.storage = load_handler(builder_config.storage.handler,
+                                   builder_config.storage.settings)
+    # lease left by crashed builder
+    stale = StorageLease(builder.storage, builder.bootstrap_lease().path,
+                         ttl=-1, settle=0)
+    assert stale.acquire()
+    assert builder.ensure_os_image() is True
+    assert builder.ensure_os_image() is False
+    assert not builder.storage.exists(stale.path)
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_os_image_refresh(builder_config):
+    builder_config.bootstrap.soft_maxage = 1
+    builder = OSBuilder(builder_config)
+    assert builder.refresh_os_image() is True
+    assert builder.os_image_needs_refresh() is False
+    assert builder.refresh_os_image() is False
+
+    image = os.path.join(builder_config.storage.settings['dir'],
+                         distro.distro_image_filename())
+    old = time.time() - 2 * 86400
+    os.utime(image, (old, old))
+    assert builder.has_valid_os_image() is True
+    assert builder.os_image_needs_refresh() is True
+    assert builder.refresh_os_image() is True
+    assert builder.os_image_needs_refresh() is False
+    assert builder.refresh_os_image(force=True) is True
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_reuse_unchanged(builder_config):
+    metadata = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+  versions:
+    - 1.8.7
+repository:
+  clone: /bin/true
+  update: /bin/true
+  revision:
+    id: echo 1234
+''')
+    builder = Builder(builder_config, metadata)
+    for first in builder.build_package():
+        continue
+    assert first.reused is False
+    assert first.fingerprint
+    # fingerprint is stored inside the package, not as a separate file
+    assert not [name for name in os.listdir(
+        builder_config.storage.settings['dir']) if name.endswith(
+            '.fingerprint')]
+
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package(
+            system_filename=first.filename, current_revision='1234'):
+        continue
+    assert build_result.reused is True
+    assert build_result.progress == 100
+    assert build_result.filename == first.filename
+    assert build_result.bytes == first.bytes
+
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package(
+            system_filename=first.filename, current_revision='1234',
+            env={'NEW': 'VALUE'}):
+        continue
+    assert build_result.reused is False
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_vcs_info(builder_config):
+    metadata = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+  versions:
+    - 1.8.7
+repository:
+  clone: /bin/true
+  update: /bin/true
+  revision:
+    info: printf 'abc\\036me\\0361400000000\\036first line\\nsecond line\\n'
+    changelog: seq 1 100000
+''')
+    builder = Builder(builder_config, metadata)
+    builder.current_revision = 'old'
+    info = builder.vcs_info('/', '/')
+    assert info['id'] == 'abc'
+    assert info['author'] == 'me'
+    assert info['date'].year == 2014
+    assert info['description'] == 'first line\nsecond line'
+    assert 0 < len(info['changelog']) <= 64 * 1024
+    # single command for all fields and one for changelog
+    assert len(builder.usage['other']['commands']) == 2
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_repository_mirror(builder_config, empty_dir):
+    class mirror_cache:
+        dir = os.path.join(empty_dir, 'mirrors')
+    builder_config.mirror_cache = mirror_cache
+    metadata = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+  versions:
+    - 1.8.7
+repository:
+  url: https://example.com/repo.git
+  clone: echo %mirror% %reference%
+  update: /bin/true
+''')
+    builder = Builder(builder_config, metadata)
+    assert builder.mirror_placeholders('git clone %mirror%', None) == \
+        'git clone https://example.com/repo.git'
+    assert builder.mirror_placeholders(
+        'git clone --reference-if-able %reference%', None) == \
+        'git clone --reference-if-able /var/cache/upaas/mirror/repo'
+
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    cmds = [c['cmd'] for c in build_result.usage['repository']['commands']]
+    entries = os.listdir(mirror_cache.dir)
+    assert len(entries) == 1
+    assert os.listdir(os.path.join(mirror_cache.dir, entries[0])) == ['lock']
+    assert cmds[0] == 'git ls-remote --heads -- https://example.com/repo.git'
+    # mirror is updated on the host
+    assert cmds[1] == 'git clone --mirror -- https://example.com/repo.git ' \
+                      '%s' % os.path.join(mirror_cache.dir, entries[0], 'repo')
+    assert cmds[2] == 'echo /var/cache/upaas/mirror/repo ' \
+                      '/var/cache/upaas/mirror/repo'
+
+    assert builder.mirror_allowed('git@example.com:repo.git') is True
+    assert builder.mirror_allowed('/srv/repo.git') is False
+    assert builder.mirror_allowed('file:///srv/repo.git') is False
+
+
+@pytest.mark.usefixtures("mock_chroot")
+def test_builder_repository_mirror_injection(builder_config, empty_dir):
+    class mirror_cache:
+        dir = os.path.join(empty_dir, 'mirrors')
+    builder_config.mirror_cache = mirror_cache
+    marker = os.path.join(empty_dir, 'pwned')
+    metadata = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+  versions:
+    - 1.8.7
+repository:
+  url: https://127.0.0.1:1/repo.git;touch %s
+  clone: git clone %%mirror%% %%destination%%
+  update: /bin/true
+''' % marker)
+    builder = Builder(builder_config, metadata)
+    for url in ['https://127.0.0.1:1/repo.git;touch %s' % marker,
+                'https://127.0.0.1:1/$(touch %s)' % marker,
+                'git@127.0.0.1:`touch %s`' % marker,
+                'https://127.0.0.1:1/repo.git touch',
+                '--upload-pack=touch@127.0.0.1:repo.git']:
+        assert builder.mirror_allowed(url) is False
+    workdir = os.path.join(empty_dir, 'workdir')
+    os.mkdir(workdir)
+    with builder.repository_mirror(workdir, ['%mirror%']) as mirror:
+        assert mirror is None
+
+    # url is passed to git as a single argument even if it wasn't validated
+    url = 'https://127.0.0.1:1/repo.git;touch %s' % marker
+    assert builder.check_repository_access(workdir, url) is False
+    assert builder.update_mirror(url, os.path.join(empty_dir, 'repo')) is \
+        False
+    assert not os.path.exists(marker)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="mounting requires root")
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_repository_mirror_mount(builder_config, empty_dir):
+    class mirror_cache:
+        dir = os.path.join(empty_dir, 'mirrors')
+    builder_config.mirror_cache = mirror_cache
+    metadata = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+  versions:
+    - 1.8.7
+repository:
+  url: https://example.com/repo.git
+  clone: git clone %mirror% %destination%
+  update: /bin/true
+''')
+    builder = Builder(builder_config, metadata)
+    workdir = os.path.join(empty_dir, 'workdir')
+    os.mkdir(workdir)
+    target = os.path.join(workdir, 'var', 'cache', 'upaas', 'mirror')
+    with builder.repository_mirror(workdir, ['%mirror%']) as mirror:
+        assert mirror == '/var/cache/upaas/mirror/repo'
+        with pytest.raises(IOError):
+            open(os.path.join(target, 'poisoned'), 'w')
+    assert utils.mounted_filesystems(empty_dir) == []
+
+    # mirror that failed to update is never used
+    builder.update_mirror = lambda url, host_path: False
+    with builder.repository_mirror(workdir, ['%mirror%']) as mirror:
+        assert mirror is None
+    assert builder.mirror_placeholders('git clone %mirror%', None) == \
+        'git clone https://example.com/repo.git'
+
+    # mount point outside of the chroot is never used
+    del builder.update_mirror
+    utils.rmdirs(os.path.join(workdir, 'var'))
+    os.symlink(empty_dir, os.path.join(workdir, 'var'))
+    with builder.repository_mirror(workdir, ['%mirror%']) as mirror:
+        assert mirror is None
+
+
+@pytest.mark.skipif(not os.access('/sys/fs/cgroup/unified/cgroup.procs',
+                                  os.W_OK), reason="cgroup v2 not writable")
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_cgroup(builder_config):
+    class cgroup:
+        enabled = True
+        root = '/sys/fs/cgroup/unified'
+        parent = 'upaas_test'
+    builder_config.cgroup = cgroup
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    assert 'cpu_usage' in build_result.cgroup
+    assert not builder.cgroup.exists()
+    os.rmdir(builder.cgroup.parent)
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_trash(builder_config, empty_dir):
+    class paths:
+        workdir = empty_dir
+
+    class cleanup:
+        trash = os.path.join(empty_dir, 'trash')
+    builder_config.paths = paths
+    builder_config.cleanup = cleanup
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    builder = Builder(builder_config, metadata)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    assert [d for d in os.listdir(empty_dir)
+            if d.startswith('upaas_package_')] == []
+    deadline = time.time() + 30
+    while builder.trash.entries() and time.time() < deadline:
+        time.sleep(0.1)
+    assert builder.trash.entries() == []
+
+
+def _tmpfs_builder(builder_config, empty_dir, expansion, limit_ratio):
+    class paths:
+        workdir = empty_dir
+
+    class tmpfs:
+        enabled = True
+    tmpfs.expansion = expansion
+    builder_config.paths = paths
+    builder_config.tmpfs = tmpfs
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    builder = Builder(builder_config, metadata)
+    builder.storage = load_handler(builder_config.storage.handler,
+                                   builder_config.storage.settings)
+    if not builder.has_valid_os_image():
+        builder.ensure_os_image()
+    packed = builder.storage.size(distro.distro_image_filename())
+    tmpfs.max_memory = packed * expansion * limit_ratio / float(
+        utils.backend_total_memory())
+    return builder
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="mounting requires root")
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_tmpfs(builder_config, empty_dir):
+    builder = _tmpfs_builder(builder_config, empty_dir, 1000, 2)
+    on_tmpfs = []
+    builder.add_stage_hook(lambda stage: on_tmpfs.append(
+        builder.tmpfs is not None))
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    assert all(on_tmpfs[:-1])
+    assert not [line for line in open('/proc/mounts')
+                if empty_dir in line]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="mounting requires root")
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_tmpfs_spill(builder_config, empty_dir):
+    builder = _tmpfs_builder(builder_config, empty_dir, 1, 1.5)
+    for build_result in builder.build_package():
+        continue
+    assert build_result.progress == 100
+    assert builder.tmpfs is None
+    assert 'cp' in [c['cmd'].split()[0] for stage in builder.usage.values()
+                    for c in stage['commands']]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="mounting requires root")
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_tmpfs_retry(builder_config, empty_dir, monkeypatch):
+    builder = _tmpfs_builder(builder_config, empty_dir, 1000, 2)
+    events = []
+    builder.events.add_listener(events.append)
+    write_files = builder.write_files
+    on_tmpfs = []
+
+    def fill_tmpfs(workdir, homedir):
+        on_tmpfs.append(builder.tmpfs is not None)
+        if builder.tmpfs is None:
+            return write_files(workdir, homedir)
+        try:
+            with open(os.path.join(workdir, 'fill'), 'wb') as out:
+                while True:
+                    out.write(b'x' * 1024 * 1024)
+        except IOError:
+            pass
+        builder.tmpfs_monitor.check()
+        return False
+
+    monkeypatch.setattr(builder, 'write_files', fill_tmpfs)
+    progress = []
+    for build_result in builder.build_package():
+        progress.append(build_result.progress)
+    assert progress == sorted(progress) and progress[-1] == 100
+    assert on_tmpfs == [True, False]
+    assert BuildEvent.FAILED not in [e.type for e in events]
+    reported = [e.data['progress'] for e in events
+                if 'progress' in e.data]
+    assert reported == sorted(reported)
+    # stages of aborted attempt are not reported
+    names = [name for (name, _) in Builder.stages]
+    assert [s.name for s in builder.finished_stages] == names
+    assert [s['name'] for s in build_result.stages] == names
+    counts = dict([(name, usage['total']['count'])
+                   for (name, usage) in build_result.usage.items()])
+    builder_config.tmpfs.enabled = False
+    baseline = Builder(builder_config, builder.metadata)
+    for baseline_result in baseline.build_package():
+        continue
+    assert counts == dict([(name, usage['total']['count']) for (name, usage)
+                           in baseline_result.usage.items()])
+    assert not [line for line in open('/proc/mounts')
+                if empty_dir in line]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="mounting requires root")
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_tmpfs_abort(builder_config, empty_dir):
+    builder = _tmpfs_builder(builder_config, empty_dir, 1000, 2)
+    build = builder.build_package()
+    next(build)
+    assert builder.tmpfs
+    monitor = builder.tmpfs_monitor.process
+    build.close()
+    assert builder.tmpfs is None
+    assert not monitor.is_alive()
+    assert not [line for line in open('/proc/mounts')
+                if empty_dir in line]
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_builder_events(builder_config):
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    builder = Builder(builder_config, metadata)
+    events = []
+    builder.events.add_listener(events.append)
+    for build_result in builder.build_package():
+        continue
+    types = [e.type for e in events]
+    assert types.count(BuildEvent.STAGE_STARTED) == len(Builder.stages)
+    assert types.count(BuildEvent.STAGE_FINISHED) == len(Builder.stages)
+    assert types[-1] == BuildEvent.FINISHED
+    assert events[-1].checksum == build_result.checksum
+    checksum = [e for e in events if e.type == BuildEvent.STAGE_FINISHED and
+                e.stage == 'checksum'][0]
+    assert checksum.bytes == build_result.bytes
+    transfers = [e for e in events if e.type == BuildEvent.TRANSFER]
+    assert set([e.stage for e in transfers]) == set(
+        ['pack', 'checksum', 'upload'])
+    for stage in ['pack', 'upload']:
+        assert [e for e in transfers if e.stage == stage][-1].bytes == \
+            build_result.bytes
+    progress = [e.progress for e in events if e.type == BuildEvent.PROGRESS]
+    assert progress == sorted(progress) and progress[-1] == 100
+    timestamps = [e.timestamp for e in events]
+    assert timestamps == sorted(timestamps)
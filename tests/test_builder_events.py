@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from upaas.builder.events import BuildEvent, EventStream, TransferMeter, mbps
+from upaas.checksum import calculate_file_sha256
+
+
+def test_mbps():
+    assert mbps(2 * 1024 * 1024, 2) == 1.0
+    assert mbps(0, 1) is None
+    assert mbps(1024, 0) is None
+
+
+def test_event_stream():
+    events = EventStream()
+    received = []
+    queue = Queue()
+    events.add_listener(received.append)
+    events.add_listener(lambda event: 1 / 0)
+    events.add_queue(queue)
+    event = events.emit(BuildEvent.PROGRESS, stage='pack', progress=50)
+    assert received == [event]
+    assert event.progress == 50
+    dumped = queue.get_nowait()
+    assert dumped['type'] == BuildEvent.PROGRESS
+    assert dumped['stage'] == 'pack'
+    assert dumped['progress'] == 50
+    assert dumped['timestamp'] == event.timestamp
+
+
+def test_transfer_meter(empty_file):
+    with open(empty_file, 'wb') as out:
+        out.write(b'x' * 300000)
+    events = EventStream()
+    received = []
+    events.add_listener(received.append)
+    meter = TransferMeter(events, 'checksum', total=300000,
+                          progress=(80, 90), interval=0)
+    calculate_file_sha256(empty_file, callback=meter)
+    final = meter.finish()
+    assert final.bytes == 300000
+    assert final.progress == 90
+    progress = [e.progress for e in received]
+    assert progress == sorted(progress)
+    assert progress[0] < 90
+    assert all([e.type == BuildEvent.TRANSFER for e in received])
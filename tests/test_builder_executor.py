@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+
+import pytest
+
+from upaas import distro
+from upaas.config.metadata import MetadataConfig
+from upaas.builder.builder import OSBuilder
+from upaas.builder.executor import BuildExecutor
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_executor(builder_config):
+    class executor:
+        workers = 1
+    builder_config.executor = executor
+    metadata_path = os.path.join(os.path.dirname(__file__),
+                                 'mock_metadata.yml')
+    metadata = MetadataConfig.from_file(metadata_path)
+    unsupported = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+  versions:
+    - '0.1'
+repository:
+  clone: /bin/true
+  update: /bin/true
+''')
+
+    executor = BuildExecutor(builder_config)
+    first = executor.submit(metadata)
+    second = executor.submit(unsupported)
+    events = list(executor.events(timeout=0.1))
+    assert not executor.running and not executor.pending
+
+    first_events = [e['event'] for e in events if e['build'] == first]
+    assert first_events[0] == 'started'
+    assert first_events[-1] == 'finished'
+    assert 'stage' in first_events and 'progress' in first_events
+    assert 'transfer' in first_events
+    finished = [e for e in events if e['event'] == 'finished'][0]
+    assert finished['result']['progress'] == 100
+    assert finished['result']['checksum']
+
+    failed = [e for e in events if e['build'] == second][-1]
+    assert failed['event'] == 'failed'
+    assert failed['user_error'] is True
+
+    # with single worker second build is started after first one is done
+    started = [i for (i, e) in enumerate(events) if e['event'] == 'started']
+    assert started[1] > events.index(finished)
+
+
+def _exit_after_finished(queue, build_id, builder_config, metadata, kwargs):
+    queue.put({'build': build_id, 'event': 'finished', 'result': {}})
+
+
+def test_executor_reap(builder_config, monkeypatch):
+    monkeypatch.setattr('upaas.builder.executor.run_build',
+                        _exit_after_finished)
+    executor = BuildExecutor(builder_config)
+    build = executor.submit(None)
+    executor.schedule()
+    # build process put its last event and exited before it was read
+    executor.running[build].join()
+    events = executor.reap()
+    assert [e['event'] for e in events] == ['finished']
+    assert not executor.running
+
+    # events of completed builds are dropped
+    assert executor.handle({'build': build, 'event': 'failed'}) is None
+
+
+@pytest.mark.usefixtures("mock_chroot", "mock_build_commands")
+def test_executor_os_refresh(builder_config):
+    builder_config.bootstrap.soft_maxage = 1
+    builder = OSBuilder(builder_config)
+    builder.refresh_os_image(force=True)
+    executor = BuildExecutor(builder_config)
+    executor.refresh_os_image()
+    assert executor.refresh_process is None
+
+    image = os.path.join(builder_config.storage.settings['dir'],
+                         distro.distro_image_filename())
+    old = time.time() - 2 * 86400
+    os.utime(image, (old, old))
+    # image age is checked at most once every refresh interval
+    executor.refresh_os_image()
+    assert executor.refresh_process is None
+    executor.refresh_checked = None
+    executor.refresh_os_image()
+    executor.refresh_process.join()
+    assert builder.os_image_needs_refresh() is False
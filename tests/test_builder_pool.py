@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+
+from upaas.builder.pool import WarmPool
+
+
+def _add(pool, key, created=None):
+    directory = pool.tmp_dir(key)
+    with open(os.path.join(directory, 'file'), 'w') as out:
+        out.write('x')
+    path = pool.add(key, directory)
+    if created:
+        os.rename(path, os.path.join(pool.key_path(key), '%d-1' % created))
+
+
+def test_pool_claim(empty_dir):
+    pool = WarmPool(os.path.join(empty_dir, 'pool'), size=2)
+    assert pool.missing('key') == 2
+    _add(pool, 'key')
+    assert pool.missing('key') == 1
+    destination = os.path.join(empty_dir, 'workdir')
+    os.mkdir(destination)
+    assert pool.claim('other', destination) is False
+    assert pool.claim('key', destination) is True
+    assert os.listdir(destination) == ['file']
+    assert pool.entries('key') == []
+    assert pool.missing('key') == 2
+
+
+def test_pool_expired(empty_dir):
+    pool = WarmPool(os.path.join(empty_dir, 'pool'), ttl=60)
+    _add(pool, 'key', created=time.time() - 120)
+    assert pool.missing('key') == 1
+    destination = os.path.join(empty_dir, 'workdir')
+    os.mkdir(destination)
+    assert pool.claim('key', destination) is False
+    _add(pool, 'key')
+    pool.tmp_dir('key')
+    pool.cleanup()
+    assert len(os.listdir(pool.key_path('key'))) == 1
+    assert pool.claim('key', destination) is True
+
+
+def test_pool_cleanup_stale_keys(empty_dir):
+    pool = WarmPool(os.path.join(empty_dir, 'pool'))
+    _add(pool, 'old')
+    _add(pool, 'new')
+    pool.cleanup(keep=['new'])
+    assert pool.keys() == ['new']
+
+
+def test_pool_size_limit(empty_dir):
+    pool = WarmPool(os.path.join(empty_dir, 'pool'), size=2, max_size=1)
+    _add(pool, 'key')
+    assert pool.missing('key') == 0
+
+
+def test_pool_size(empty_dir):
+    pool = WarmPool(os.path.join(empty_dir, 'pool'), size=2)
+    _add(pool, 'key')
+    _add(pool, 'other')
+    assert pool.key_size('key') == 1
+    # size is read from entry name, chroot content is not scanned
+    (_, path) = pool.entries('key')[0]
+    with open(os.path.join(path, 'file'), 'w') as out:
+        out.write('more data')
+    assert pool.key_size('key') == 1
+    assert pool.total_size() == 2
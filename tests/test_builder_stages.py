@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+
+from upaas.builder.stages import BuildStage, StageStats
+
+
+def _stage(name, duration):
+    stage = BuildStage(name)
+    stage.start()
+    stage.finish(BuildStage.SUCCESS)
+    stage.duration = duration
+    return stage
+
+
+def test_stage():
+    stage = BuildStage('test')
+    stage.start()
+    assert stage.status == BuildStage.RUNNING
+    stage.finish(BuildStage.FAILED)
+    assert stage.dump()['status'] == BuildStage.FAILED
+    assert stage.duration >= 0
+
+
+def test_default_progress(empty_dir):
+    stats = StageStats(os.path.join(empty_dir, 'stats.json'))
+    assert stats.progress([('a', 10), ('b', 30), ('c', 60)]) == {
+        'a': 10, 'b': 40, 'c': 100}
+
+
+def test_historical_progress(empty_dir):
+    stats = StageStats(os.path.join(empty_dir, 'stats.json'), smoothing=0.5)
+    stats.update([_stage('a', 1), _stage('b', 2)])
+    # missing stats for 'c', default weights are used
+    assert stats.progress([('a', 50), ('b', 25), ('c', 25)]) == {
+        'a': 50, 'b': 75, 'c': 100}
+    stats.update([_stage('a', 3), _stage('b', 2), _stage('c', 4)])
+    assert stats.load() == {'a': 2, 'b': 2, 'c': 4}
+    assert stats.progress([('a', 50), ('b', 25), ('c', 25)]) == {
+        'a': 25, 'b': 50, 'c': 100}
+
+
+def test_disabled_stats():
+    stats = StageStats(None)
+    stats.update([_stage('a', 1)])
+    assert stats.load() == {}
+    assert stats.progress([('a', 10), ('b', 30)]) == {'a': 25, 'b': 100}
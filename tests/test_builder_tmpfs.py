@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+
+import pytest
+
+from upaas import utils
+from upaas.builder.tmpfs import TmpfsMonitor
+
+
+pytestmark = pytest.mark.skipif(os.geteuid() != 0,
+                                reason="mounting requires root")
+
+MB = 1024 * 1024
+
+
+def _fill(path, size):
+    with open(path, 'wb') as out:
+        out.write(b'x' * size)
+
+
+def test_tmpfs_monitor_grow(empty_dir):
+    utils.mount_tmpfs(empty_dir, 4 * MB)
+    try:
+        monitor = TmpfsMonitor(empty_dir, 16 * MB)
+        assert monitor.check() is True
+        _fill(os.path.join(empty_dir, 'data'), 3 * MB)
+        assert monitor.check() is True
+        assert utils.filesystem_usage(empty_dir)[0] > 4 * MB
+        assert monitor.exhausted is False
+    finally:
+        utils.umount(empty_dir)
+    assert monitor.check() is False
+
+
+def test_tmpfs_monitor_exhausted(empty_dir):
+    utils.mount_tmpfs(empty_dir, 4 * MB)
+    try:
+        monitor = TmpfsMonitor(empty_dir, 4 * MB)
+        _fill(os.path.join(empty_dir, 'data'), 3 * MB)
+        assert monitor.check() is True
+        assert utils.filesystem_usage(empty_dir)[0] == 4 * MB
+        assert monitor.exhausted is True
+    finally:
+        utils.umount(empty_dir)
+
+
+def test_tmpfs_monitor_process(empty_dir):
+    utils.mount_tmpfs(empty_dir, 4 * MB)
+    monitor = TmpfsMonitor(empty_dir, 64 * MB, interval=0.1)
+    monitor.start()
+    try:
+        # writes bigger than initial tmpfs size only succeed if it's grown
+        # while they are running
+        for num in range(12):
+            _fill(os.path.join(empty_dir, 'data%d' % num), MB)
+            time.sleep(0.3)
+        assert monitor.exhausted is False
+    finally:
+        monitor.stop()
+        utils.umount(empty_dir)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import datetime
+
+from upaas import tar
+from upaas.cache import FileLock, CacheDirectory, TreeCache, path_size
+
+
+def _write(path, size):
+    with open(path, 'wb') as out:
+        out.write(b'x' * size)
+
+
+def test_path_size(empty_dir):
+    _write(os.path.join(empty_dir, 'a'), 100)
+    os.mkdir(os.path.join(empty_dir, 'sub'))
+    _write(os.path.join(empty_dir, 'sub', 'b'), 50)
+    assert path_size(os.path.join(empty_dir, 'a')) == 100
+    assert path_size(empty_dir) >= 150
+
+
+def test_exclusive_lock(empty_file):
+    with FileLock(empty_file) as lock:
+        assert lock.locked
+        other = FileLock(empty_file, blocking=False)
+        assert other.acquire() is False
+    assert other.acquire() is True
+    other.release()
+
+
+def test_shared_lock(empty_file):
+    with FileLock(empty_file, shared=True):
+        other = FileLock(empty_file, shared=True, blocking=False)
+        assert other.acquire() is True
+        exclusive = FileLock(empty_file, blocking=False)
+        assert exclusive.acquire() is False
+        other.release()
+
+
+def test_cache_cleanup(empty_dir):
+    cache = CacheDirectory(os.path.join(empty_dir, 'cache'), max_size=250)
+    now = time.time()
+    for (i, name) in enumerate(['old', 'middle', 'new']):
+        _write(cache.entry_path(name), 100)
+        os.utime(cache.entry_path(name), (now - 100 + i, now - 100 + i))
+    cache.touch('old')
+    cache.cleanup()
+    assert sorted(os.listdir(cache.path)) == ['new', 'old']
+
+
+def test_cache_cleanup_skipped_when_locked(empty_dir):
+    cache = CacheDirectory(os.path.join(empty_dir, 'cache'), max_size=1)
+    _write(cache.entry_path('entry'), 100)
+    with cache.lock(shared=True):
+        cache.cleanup()
+        assert os.listdir(cache.path) == ['entry']
+    cache.cleanup()
+    assert os.listdir(cache.path) == []
+
+
+def test_tree_cache(empty_dir):
+    source = os.path.join(empty_dir, 'source')
+    os.mkdir(source)
+    _write(os.path.join(source, 'file'), 10)
+    archive = os.path.join(empty_dir, 'archive.tar.gz')
+    assert tar.pack_tar(source, archive)
+
+    cache = TreeCache(os.path.join(empty_dir, 'cache'))
+    mtime = datetime.datetime.now()
+    name = cache.entry_name('archive.tar.gz', mtime)
+    assert name != cache.entry_name(
+        'archive.tar.gz', mtime + datetime.timedelta(seconds=1))
+    assert cache.get(name) is None
+    path = cache.add(name, archive)
+    assert os.listdir(path) == ['file']
+    assert cache.get(name) == path
+    assert cache.add(name, archive) == path
+    assert os.listdir(cache.path) == [name]
+
+    destination = os.path.join(empty_dir, 'destination')
+    os.mkdir(destination)
+    assert cache.copy(name, destination)
+    assert os.listdir(destination) == ['file']
+    assert cache.copy('missing', destination) is False
+
+
+def test_tree_cache_expiry(empty_dir):
+    cache = TreeCache(os.path.join(empty_dir, 'cache'), max_age=3600)
+    now = datetime.datetime.now()
+    old = cache.entry_name('old.tar.gz', now - datetime.timedelta(days=1))
+    new = cache.entry_name('new.tar.gz', now)
+    for name in [old, new, '.%s.123' % new]:
+        os.mkdir(cache.entry_path(name))
+    cache.cleanup()
+    assert os.listdir(cache.path) == [new]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import uuid
+
+import pytest
+
+from upaas import cgroup
+from upaas import commands
+from upaas.processes import kill_and_remove_dir
+
+
+def _cgroup2_root():
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if fields[2] == 'cgroup2' and os.access(fields[1], os.W_OK):
+                    return fields[1]
+    except IOError:
+        pass
+
+
+requires_cgroup2 = pytest.mark.skipif(_cgroup2_root() is None,
+                                      reason="cgroup v2 is not writable")
+
+
+def _write(path, content):
+    with open(path, 'w') as out:
+        out.write(content)
+
+
+@pytest.fixture
+def fake_root(empty_dir):
+    _write(os.path.join(empty_dir, 'cgroup.controllers'), 'cpu io memory\n')
+    _write(os.path.join(empty_dir, 'cgroup.subtree_control'), '')
+    return empty_dir
+
+
+def test_cgroup_available(fake_root, empty_dir):
+    assert cgroup.cgroup_available(fake_root)
+    assert not cgroup.cgroup_available(os.path.join(empty_dir, 'missing'))
+
+
+def test_cgroup_limits(fake_root):
+    group = cgroup.CGroup('build', parent='upaas', root=fake_root)
+    os.makedirs(group.path)
+    _write(group.file_path('cgroup.procs'), '')
+    group.create()
+    with open(os.path.join(fake_root, 'cgroup.subtree_control')) as ctrl:
+        assert ctrl.read() == '+cpu +memory +io'
+    group.set_limits(cpu=1.5, memory=1024 * 1024)
+    assert group.read('cpu.max') == '150000 100000'
+    assert group.read('memory.max') == '1048576'
+
+
+def test_cgroup_stats(fake_root):
+    group = cgroup.CGroup('build', root=fake_root)
+    os.makedirs(group.path)
+    _write(group.file_path('cpu.stat'), 'usage_usec 2500000\n'
+           'user_usec 2000000\nsystem_usec 500000\nnr_periods 0\n')
+    _write(group.file_path('memory.peak'), '4096\n')
+    _write(group.file_path('io.stat'), '8:0 rbytes=100 wbytes=200 rios=1 '
+           'wios=2 dbytes=0 dios=0\n8:16 rbytes=1 wbytes=2 rios=3 wios=4\n')
+    assert group.stats() == {
+        'cpu_usage': 2.5, 'cpu_user': 2.0, 'cpu_system': 0.5,
+        'memory_peak': 4096, 'io_rbytes': 101, 'io_wbytes': 202,
+        'io_rios': 4, 'io_wios': 6}
+
+
+@requires_cgroup2
+def test_cgroup_execute(empty_dir):
+    workdir = os.path.join(empty_dir, 'workdir')
+    os.mkdir(workdir)
+    group = cgroup.CGroup('test_%s' % uuid.uuid4().hex, parent='upaas_test',
+                          root=_cgroup2_root())
+    group.create()
+    try:
+        commands.execute('sleep 30 >/dev/null 2>&1 &', cgroup=group)
+        assert len(group.pids()) == 1
+        assert group.populated()
+        cgroup.register(workdir, group)
+        assert cgroup.directory_cgroup(workdir) is group
+        kill_and_remove_dir(workdir)
+        assert cgroup.directory_cgroup(workdir) is None
+        assert not group.exists()
+    finally:
+        group.remove()
+        os.rmdir(group.parent)
@@ -35,3 +35,70 @@ def test_return_code():
 def test_env_and_output():
     _, output = commands.execute("echo $MYENV", env={"MYENV": "MYVALUE"})
     assert output == ["MYVALUE\n"]
+
+
+def test_session_output_and_return_code():
+    with commands.ShellSession() as session:
+        rcode, output = session.execute("echo first")
+        assert rcode == 0
+        assert output == ["first\n"]
+        rcode, _ = session.execute("exit 123", valid_retcodes=[123])
+        assert rcode == 123
+        _, output = session.execute("printf 'no newline'")
+        assert output == ["no newline"]
+
+
+def test_session_failed_command():
+    with commands.ShellSession() as session:
+        with pytest.raises(commands.CommandFailed):
+            session.execute("non existing command")
+        _, output = session.execute("echo 'still running'")
+        assert output == ["still running\n"]
+
+
+def test_session_timeout():
+    with commands.ShellSession() as session:
+        with pytest.raises(commands.CommandTimeout):
+            session.execute("sleep 2", timeout=1)
+        assert not session.is_running()
+
+
+def test_session_env():
+    with commands.ShellSession(env={"MYENV": "MYVALUE"},
+                               strip_envs=True) as session:
+        _, output = session.execute("echo $MYENV")
+        assert output == ["MYVALUE\n"]
+
+
+def test_usage():
+    usage = commands.CommandUsage("sleep 0.1")
+    commands.execute("sleep 0.1", usage=usage)
+    assert usage.count == 1
+    assert usage.wall >= 0.1
+    assert usage.maxrss > 0
+    total = commands.CommandUsage()
+    total.add(usage)
+    total.add(usage)
+    assert total.count == 2
+    assert total.wall == usage.wall * 2
+    assert total.maxrss == usage.maxrss
+    assert usage.dump()['cmd'] == "sleep 0.1"
+    assert 'cmd' not in total.dump()
+
+
+def test_session_usage():
+    usage = commands.CommandUsage("sleep 0.1")
+    with commands.ShellSession() as session:
+        session.execute("sleep 0.1", usage=usage)
+    assert usage.wall >= 0.1
+    assert session.usage.maxrss > 0
+
+
+def test_multiline_output():
+    _, output = commands.execute("printf 'a\\nb\\nc\\n'")
+    assert output == ["a\n", "b\n", "c\n"]
+
+
+def test_output_limit():
+    _, output = commands.execute("seq 1 1000", output_limit=10)
+    assert output == ["1\n", "2\n", "3\n", "4\n", "5\n"]
@@ -453,3 +453,65 @@ def test_nested_dict_config_type_invalid():
 def test_nested_dict_config_value_invalid():
     with pytest.raises(base.ConfigurationError):
         NestedDictBoolConfig({"subconfig": {'a': {"mybool_false": 1}}})
+
+
+def test_compiled_schema_cached():
+    compiled = base.compile_schema(BasicConfig.schema)
+    assert base.compile_schema(BasicConfig.schema) is compiled
+    assert [key for (key, _, _, _) in compiled] == list(
+        BasicConfig.schema.keys())
+    other = dict(BasicConfig.schema)
+    assert base.compile_schema(other) is not compiled
+
+
+def test_compiled_schema_errors():
+    for _ in range(2):
+        with pytest.raises(base.ConfigurationError) as excinfo:
+            BasicConfig({"required_string": "abc", "folder1": {
+                "subfolder1": {"required_int": "abc"}}})
+        assert 'folder1.subfolder1.required_int is invalid' in '%s' % (
+            excinfo.value)
+        with pytest.raises(base.ConfigurationError) as excinfo:
+            BasicConfig({"folder1": {"subfolder1": {"required_int": 1}}})
+        assert '%s' % excinfo.value == "Missing required configuration " \
+                                       "entry: required_string"
+
+
+def _write(path, content):
+    with open(path, 'w') as out:
+        out.write(content)
+
+
+def test_load_yaml_file_cached(empty_dir, monkeypatch):
+    main = os.path.join(empty_dir, 'main.yml')
+    included = os.path.join(empty_dir, 'included.yml')
+    _write(main, "required_string: abc\nchained: !include included.yml\n")
+    _write(included, "included: true\n")
+    parsed = []
+    real_load = base.yaml.load
+
+    def counting_load(stream, Loader):
+        parsed.append(stream.name)
+        return real_load(stream, Loader=Loader)
+    monkeypatch.setattr(base.yaml, 'load', counting_load)
+
+    first = base.load_yaml_file(main)
+    assert first == {'required_string': 'abc', 'chained': {'included': True}}
+    first['chained']['included'] = False
+    assert base.load_yaml_file(main) == {'required_string': 'abc',
+                                         'chained': {'included': True}}
+    assert base.load_yaml_file(included) == {'included': True}
+    assert parsed == [main, included]
+
+    _write(included, "included: false\nextra: 1\n")
+    assert base.load_yaml_file(main)['chained'] == {'included': False,
+                                                    'extra': 1}
+    assert parsed == [main, included, main, included]
+
+
+def test_from_string_include():
+    path = os.path.join(os.path.dirname(__file__), "test_config_included.yml")
+    cfg = BasicConfig.from_string("required_string: abc\nchained: !include "
+                                  "%s\nfolder1:\n  subfolder1:\n    "
+                                  "required_int: 1\n" % path)
+    assert cfg.chained.included is True
@@ -11,7 +11,7 @@ from collections import namedtuple
 
 import pytest
 
-from upaas.config.metadata import MetadataConfig
+from upaas.config.metadata import MetadataConfig, VCSInfoEntry
 from upaas.utils import supported_versions
 
 
@@ -100,6 +100,12 @@ def test_changelog_command(metadata_manual):
     assert metadata_manual.repository.revision.changelog == 'changelog cmd'
 
 
+def test_info_joined_commands():
+    cmd = VCSInfoEntry.commands['hg']
+    assert cmd.startswith("( hg id -i ) ; printf '\\036' ; ")
+    assert cmd.count('036') == len(VCSInfoEntry.fields) - 1
+
+
 def test_supported_versions_major(interpreters_config):
     metadata = MetadataConfig.from_string('''
 interpreter:
@@ -135,3 +141,24 @@ repository:
     assert '1.8' in valid
     assert '1.9' in valid
     assert '2.1' in valid
+
+
+def test_dependency_cache():
+    metadata = MetadataConfig.from_string('''
+interpreter:
+  type: ruby
+repository:
+  clone: echo "Cloned"
+  update: echo "Updated"
+cache:
+  - path: vendor/bundle
+    key:
+      - Gemfile.lock
+''')
+    assert metadata.cache[0].path == 'vendor/bundle'
+    assert metadata.cache[0].key == ['Gemfile.lock']
+
+
+def test_info_detect(metadata_detect):
+    assert metadata_detect.repository.revision.info() == \
+        "git log -1 --pretty='%H%x1e%aN <%aE>%x1e%at%x1e%B'"
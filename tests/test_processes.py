@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import signal
+import subprocess
+
+from upaas import processes
+
+
+def _spawn(cmd, **kwargs):
+    return subprocess.Popen(cmd, shell=True, **kwargs)
+
+
+def test_directory_pids_cwd(empty_dir):
+    proc = _spawn('exec sleep 30', cwd=empty_dir)
+    try:
+        assert proc.pid in processes.directory_pids(empty_dir)
+        assert proc.pid not in processes.directory_pids(
+            os.path.dirname(__file__))
+    finally:
+        proc.kill()
+        proc.wait()
+    assert proc.pid not in processes.directory_pids(empty_dir)
+
+
+def test_directory_pids_open_file(empty_dir):
+    path = os.path.join(empty_dir, 'file')
+    proc = _spawn('exec sleep 30 > %s' % path)
+    try:
+        assert proc.pid in processes.directory_pids(empty_dir)
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_directory_pids_missing():
+    assert processes.directory_pids('/missing/directory') == []
+
+
+def test_is_pid_running():
+    assert processes.is_pid_running(os.getpid())
+    proc = _spawn('exit 0')
+    proc.wait()
+    assert not processes.is_pid_running(proc.pid)
+
+
+def test_kill_pids_parallel():
+    procs = [_spawn('exec sleep 30') for _ in range(5)]
+    started = time.time()
+    processes.kill_pids([proc.pid for proc in procs], timeout=5)
+    assert time.time() - started < 2
+    for proc in procs:
+        assert proc.wait() == -signal.SIGTERM
+
+
+def test_kill_pids_sigkill():
+    procs = [_spawn("trap '' TERM; sleep 30 & wait") for _ in range(3)]
+    time.sleep(0.2)
+    started = time.time()
+    processes.kill_pids([proc.pid for proc in procs], timeout=1)
+    assert time.time() - started < 3
+    for proc in procs:
+        assert proc.wait() == -signal.SIGKILL
+
+
+def test_wait_for_pids_timeout():
+    proc = _spawn('exec sleep 30')
+    try:
+        assert processes.wait_for_pids([proc.pid], 0.2) == [proc.pid]
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_kill_and_remove_dir(empty_dir):
+    workdir = os.path.join(empty_dir, 'workdir')
+    os.mkdir(workdir)
+    procs = [_spawn('exec sleep 30', cwd=workdir) for _ in range(3)]
+    processes.kill_and_remove_dir(workdir)
+    assert not os.path.exists(workdir)
+    for proc in procs:
+        assert proc.wait() == -signal.SIGTERM
+
+
+def test_kill_pids_without_pidfd(monkeypatch):
+    monkeypatch.setattr(processes, '_open_pidfd', lambda pid: None)
+    procs = [_spawn('exec sleep 30') for _ in range(3)]
+    started = time.time()
+    processes.kill_pids([proc.pid for proc in procs], timeout=5)
+    assert time.time() - started < 2
+    for proc in procs:
+        assert proc.wait() == -signal.SIGTERM
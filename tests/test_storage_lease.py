@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+from upaas.storage.local import LocalStorage
+from upaas.storage.lease import StorageLease
+
+
+def test_lease(empty_dir):
+    storage = LocalStorage({'dir': empty_dir})
+    lease = StorageLease(storage, 'image.lease', settle=0)
+    other = StorageLease(storage, 'image.lease', settle=0)
+    assert lease.read() is None
+    assert lease.acquire() is True
+    assert lease.read()['holder'] == lease.holder
+    assert other.acquire() is False
+    lease.renew()
+    assert lease.read()['holder'] == lease.holder
+    other.release()
+    assert storage.exists('image.lease')
+    lease.release()
+    assert not storage.exists('image.lease')
+    other.wait()
+    assert other.acquire() is True
+    other.release()
+
+
+def test_lease_expired(empty_dir):
+    storage = LocalStorage({'dir': empty_dir})
+    lease = StorageLease(storage, 'image.lease', ttl=-1, settle=0)
+    other = StorageLease(storage, 'image.lease', settle=0)
+    assert lease.acquire() is True
+    other.wait()
+    assert other.acquire() is True
+    assert lease.read()['holder'] == other.holder
+    lease.release()
+    assert storage.exists('image.lease')
+
+
+def test_lease_invalid(empty_dir):
+    storage = LocalStorage({'dir': empty_dir})
+    with open('%s/image.lease' % empty_dir, 'w') as lease_file:
+        lease_file.write('invalid')
+    lease = StorageLease(storage, 'image.lease', settle=0)
+    assert lease.acquire() is True
+
+
+def test_lease_renew(empty_dir):
+    class TrackingStorage(LocalStorage):
+        deleted = []
+
+        def delete(self, remote_path):
+            self.deleted.append(remote_path)
+            super(TrackingStorage, self).delete(remote_path)
+
+    storage = TrackingStorage({'dir': empty_dir})
+    lease = StorageLease(storage, 'image.lease', ttl=-1, settle=0)
+    other = StorageLease(storage, 'image.lease', settle=0)
+    assert lease.acquire() is True
+    assert lease.renew() is True
+    assert storage.deleted == []
+    # expired lease is overwritten, it's never missing during takeover
+    assert other.acquire() is True
+    assert storage.deleted == []
+    assert lease.renew() is False
+    assert lease.read()['holder'] == other.holder
@@ -90,6 +90,34 @@ def test_put_and_get(storage, empty_dir, empty_file):
     assert os.path.exists(local_path)
 
 
+def test_put_callback(storage, empty_file):
+    with open(empty_file, 'w') as f:
+        f.write('x' * 100000)
+    os.chmod(empty_file, 0o640)
+    uploaded = []
+    storage.put(empty_file, "progress", callback=uploaded.append)
+    assert sum(uploaded) == 100000
+    assert len(uploaded) > 1
+    assert storage.size("progress") == 100000
+    assert os.stat(os.path.join(storage.settings.dir, "progress")).st_mode \
+        & 0o777 == 0o640
+
+
+def test_replace(storage, empty_dir, empty_file):
+    with open(empty_file, 'w') as f:
+        f.write('old')
+    storage.replace(empty_file, "replace.me")
+    with open(empty_file, 'w') as f:
+        f.write('new')
+    storage.replace(empty_file, "replace.me")
+    assert not [name for name in os.listdir(storage.settings.dir)
+                if name.endswith('.tmp')]
+    local_path = os.path.join(empty_dir, "replaced")
+    storage.get("replace.me", local_path)
+    with open(local_path) as f:
+        assert f.read() == 'new'
+
+
 def test_delete_not_exists(storage):
     with pytest.raises(FileNotFound):
         storage.delete("missing file")
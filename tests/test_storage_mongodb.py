@@ -15,6 +15,8 @@ import pytest
 
 from pymongo import MongoClient
 
+from gridfs import GridFS
+
 from upaas.storage.mongodb import MongoDBStorage
 from upaas.storage.exceptions import FileNotFound
 from upaas.config.base import ConfigurationError
@@ -67,6 +69,44 @@ def test_put_and_get(storage, empty_dir, empty_file):
     assert os.path.exists(local_path)
 
 
+def test_put_callback(storage, empty_file):
+    with open(empty_file, 'w') as f:
+        f.write('x' * 10000)
+    uploaded = []
+    storage.put(empty_file, "progress", callback=uploaded.append)
+    assert sum(uploaded) == 10000
+    assert storage.size("progress") == 10000
+
+
+def test_replace(storage, empty_dir, empty_file):
+    with open(empty_file, 'w') as f:
+        f.write('old')
+    storage.put(empty_file, "replace.me")
+    with open(empty_file, 'w') as f:
+        f.write('new')
+    storage.replace(empty_file, "replace.me")
+    local_path = os.path.join(empty_dir, "replaced")
+    storage.get("replace.me", local_path)
+    with open(local_path) as f:
+        assert f.read() == 'new'
+    storage.delete("replace.me")
+    assert storage.exists("replace.me") is False
+
+
+def test_replace_keeps_previous_version(storage, empty_file):
+    for content in ['first', 'second', 'third']:
+        with open(empty_file, 'w') as f:
+            f.write(content)
+        storage.replace(empty_file, "versions")
+    client = MongoClient()
+    fs = GridFS(client[storage.settings.database])
+    versions = [f.read() for f in fs.find({'filename': 'versions'})]
+    client.close()
+    assert sorted(versions) == [b'second', b'third']
+    storage.delete("versions")
+    assert storage.exists("versions") is False
+
+
 def test_delete_not_exists(storage):
     with pytest.raises(FileNotFound):
         storage.delete("missing file")
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+
+from upaas.trash import Trash
+from upaas.processes import kill_and_remove_dir
+
+
+def _make_tree(path, files=5, size=1024):
+    os.makedirs(os.path.join(path, 'sub', 'dir'))
+    os.symlink('/tmp', os.path.join(path, 'sub', 'link'))
+    for i in range(files):
+        with open(os.path.join(path, 'sub', 'dir', '%d' % i), 'wb') as out:
+            out.write(b'x' * size)
+
+
+def _wait_empty(trash, timeout=10):
+    deadline = time.time() + timeout
+    while trash.entries() and time.time() < deadline:
+        time.sleep(0.05)
+    return trash.entries() == []
+
+
+def test_trash_put_and_empty(empty_dir):
+    trash = Trash(os.path.join(empty_dir, 'trash'))
+    build = os.path.join(empty_dir, 'build')
+    _make_tree(build)
+    assert trash.put(build)
+    assert not os.path.exists(build)
+    assert len(trash.entries()) == 1
+    assert trash.empty()
+    assert trash.entries() == []
+    assert os.path.isdir('/tmp')
+
+
+def test_trash_put_missing(empty_dir):
+    trash = Trash(os.path.join(empty_dir, 'trash'))
+    assert not trash.put(os.path.join(empty_dir, 'missing'))
+
+
+def test_trash_locked(empty_dir):
+    trash = Trash(os.path.join(empty_dir, 'trash'))
+    _make_tree(os.path.join(empty_dir, 'build'))
+    trash.put(os.path.join(empty_dir, 'build'))
+    with trash.lock():
+        assert not trash.empty()
+    assert len(trash.entries()) == 1
+
+
+def test_trash_rate(empty_dir):
+    trash = Trash(os.path.join(empty_dir, 'trash'), rate=10 * 1024)
+    build = os.path.join(empty_dir, 'build')
+    _make_tree(build, files=5, size=1024)
+    trash.put(build)
+    started = time.time()
+    trash.empty()
+    assert time.time() - started >= 0.4
+
+
+def test_kill_and_remove_dir_trash(empty_dir):
+    trash = Trash(os.path.join(empty_dir, 'trash'), ionice=False)
+    build = os.path.join(empty_dir, 'build')
+    _make_tree(build)
+    kill_and_remove_dir(build, trash=trash)
+    assert not os.path.exists(build)
+    assert _wait_empty(trash)
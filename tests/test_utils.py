@@ -7,7 +7,16 @@
 
 from __future__ import unicode_literals
 
+import os
+
+import pytest
+
 from upaas import utils
+from upaas.commands import CommandFailed
+
+
+requires_root = pytest.mark.skipif(os.geteuid() != 0,
+                                   reason="mounting requires root")
 
 
 def test_version_fuzzy_compare():
@@ -43,3 +52,88 @@ def test_version_tuple_to_string():
 
 def test_backend_total_memory():
     assert utils.backend_total_memory() > 32 * 1024 * 1024
+
+
+def test_backend_available_memory():
+    available = utils.backend_available_memory()
+    assert available is None or \
+        0 < available <= utils.backend_total_memory()
+
+
+def test_backend_load():
+    assert utils.backend_load() >= 0
+
+
+def test_get_config_option():
+    class Config:
+        class commands:
+            timelimit = 10
+        interpreters = {'ruby': {'any': {'env': {}}}}
+
+    assert utils.get_config_option(Config, 'commands.timelimit') == 10
+    assert utils.get_config_option(Config, 'interpreters.ruby.any.env') == {}
+    assert utils.get_config_option(Config, 'commands.missing') is None
+    assert utils.get_config_option(Config, 'missing.key', default=1) == 1
+
+
+def test_depth_order():
+    assert utils._depth_order(['/w/a', '/w/a/b/c', '/w/b', '/w/a/b']) == [
+        '/w/a/b/c', '/w/a/b', '/w/b', '/w/a']
+
+
+def test_unescape_mount_path():
+    assert utils._unescape_mount_path('/tmp/a\\040b') == '/tmp/a b'
+
+
+def test_mount_registry():
+    registry = utils.MountRegistry()
+    registry.add('/w/a/')
+    registry.add('/w/a/b')
+    registry.add('/other')
+    assert registry.under('/w') == ['/w/a', '/w/a/b']
+    registry.discard('/w/a')
+    assert registry.under('/w') == ['/w/a/b']
+
+
+def test_chroot_path(empty_dir):
+    root = os.path.join(empty_dir, 'root')
+    os.makedirs(os.path.join(root, 'var'))
+    os.symlink(empty_dir, os.path.join(root, 'host'))
+    os.symlink('var', os.path.join(root, 'local'))
+    assert utils.chroot_path(root, '/var/cache') == os.path.join(
+        os.path.realpath(root), 'var', 'cache')
+    assert utils.chroot_path(root, 'local') == os.path.join(
+        os.path.realpath(root), 'var')
+    with pytest.raises(ValueError):
+        utils.chroot_path(root, '/host/cache')
+    with pytest.raises(ValueError):
+        utils.chroot_path(root, '/../cache')
+
+
+@requires_root
+def test_umount_filesystems(empty_dir):
+    source = os.path.join(empty_dir, 'source')
+    target = os.path.join(empty_dir, 'target')
+    os.makedirs(os.path.join(source, 'nested'))
+    os.mkdir(target)
+    registry = utils.MountRegistry()
+    utils.bind_mount(source, target, registry=registry)
+    utils.bind_mount(empty_dir, os.path.join(target, 'nested'),
+                     registry=registry)
+    assert utils.mounted_filesystems(empty_dir) == [
+        target, os.path.join(target, 'nested')]
+    utils.umount_filesystems(empty_dir, registry=registry)
+    assert utils.mounted_filesystems(empty_dir) == []
+    assert registry.under(empty_dir) == []
+
+
+@requires_root
+def test_umount_lazy(empty_dir):
+    target = os.path.join(empty_dir, 'mnt')
+    os.mkdir(target)
+    utils.bind_mount(empty_dir, target)
+    with open(os.path.join(target, 'busy'), 'w'):
+        with pytest.raises(CommandFailed):
+            utils.umount(target)
+        utils.umount(target, lazy=True)
+        assert utils.mounted_filesystems(empty_dir) == []
@@ -8,28 +8,80 @@
 from __future__ import unicode_literals
 
 import os
+import re
+import json
+import time
+import shutil
 import tempfile
 import datetime
 import logging
+import multiprocessing
+from contextlib import contextmanager
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 
 from timestring import Date, TimestringInvalid
 
 from upaas import distro
 
+from upaas import cgroup
 from upaas import commands
 from upaas import tar
 from upaas import utils
-from upaas.checksum import calculate_file_sha256
+from upaas.checksum import calculate_file_sha256, calculate_string_sha256
 from upaas.builder import exceptions
+from upaas.builder.events import BuildEvent, EventStream, TransferMeter, mbps
+from upaas.builder.pool import WarmPool
+from upaas.builder.stages import BuildStage, StageStats
+from upaas.builder.tmpfs import TmpfsMonitor
+from upaas.cache import CacheDirectory, FileLock, TreeCache
 from upaas.chroot import Chroot
+from upaas.config.metadata import MetadataConfig, VCSInfoEntry
 from upaas.storage.exceptions import StorageError
+from upaas.storage.lease import StorageLease
 from upaas.processes import kill_and_remove_dir
+from upaas.trash import Trash
 from upaas.utils import load_handler
 
 
 log = logging.getLogger(__name__)
 
 
+def warm_pool(builder_config):
+    """
+    Return pool of ready to use chroots if it's enabled in builder config
+    (pool.dir, optional pool.size, pool.ttl in seconds and pool.max_size in
+    MB).
+    """
+    pool_dir = utils.get_config_option(builder_config, 'pool.dir')
+    if pool_dir:
+        max_size = utils.get_config_option(builder_config, 'pool.max_size')
+        return WarmPool(
+            pool_dir,
+            size=utils.get_config_option(builder_config, 'pool.size',
+                                         default=1),
+            ttl=utils.get_config_option(builder_config, 'pool.ttl'),
+            max_size=max_size and max_size * 1024 * 1024)
+
+
+def build_trash(builder_config):
+    """
+    Return trash used for removing build directories in background if it's
+    enabled in builder config (cleanup.trash, optional cleanup.rate in MB per
+    second and cleanup.nice). Trash must be on the same filesystem as
+    paths.workdir.
+    """
+    trash_dir = utils.get_config_option(builder_config, 'cleanup.trash')
+    if trash_dir:
+        rate = utils.get_config_option(builder_config, 'cleanup.rate')
+        return Trash(trash_dir, rate=rate and rate * 1024 * 1024,
+                     nice=utils.get_config_option(builder_config,
+                                                  'cleanup.nice', default=19))
+
+
 class BuildResult:
 
     def __init__(self):
@@ -56,18 +108,88 @@ class BuildResult:
         # information about last commit in VCS (if available)
         self.vcs_revision = {}
 
+        # resources used by commands executed in each build stage
+        self.usage = {}
+
+        # resources used by all build processes, collected from build cgroup
+        # (if enabled)
+        self.cgroup = {}
+
+        # list of executed build stages (name, timing, bytes and status)
+        self.stages = []
+
+        # True if nothing changed since parent package was built and it was
+        # used as the result of this build
+        self.reused = False
+
+        # fingerprint of everything used to build this package, it's also
+        # stored inside the package
+        self.fingerprint = None
+
+    def dump(self):
+        return dict(self.__dict__)
+
 
 class Builder(object):
 
-    # TODO stage decorators
-    # @stage('action_system', 95%)
-    # time()
+    # all build stages with default weights used to calculate build progress
+    # if there are no historical stage durations available
+    stages = [
+        ('unpack_os', 10),
+        ('system_actions', 10),
+        ('install_packages', 15),
+        ('interpreter_actions', 5),
+        ('repository', 5),
+        ('vcs_info', 1),
+        ('write_files', 3),
+        ('restore_cache', 1),
+        ('app_actions', 34),
+        ('save_cache', 1),
+        ('finalize_actions', 3),
+        ('chown', 1),
+        ('umount', 1),
+        ('pack', 3),
+        ('checksum', 3),
+        ('upload', 4),
+    ]
+
+    # storage file with the list of all uploaded snapshots
+    snapshot_index = 'snapshots.index'
 
     builder_action_names = ["system"]
     interpreter_action_names = ["interpreter"]
     app_action_names = ["before", "main", "after"]
     finalize_action_names = ["finalize"]
 
+    # commands used to create and update repository mirror for every
+    # supported VCS type, %url% is replaced with quoted repository url and
+    # %mirror% with quoted mirror path, they are executed on the builder host
+    mirror_commands = {
+        'git': ('git clone --mirror -- %url% %mirror%',
+                'git --git-dir=%mirror% remote update --prune'),
+        'hg': ('hg clone --noupdate -- %url% %mirror%',
+               'hg --repository %mirror% pull'),
+    }
+
+    # commands used to verify that application can access its repository
+    # before mirror is used, they are executed inside the chroot with
+    # repository env variables from metadata
+    mirror_access_commands = {
+        'git': 'git ls-remote --heads -- %url%',
+        'hg': 'hg identify -- %url%',
+    }
+
+    # file with build fingerprint, stored in the root directory of every
+    # package
+    fingerprint_file = 'upaas.fingerprint'
+
+    # only remote repositories can be mirrored
+    mirror_protocols = ['https', 'http', 'git', 'ssh']
+
+    # characters allowed in mirrored repository url, there is no whitespace
+    # or shell metacharacters and url can't start with '-'
+    mirror_url_re = re.compile(r'^(?!-)[A-Za-z0-9._~@:/?#\[\]!+,=%-]+$')
+
     def __init__(self, builder_config, metadata):
         """
         :param builder_config: Builder configuration.
@@ -84,14 +206,147 @@ class Builder(object):
 
         self.current_revision = None
 
+        self.stage = None
+        self.usage = {}
+        self.stage_usage = {}
+        self.stage_hooks = []
+        self.finished_stages = []
+        self.progress = {}
+        # progress reached by aborted build attempt, retry starts from it
+        self.progress_floor = 0
+        self.events = EventStream()
+
+        # list of (workdir, directory inside chroot, cache entry name) tuples
+        self.dependency_caches = []
+
+        # cgroup tracking all processes started by this build
+        self.cgroup = None
+
+        # filesystems mounted by this build
+        self.mounts = utils.MountRegistry()
+
+        self.trash = build_trash(self.config)
+
+        # build directory mounted as tmpfs, its size in bytes and
+        # TmpfsMonitor watching it while build commands are running
+        self.use_tmpfs = True
+        self.tmpfs = None
+        self.tmpfs_size = None
+        self.tmpfs_monitor = None
+
+    def execute(self, cmd, **kwargs):
+        """
+        Execute command and account resources it used to current build stage.
+        Accepts the same arguments as commands.execute().
+        """
+        usage = commands.CommandUsage(cmd)
+        if self.cgroup is not None:
+            kwargs.setdefault('cgroup', self.cgroup)
+        try:
+            return commands.execute(cmd, usage=usage, **kwargs)
+        finally:
+            self.account_usage(usage)
+
+    def account_usage(self, usage):
+        """
+        Add resources used by a command to the current build stage totals.
+        """
+        stage = self.stage or 'other'
+        total = self.stage_usage.setdefault(stage, commands.CommandUsage())
+        total.add(usage)
+        self.usage.setdefault(stage, {'commands': []})
+        self.usage[stage]['total'] = total.dump()
+        self.usage[stage]['commands'].append(usage.dump())
+
+    def add_stage_hook(self, callback):
+        """
+        Register callback that will be called with BuildStage instance every
+        time build stage is started or finished.
+        """
+        self.stage_hooks.append(callback)
+
+    def run_stage_hooks(self, stage):
+        for callback in self.stage_hooks:
+            try:
+                callback(stage)
+            except Exception as e:
+                log.error("Stage hook %s failed: %s" % (callback, e))
+
+    def stage_stats(self):
+        """
+        Historical stage durations are stored only if paths.stage_stats is
+        set, default stage weights are used otherwise.
+        """
+        return StageStats(utils.get_config_option(self.config,
+                                                  'paths.stage_stats'))
+
+    @contextmanager
+    def build_stage(self, name, result):
+        """
+        Run build stage, it's timing and outcome is recorded in build result
+        and build progress is updated once stage is finished.
+        """
+        stage = BuildStage(name)
+        self.stage = name
+        stage.start()
+        self.run_stage_hooks(stage)
+        self.events.emit(BuildEvent.STAGE_STARTED, stage=name,
+                         progress=result.progress)
+        try:
+            yield stage
+        except Exception:
+            stage.finish(BuildStage.FAILED)
+            result.stages.append(stage.dump())
+            self.run_stage_hooks(stage)
+            self.emit_stage_finished(stage)
+            raise
+        if stage.skipped:
+            stage.finish(BuildStage.SKIPPED)
+        else:
+            stage.finish(BuildStage.SUCCESS)
+        self.finished_stages.append(stage)
+        result.stages.append(stage.dump())
+        if self.tmpfs:
+            self.check_tmpfs()
+        self.run_stage_hooks(stage)
+        self.emit_stage_finished(stage)
+        if self.progress.get(name, result.progress) != result.progress:
+            result.progress = self.progress[name]
+            self.events.emit(BuildEvent.PROGRESS, stage=name,
+                             progress=result.progress)
+
+    def emit_stage_finished(self, stage):
+        self.events.emit(BuildEvent.STAGE_FINISHED, stage=stage.name,
+                         status=stage.status, duration=stage.duration,
+                         bytes=stage.bytes,
+                         mbps=mbps(stage.bytes, stage.duration))
+
+    def emit_finished(self, result):
+        self.events.emit(BuildEvent.FINISHED, filename=result.filename,
+                         checksum=result.checksum, bytes=result.bytes,
+                         reused=result.reused)
+
     def user_error(self, msg):
         log.error(msg)
+        if not self.retry_on_disk():
+            self.events.emit(BuildEvent.FAILED, stage=self.stage, error=msg,
+                             user_error=True)
         raise exceptions.PackageUserError(msg)
 
     def system_error(self, msg):
         log.error(msg)
+        if not self.retry_on_disk():
+            self.events.emit(BuildEvent.FAILED, stage=self.stage, error=msg,
+                             user_error=False)
         raise exceptions.PackageSystemError(msg)
 
+    def retry_on_disk(self):
+        """
+        Failed build is retried on disk if it was running on tmpfs that was
+        filled up, it might have failed only because it ran out of space.
+        """
+        return self.tmpfs_monitor is not None and self.tmpfs_monitor.exhausted
+
     def parse_actions(self, meta):
         """
         Parse and merge all config files (builder and app meta), then return
@@ -249,6 +504,27 @@ class Builder(object):
                 pass
         return ret
 
+    def parse_dependency_caches(self, meta):
+        """
+        Parse and merge all config files (builder and app meta), then return
+        list of all dependency cache directories as (path, key files) tuples.
+        """
+        ret = []
+        for version in ["any"] + [self.interpreter_version]:
+            try:
+                entries = self.config.interpreters[meta.interpreter.type][
+                    version]["cache"]
+            except KeyError:
+                continue
+            for entry in entries:
+                ret.append((entry["path"], entry.get("key", [])))
+        for entry in meta.get("cache", []):
+            ret.append((entry.path, entry.key))
+        for (path, key_files) in ret:
+            log.info("Will cache '%s' directory, key files: %s" % (
+                path, ', '.join(key_files) or 'none'))
+        return ret
+
     def build_package(self, system_filename=None, interpreter_version=None,
                       current_revision=None, env=None):
         """
@@ -260,6 +536,41 @@ class Builder(object):
                                     for fresh packages.
         :param current_revision: VCS revision id from current package.
         """
+        os_packages = list(self.os_packages)
+        try:
+            try:
+                for result in self._build_package(
+                        system_filename=system_filename,
+                        interpreter_version=interpreter_version,
+                        current_revision=current_revision, env=env):
+                    yield result
+            except (exceptions.PackageUserError,
+                    exceptions.PackageSystemError):
+                if not self.retry_on_disk():
+                    raise
+                log.warning("Build failed after filling up tmpfs, retrying "
+                            "it on disk")
+                self.release_tmpfs()
+                self.use_tmpfs = False
+                # nothing from aborted attempt is reported in the result or
+                # stage statistics, progress continues from the point where
+                # it failed
+                self.progress_floor = self.progress.get(self.stage, 0)
+                self.os_packages = os_packages
+                self.usage = {}
+                self.stage_usage = {}
+                self.finished_stages = []
+                self.dependency_caches = []
+                for result in self._build_package(
+                        system_filename=system_filename,
+                        interpreter_version=interpreter_version,
+                        current_revision=current_revision, env=env):
+                    yield result
+        finally:
+            self.release_tmpfs()
+
+    def _build_package(self, system_filename=None, interpreter_version=None,
+                       current_revision=None, env=None):
         if interpreter_version:
             self.interpreter_version = interpreter_version
             log.info("Using forced interpreter version: "
@@ -281,14 +592,18 @@ class Builder(object):
             self.envs['UPAAS_FRESH_PACKAGE'] = 'true'
             system_filename = None
             log.info("Starting package build using empty system image")
+            self.stage = 'bootstrap_os'
             if not self.has_valid_os_image():
                 try:
-                    self.bootstrap_os()
+                    self.ensure_os_image()
                 except exceptions.OSBootstrapError as e:
                     self.system_error("Error during os bootstrap: %s" % e)
                 except StorageError as e:
                     self.system_error("Error during uploading OS image: "
                                       "%s" % e)
+            elif self.os_image_needs_refresh():
+                log.info("Current OS image will be used until it's "
+                         "refreshed by OSBuilder.refresh_os_image()")
 
         if not self.interpreter_version:
             self.user_error("Unsupported interpreter version")
@@ -304,129 +619,467 @@ class Builder(object):
         result = BuildResult()
         result.parent = system_filename
         result.interpreter_version = self.interpreter_version
+        result.usage = self.usage
+
+        stage_stats = self.stage_stats()
+        self.progress = stage_stats.progress(self.stages)
+        if self.progress_floor:
+            # retried build, progress is scaled to the remaining range
+            self.progress = dict([
+                (name, self.progress_floor + value * (
+                    100 - self.progress_floor) // 100)
+                for (name, value) in self.progress.items()])
+            result.progress = self.progress_floor
 
         # directory is encoded into string to prevent unicode errors
-        directory = tempfile.mkdtemp(dir=self.config.paths.workdir,
-                                     prefix="upaas_package_")
+        directory = self.make_build_directory(system_filename)
         workdir = os.path.join(directory, "workdir")
         chroot_homedir = self.config.apps.home
         os.mkdir(workdir, 0o755)
         log.info("Working directory created at '%s'" % workdir)
+        self.cgroup = self.build_cgroup(directory)
         self.envs['HOME'] = chroot_homedir
 
-        if not self.unpack_os(directory, workdir,
-                              system_filename=system_filename):
-            kill_and_remove_dir(directory)
-            self.system_error("Unpacking OS image failed")
-        log.info("OS image unpacked")
-        result.progress = 10
+        snapshot = None
+        from_snapshot = False
+        if not system_filename and utils.get_config_option(
+                self.config, 'snapshots.enabled', default=False):
+            snapshot = self.snapshot_filename()
+
+        # set of OS packages installed in chroot claimed from warm pool
+        pool_packages = None
+
+        with self.build_stage('unpack_os', result) as stage:
+            if not system_filename:
+                pool_packages = self.claim_pooled_workdir(workdir)
+            if pool_packages is not None:
+                log.info("Using chroot from warm pool")
+                stage.skip()
+            elif snapshot and self.storage.exists(snapshot):
+                from_snapshot = self.unpack_snapshot(directory, workdir,
+                                                     snapshot)
+            if pool_packages is None and not from_snapshot and \
+                    not self.unpack_os(directory, workdir,
+                                       system_filename=system_filename):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("Unpacking OS image failed")
+            if os.path.isfile(os.path.join(directory, "os.image")):
+                stage.bytes = os.path.getsize(os.path.join(directory,
+                                                           "os.image"))
+            log.info("OS image unpacked")
         yield result
 
         log.info("Using interpreter %s, version %s" % (
             self.metadata.interpreter.type, self.interpreter_version))
 
-        if not self.run_actions(self.builder_action_names, workdir):
-            kill_and_remove_dir(directory)
-            self.system_error("System actions failed")
-        log.info("All builder actions executed")
-        result.progress = 20
+        with self.build_stage('system_actions', result):
+            if not self.run_actions(self.builder_action_names, workdir):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("System actions failed")
+            log.info("All builder actions executed")
         yield result
 
-        if not self.install_packages(workdir, self.os_packages):
-            kill_and_remove_dir(directory)
-            self.user_error("Failed to install OS packages")
-        log.info("All packages installed")
-        result.progress = 35
+        with self.build_stage('install_packages', result) as stage:
+            packages = set(self.os_packages) - (pool_packages or set())
+            if from_snapshot:
+                log.info("Packages already installed in snapshot")
+                stage.skip()
+            elif pool_packages is not None and not packages:
+                log.info("Packages already installed in pooled chroot")
+                stage.skip()
+            elif not self.install_packages(workdir, packages):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.user_error("Failed to install OS packages")
+            else:
+                log.info("All packages installed")
         yield result
 
-        if not self.run_actions(self.interpreter_action_names, workdir, '/'):
-            kill_and_remove_dir(directory)
-            self.system_error("Interpreter actions failed")
-        log.info("All interpreter actions executed")
-        result.progress = 40
+        with self.build_stage('interpreter_actions', result) as stage:
+            if from_snapshot or pool_packages is not None:
+                log.info("Interpreter actions already executed")
+                stage.skip()
+            elif not self.run_actions(self.interpreter_action_names,
+                                      workdir, '/'):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("Interpreter actions failed")
+            else:
+                log.info("All interpreter actions executed")
+                if snapshot:
+                    self.save_snapshot(directory, workdir, snapshot)
         yield result
 
         # TODO if building fails up to this point, then we can try retry it
         # on another builder (for a limited number of times)
 
-        if system_filename:
-            if not self.update(workdir, chroot_homedir):
-                kill_and_remove_dir(directory)
-                self.user_error("Updating repository failed")
-        else:
-            if not self.clone(workdir, chroot_homedir):
-                kill_and_remove_dir(directory)
-                self.user_error("Cloning repository failed")
-        log.info("Application repository ready")
-        result.progress = 45
+        with self.build_stage('repository', result):
+            if system_filename:
+                if not self.update(workdir, chroot_homedir):
+                    kill_and_remove_dir(directory, trash=self.trash)
+                    self.user_error("Updating repository failed")
+            else:
+                if not self.clone(workdir, chroot_homedir):
+                    kill_and_remove_dir(directory, trash=self.trash)
+                    self.user_error("Cloning repository failed")
+            log.info("Application repository ready")
+        yield result
+
+        with self.build_stage('vcs_info', result):
+            result.vcs_revision = self.vcs_info(workdir, chroot_homedir)
         yield result
 
-        result.vcs_revision = self.vcs_info(workdir, chroot_homedir)
-        result.progress = 46
+        fingerprint = self.build_fingerprint(result.vcs_revision.get('id'))
+        result.fingerprint = fingerprint
+        if system_filename and self.is_unchanged(
+                workdir, system_filename, result.vcs_revision.get('id'),
+                fingerprint):
+            log.info("Nothing changed since package %s was built, reusing "
+                     "it" % system_filename)
+            result.cgroup = self.cgroup_stats()
+            kill_and_remove_dir(directory, trash=self.trash)
+            result.reused = True
+            result.filename = system_filename
+            result.checksum = system_filename
+            result.bytes = self.storage.size(system_filename)
+            result.progress = 100
+            stage_stats.update(self.finished_stages)
+            self.emit_finished(result)
+            yield result
+            return
+
+        with self.build_stage('write_files', result):
+            if not self.write_files(workdir, chroot_homedir):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.user_error("Creating files from metadata failed")
+            log.info("Created all files from metadata")
         yield result
 
-        if not self.write_files(workdir, chroot_homedir):
-            kill_and_remove_dir(directory)
-            self.user_error("Creating files from metadata failed")
-        log.info("Created all files from metadata")
-        result.progress = 49
+        with self.build_stage('restore_cache', result):
+            self.restore_dependency_caches(workdir, chroot_homedir)
         yield result
 
-        if not self.run_actions(self.app_action_names, workdir,
-                                chroot_homedir):
-            self.user_error("Application actions failed")
-            kill_and_remove_dir(directory)
-        log.info("All application actions executed")
-        result.progress = 85
+        with self.build_stage('app_actions', result):
+            if not self.run_actions(self.app_action_names, workdir,
+                                    chroot_homedir):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.user_error("Application actions failed")
+            log.info("All application actions executed")
         yield result
 
-        if not self.run_actions(self.finalize_action_names, workdir, '/'):
-            kill_and_remove_dir(directory)
-            self.system_error("Finalize actions failed")
-        log.info("All final actions executed")
-        result.progress = 88
+        with self.build_stage('save_cache', result):
+            self.save_dependency_caches()
         yield result
 
-        if not self.chown_app_dir(workdir, chroot_homedir):
-            kill_and_remove_dir(directory)
-            self.system_error("Setting file ownership failed")
-        log.info("Owner of application directory updated")
-        result.progress = 89
+        with self.build_stage('finalize_actions', result):
+            if not self.run_actions(self.finalize_action_names, workdir, '/'):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("Finalize actions failed")
+            log.info("All final actions executed")
         yield result
 
-        if not self.umount_filesystems(workdir):
-            kill_and_remove_dir(directory)
-            self.system_error("Failed to unmount filesystems")
-        result.progress = 90
+        with self.build_stage('chown', result):
+            if not self.chown_app_dir(workdir, chroot_homedir):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("Setting file ownership failed")
+            log.info("Owner of application directory updated")
+        yield result
+
+        with self.build_stage('umount', result):
+            if not self.umount_filesystems(workdir):
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("Failed to unmount filesystems")
         yield result
 
         package_path = os.path.join(directory, "package")
-        if not tar.pack_tar(workdir, package_path):
-            kill_and_remove_dir(directory)
-            self.system_error("Creating package file failed")
-        result.bytes = os.path.getsize(package_path)
-        log.info("Application package created, "
-                 "%s" % utils.bytes_to_human(result.bytes))
-        result.progress = 93
+        with self.build_stage('pack', result) as stage:
+            self.save_fingerprint(workdir, fingerprint)
+            usage = commands.CommandUsage('tar')
+            # final archive size is unknown, so progress isn't interpolated
+            meter = TransferMeter(self.events, 'pack',
+                                  progress=(result.progress,
+                                            result.progress))
+            packed = tar.pack_tar(workdir, package_path, usage=usage,
+                                  callback=meter)
+            self.account_usage(usage)
+            if not packed:
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("Creating package file failed")
+            meter.finish()
+            result.bytes = stage.bytes = os.path.getsize(package_path)
+            log.info("Application package created, "
+                     "%s" % utils.bytes_to_human(result.bytes))
         yield result
 
-        checksum = calculate_file_sha256(package_path)
-        log.info("Package checksum: %s" % checksum)
-        result.progress = 96
+        with self.build_stage('checksum', result) as stage:
+            meter = TransferMeter(self.events, 'checksum', total=result.bytes,
+                                  progress=(result.progress, self.progress.get(
+                                      'checksum', result.progress)))
+            checksum = calculate_file_sha256(package_path, callback=meter)
+            meter.finish()
+            stage.bytes = result.bytes
+            log.info("Package checksum: %s" % checksum)
         yield result
 
+        with self.build_stage('upload', result) as stage:
+            meter = TransferMeter(self.events, 'upload', total=result.bytes,
+                                  progress=(result.progress, self.progress.get(
+                                      'upload', result.progress)))
+            try:
+                self.storage.put(package_path, checksum, callback=meter)
+            except StorageError as e:
+                kill_and_remove_dir(directory, trash=self.trash)
+                self.system_error("Package upload failed: %s" % e)
+            meter.finish()
+            stage.bytes = result.bytes
+            result.cgroup = self.cgroup_stats()
+            kill_and_remove_dir(directory, trash=self.trash)
+            result.filename = checksum
+            result.checksum = checksum
+
+        stage_stats.update(self.finished_stages)
+        self.emit_finished(result)
+        yield result
+
+    def build_cgroup(self, directory):
+        """
+        Create cgroup for all processes started by this build and register it
+        for build directory, so that all processes are killed when directory
+        is removed. Returns None if cgroups are disabled or not supported.
+        """
+        if not utils.get_config_option(self.config, 'cgroup.enabled',
+                                       default=False):
+            return None
+        root = utils.get_config_option(self.config, 'cgroup.root',
+                                       default=cgroup.CGROUP_ROOT)
+        if not cgroup.cgroup_available(root):
+            log.warning("cgroup v2 is not mounted at '%s', build processes "
+                        "will not be tracked" % root)
+            return None
+        group = cgroup.CGroup(os.path.basename(directory), root=root,
+                              parent=utils.get_config_option(
+                                  self.config, 'cgroup.parent',
+                                  default='upaas'))
+        memory = utils.get_config_option(self.config, 'cgroup.memory')
         try:
-            self.storage.put(package_path, checksum)
-        except StorageError as e:
-            kill_and_remove_dir(directory)
-            self.system_error("Package upload failed: %s" % e)
+            group.create()
+            group.set_limits(
+                cpu=utils.get_config_option(self.config, 'cgroup.cpu'),
+                memory=memory * 1024 * 1024 if memory else None,
+                io=utils.get_config_option(self.config, 'cgroup.io'))
+        except cgroup.CGroupError as e:
+            log.warning("Can't create build cgroup: %s" % e)
+            group.remove()
+            return None
+        cgroup.register(directory, group)
+        return group
+
+    def cgroup_stats(self):
+        """
+        Return resources used by all processes running in build cgroup.
+        """
+        if self.cgroup is None:
+            return {}
+        return self.cgroup.stats()
 
-        kill_and_remove_dir(directory)
+    def build_fingerprint(self, revision):
+        """
+        Return fingerprint of everything used to build package from given VCS
+        revision: metadata, env variables, actions, packages and builder
+        settings.
+        """
+        # fresh package flag is not an input, package built on top of it
+        # should have the same fingerprint
+        env = dict([(k, v) for (k, v) in self.envs.items()
+                    if k != 'UPAAS_FRESH_PACKAGE'])
+        inputs = {
+            'revision': revision,
+            'metadata': self.metadata.content,
+            'interpreter': [self.metadata.interpreter.type,
+                            self.interpreter_version],
+            'distro': [distro.distro_name(), distro.distro_version(),
+                       distro.distro_arch()],
+            'packages': sorted(self.os_packages),
+            'actions': self.actions,
+            'env': env,
+            'install': [self.config.commands.install.cmd,
+                        utils.get_config_option(
+                            self.config, 'commands.install.batch_cmd'),
+                        self.config.commands.install.env],
+        }
+        return calculate_string_sha256(json.dumps(
+            inputs, sort_keys=True, default=str).encode('utf-8'))
+
+    def save_fingerprint(self, workdir, fingerprint):
+        """
+        Store build fingerprint in the package root directory, so that next
+        build can compare it without any extra files in storage. Existing
+        file is removed first, it might be a symlink created by application.
+        """
+        path = os.path.join(workdir, self.fingerprint_file)
+        try:
+            if os.path.lexists(path):
+                os.remove(path)
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            with os.fdopen(fd, 'w') as out:
+                out.write(fingerprint)
+        except (IOError, OSError) as e:
+            log.warning("Can't save build fingerprint: %s" % e)
+
+    def is_unchanged(self, workdir, filename, revision, fingerprint):
+        """
+        Check if package stored as given filename (unpacked in workdir) was
+        built from the same VCS revision and with the same build fingerprint.
+        """
+        if not revision or not self.current_revision or \
+                self.current_revision.strip() != revision.strip():
+            return False
+        path = os.path.join(workdir, self.fingerprint_file)
+        if os.path.islink(path) or not os.path.isfile(path):
+            log.info("No build fingerprint in package %s" % filename)
+            return False
+        try:
+            with open(path) as parent:
+                parent_fingerprint = parent.read().strip()
+        except IOError as e:
+            log.warning("Can't read build fingerprint of package %s: %s" % (
+                filename, e))
+            return False
+        if parent_fingerprint != fingerprint:
+            log.info("Build fingerprint changed since package %s was "
+                     "built" % filename)
+            return False
+        return True
 
-        result.progress = 100
-        result.filename = checksum
-        result.checksum = checksum
-        yield result
+    def snapshot_filename(self):
+        """
+        Return storage filename for the snapshot of a chroot with OS packages
+        installed and interpreter actions executed. Filename contains
+        fingerprint of everything used to prepare such chroot, so it can be
+        reused by every fresh package build with the same fingerprint.
+        """
+        image = distro.distro_image_filename()
+        try:
+            image_mtime = self.storage.mtime(image)
+        except StorageError:
+            image_mtime = None
+        names = self.builder_action_names + self.interpreter_action_names
+        inputs = {
+            'image': [image, '%s' % image_mtime],
+            'interpreter': [self.metadata.interpreter.type,
+                            self.interpreter_version],
+            'packages': sorted(self.os_packages),
+            'actions': dict([(n, self.actions.get(n, [])) for n in names]),
+            'env': self.envs,
+            'install': [self.config.commands.install.cmd,
+                        utils.get_config_option(
+                            self.config, 'commands.install.batch_cmd'),
+                        self.config.commands.install.env],
+        }
+        fingerprint = calculate_string_sha256(json.dumps(
+            inputs, sort_keys=True).encode('utf-8'))
+        log.info("Snapshot fingerprint: %s" % fingerprint)
+        return 'snapshot-%s.tar.gz' % fingerprint
+
+    def unpack_snapshot(self, directory, workdir, snapshot):
+        """
+        Unpack snapshot into empty workdir, returns False if it failed and
+        OS image should be used instead.
+        """
+        log.info("Using snapshot '%s'" % snapshot)
+        if self.unpack_os(directory, workdir, system_filename=snapshot):
+            return True
+        log.warning("Unpacking snapshot failed, using OS image")
+        self.umount_overlay(workdir)
+        shutil.rmtree(workdir)
+        os.mkdir(workdir, 0o755)
+        return False
+
+    def save_snapshot(self, directory, workdir, snapshot):
+        """
+        Pack workdir as snapshot and upload it to storage. Content of mounted
+        filesystems is not included.
+        """
+        if self.storage.exists(snapshot):
+            return
+        log.info("Saving snapshot '%s'" % snapshot)
+        snapshot_path = os.path.join(directory, "snapshot")
+        usage = commands.CommandUsage('tar')
+        packed = tar.pack_tar(workdir, snapshot_path,
+                              timeout=self.config.bootstrap.timelimit,
+                              usage=usage, one_file_system=True)
+        self.account_usage(usage)
+        if not packed:
+            log.warning("Failed to create snapshot")
+            return
+        try:
+            self.storage.put(snapshot_path, snapshot)
+        except StorageError as e:
+            log.warning("Snapshot upload failed: %s" % e)
+        else:
+            log.info("Snapshot uploaded")
+            self.update_snapshot_index(directory, snapshot)
+        os.remove(snapshot_path)
+
+    def read_snapshot_index(self, path):
+        """
+        Fetch index of uploaded snapshots from storage into given path,
+        returns dictionary with snapshot filenames as keys.
+        """
+        try:
+            if not self.storage.exists(self.snapshot_index):
+                return {}
+            self.storage.get(self.snapshot_index, path)
+            with open(path) as index:
+                return json.load(index)
+        except (StorageError, IOError, ValueError) as e:
+            log.warning("Can't read snapshot index: %s" % e)
+            return {}
+
+    def update_snapshot_index(self, directory, snapshot):
+        """
+        Add snapshot to the index of uploaded snapshots and delete stale
+        snapshots from storage. Snapshot is stale if it was made from older
+        OS image (OS image is part of the fingerprint, so it will never be
+        used again) or if it's older than snapshots.maxage days
+        (bootstrap.maxage by default). Index is replaced with last writer
+        wins, so it's read back and update is retried if other builder
+        overwrote it.
+        """
+        maxage = utils.get_config_option(
+            self.config, 'snapshots.maxage',
+            default=self.config.bootstrap.maxage) * 86400
+        try:
+            image_mtime = '%s' % self.storage.mtime(
+                distro.distro_image_filename())
+        except StorageError:
+            image_mtime = None
+        path = os.path.join(directory, "snapshots.index")
+        stale = set()
+        for _ in range(3):
+            index = self.read_snapshot_index(path)
+            index[snapshot] = {'image': image_mtime, 'created': time.time()}
+            for (name, entry) in list(index.items()):
+                if name != snapshot and (
+                        (image_mtime and entry.get('image') != image_mtime) or
+                        time.time() - entry.get('created', 0) > maxage):
+                    stale.add(name)
+                    del index[name]
+            with open(path, 'w') as out:
+                json.dump(index, out)
+            try:
+                self.storage.replace(path, self.snapshot_index)
+            except StorageError as e:
+                log.warning("Can't update snapshot index: %s" % e)
+                break
+            if snapshot in self.read_snapshot_index(path):
+                break
+        if os.path.exists(path):
+            os.remove(path)
+        for name in sorted(stale):
+            log.info("Deleting stale snapshot '%s'" % name)
+            try:
+                self.storage.delete(name)
+            except StorageError as e:
+                log.warning("Can't delete snapshot '%s': %s" % (name, e))
 
     def unpack_os(self, directory, workdir, system_filename=None):
         empty_os_image = False
@@ -435,71 +1088,631 @@ class Builder(object):
             empty_os_image = True
 
         os_image_path = os.path.join(directory, "os.image")
-        log.info("Fetching OS image '%s'" % system_filename)
-        try:
-            self.storage.get(system_filename, os_image_path)
-        except StorageError:
-            log.error("Storage error while fetching OS image")
-            return False
-        else:
+        unpacked = False
+        if self.base_cache():
+            if utils.get_config_option(self.config, 'base_cache.overlay',
+                                       default=False):
+                unpacked = self.mount_overlay(directory, workdir,
+                                              system_filename)
+            if not unpacked and empty_os_image:
+                # parent packages are used once, caching them would only
+                # double the I/O and evict cached OS images
+                unpacked = self.copy_base(directory, workdir, system_filename)
+        if not unpacked:
+            log.info("Fetching OS image '%s'" % system_filename)
+            try:
+                self.storage.get(system_filename, os_image_path)
+            except StorageError:
+                log.error("Storage error while fetching OS image")
+                return False
             log.info("Unpacking OS image")
-            if not tar.unpack_tar(os_image_path, workdir):
+            usage = commands.CommandUsage('tar')
+            unpacked = tar.unpack_tar(os_image_path, workdir, usage=usage)
+            self.account_usage(usage)
+            if not unpacked:
                 log.error("Error while unpacking OS image to '%s'" % workdir)
                 return False
         # verify if os is working
         log.info("Checking if OS image is working (will execute /bin/true)")
         try:
             with Chroot(workdir):
-                commands.execute('/bin/true',
-                                 timeout=self.config.commands.timelimit,
-                                 output_loglevel=logging.INFO)
+                self.execute('/bin/true',
+                             timeout=self.config.commands.timelimit,
+                             output_loglevel=logging.INFO)
         except Exception as e:
             log.error("Broken OS image! /bin/true failed: %s" % e)
             if empty_os_image:
                 try:
-                    self.storage.delete(system_filename)
-                except StorageError as e:
-                    log.error("Storage error while deleting OS image: %s" % e)
+                    self.ensure_os_image(
+                        broken=self.storage.mtime(system_filename))
+                except (exceptions.OSBootstrapError, StorageError) as e:
+                    log.error("Can't replace broken OS image: %s" % e)
                 else:
-                    log.info("Deleted broken OS image from storage")
-                    self.bootstrap_os()
+                    self.umount_overlay(workdir)
                     return self.unpack_os(directory, workdir,
                                           system_filename=system_filename)
             return False
         else:
             return True
 
+    def make_build_directory(self, system_filename=None):
+        """
+        Create build directory, it's mounted as tmpfs if build is expected to
+        fit in memory.
+        """
+        directory = tempfile.mkdtemp(dir=self.config.paths.workdir,
+                                     prefix="upaas_package_")
+        size = self.select_tmpfs_size(system_filename)
+        if size:
+            try:
+                utils.mount_tmpfs(directory, size,
+                                  timeout=self.config.commands.timelimit)
+            except commands.CommandError as e:
+                log.warning("Can't mount tmpfs, using disk: %s" % e)
+            else:
+                self.tmpfs = directory
+                self.tmpfs_size = size
+                self.tmpfs_monitor = TmpfsMonitor(
+                    directory, self.tmpfs_memory_limit(),
+                    threshold=utils.get_config_option(
+                        self.config, 'tmpfs.threshold', default=0.75),
+                    interval=utils.get_config_option(
+                        self.config, 'tmpfs.interval', default=1),
+                    timeout=self.config.commands.timelimit)
+                self.tmpfs_monitor.start()
+        return directory
+
+    def tmpfs_memory_limit(self):
+        """
+        Maximum size of build tmpfs in bytes, tmpfs.max_memory fraction of
+        total memory (25% by default).
+        """
+        return int(utils.backend_total_memory() * utils.get_config_option(
+            self.config, 'tmpfs.max_memory', default=0.25))
+
+    def select_tmpfs_size(self, system_filename=None):
+        """
+        Return size (in bytes) of tmpfs for build directory or None if build
+        should be done on disk. tmpfs is used if it's enabled in config
+        (tmpfs.enabled) and expected build size fits in memory. Expected size
+        is the size of parent package (or OS image for fresh packages)
+        multiplied by tmpfs.expansion (4 by default).
+        """
+        if not self.use_tmpfs or not utils.get_config_option(
+                self.config, 'tmpfs.enabled', default=False):
+            return None
+        if utils.get_config_option(self.config, 'pool.dir'):
+            # pooled chroots can't be moved into tmpfs
+            return None
+        try:
+            packed = self.storage.size(system_filename or
+                                       distro.distro_image_filename())
+        except StorageError as e:
+            log.warning("Can't estimate build size: %s" % e)
+            return None
+        size = int(packed * utils.get_config_option(
+            self.config, 'tmpfs.expansion', default=4))
+        available = utils.backend_available_memory()
+        if size > self.tmpfs_memory_limit() or (available is not None and
+                                                size > available):
+            log.info("Expected build size (%s) doesn't fit in memory, using "
+                     "disk" % utils.bytes_to_human(size))
+            return None
+        return size
+
+    def check_tmpfs(self):
+        """
+        Check free space on build tmpfs, called after every build stage (it's
+        also checked by TmpfsMonitor while build commands are running). If
+        tmpfs is more than tmpfs.threshold full (0.75 by default) it's grown
+        twice, if there is not enough memory for that, build directory is
+        moved to disk.
+        """
+        if not self.tmpfs_monitor.check():
+            self.release_tmpfs()
+            return
+        if self.tmpfs_monitor.exhausted:
+            self.spill_tmpfs()
+        else:
+            self.tmpfs_size = utils.filesystem_usage(self.tmpfs)[0]
+
+    def spill_tmpfs(self):
+        """
+        Move build directory from tmpfs to disk, directory path doesn't
+        change. Not possible if there are filesystems mounted inside build
+        directory, build stays on tmpfs and if it fails later, it's retried
+        on disk. Returns False if build directory is still on tmpfs.
+        """
+        directory = self.tmpfs
+        if utils.mounted_filesystems(directory):
+            log.warning("Build directory has mounted filesystems, can't move "
+                        "it from tmpfs to disk")
+            return False
+        log.info("Build doesn't fit in memory, moving it to disk")
+        self.tmpfs_monitor.stop()
+        spill = tempfile.mkdtemp(dir=self.config.paths.workdir,
+                                 prefix="upaas_spill_")
+        try:
+            self.execute("cp -a %s/. %s" % (directory, spill),
+                         timeout=self.config.commands.timelimit)
+            utils.umount(directory, timeout=self.config.commands.timelimit)
+        except commands.CommandError as e:
+            log.error("Moving build directory to disk failed: %s" % e)
+            shutil.rmtree(spill)
+            self.tmpfs_monitor.start()
+            return False
+        for name in os.listdir(spill):
+            os.rename(os.path.join(spill, name), os.path.join(directory,
+                                                              name))
+        os.rmdir(spill)
+        self.tmpfs_monitor = None
+        self.tmpfs = None
+        self.tmpfs_size = None
+        return True
+
+    def release_tmpfs(self):
+        """
+        Stop watching build tmpfs and remove build directory if it's still
+        mounted, called once build is finished, failed or aborted.
+        """
+        if self.tmpfs_monitor is not None:
+            self.tmpfs_monitor.stop()
+            self.tmpfs_monitor = None
+        if self.tmpfs and os.path.ismount(self.tmpfs):
+            kill_and_remove_dir(self.tmpfs, trash=self.trash)
+        self.tmpfs = None
+        self.tmpfs_size = None
+
+    def claim_pooled_workdir(self, workdir):
+        """
+        Move ready chroot from warm pool into empty workdir. Returns set of
+        OS packages installed in claimed chroot or None if there was no
+        chroot available. Filesystems mounted by system actions are not
+        preserved in pooled chroots, so system actions are always executed.
+        """
+        pool = warm_pool(self.config)
+        if not pool:
+            return None
+        try:
+            builder = PoolBuilder(self.config, self.metadata.interpreter.type,
+                                  self.interpreter_version)
+            if pool.claim(builder.pool_key(), workdir):
+                return set(builder.os_packages)
+        except (OSError, StorageError) as e:
+            log.warning("Can't use warm pool: %s" % e)
+        return None
+
+    def base_cache(self):
+        """
+        Return cache of unpacked OS images if it's enabled in builder config
+        (base_cache.dir, optional base_cache.max_size in MB). Parent packages
+        are cached only if they are used as overlay lower layer
+        (base_cache.overlay). Cached content is removed once it's older than
+        bootstrap.maxage.
+        """
+        cache_dir = utils.get_config_option(self.config, 'base_cache.dir')
+        if cache_dir:
+            max_size = utils.get_config_option(self.config,
+                                               'base_cache.max_size')
+            return TreeCache(cache_dir,
+                             max_size=max_size and max_size * 1024 * 1024,
+                             max_age=self.config.bootstrap.maxage * 86400)
+
+    def cached_base(self, directory, filename):
+        """
+        Return (cache, entry name) tuple for unpacked content of given storage
+        file, file is fetched and unpacked into base cache if it's not cached
+        yet. Caller must hold shared cache lock.
+        """
+        cache = self.base_cache()
+        name = cache.entry_name(filename, self.storage.mtime(filename))
+        if cache.get(name):
+            log.info("Using cached content of '%s'" % filename)
+            return (cache, name)
+        archive_path = os.path.join(directory, "os.image")
+        log.info("Fetching '%s' into base cache" % filename)
+        self.storage.get(filename, archive_path)
+        usage = commands.CommandUsage('tar')
+        path = cache.add(name, archive_path, usage=usage)
+        self.account_usage(usage)
+        if path:
+            return (cache, name)
+        return (cache, None)
+
+    def copy_base(self, directory, workdir, filename):
+        """
+        Create workdir by copying cached content of given OS image. Returns
+        False if base cache can't be used.
+        """
+        cache = self.base_cache()
+        with cache.lock(shared=True):
+            try:
+                (cache, name) = self.cached_base(directory, filename)
+            except StorageError as e:
+                log.warning("Can't fetch '%s' into base cache: %s" % (
+                    filename, e))
+                return False
+            if not name:
+                return False
+            usage = commands.CommandUsage('cp')
+            copied = cache.copy(name, workdir,
+                                timeout=self.config.commands.timelimit,
+                                usage=usage)
+            self.account_usage(usage)
+        cache.cleanup()
+        return copied
+
+    def mount_overlay(self, directory, workdir, filename):
+        """
+        Mount overlay at workdir using cached content of given storage file
+        as read-only lower layer, all changes made during build are written
+        to upper layer inside build directory. Returns False if overlay can't
+        be used. Shared cache lock is held until overlay is mounted, mounted
+        entries are never removed by cache cleanup.
+        """
+        cache = self.base_cache()
+        upperdir = os.path.join(directory, "upper")
+        overlay_workdir = os.path.join(directory, "overlay")
+        for path in [upperdir, overlay_workdir]:
+            if not os.path.isdir(path):
+                os.mkdir(path, 0o755)
+        with cache.lock(shared=True):
+            try:
+                (cache, name) = self.cached_base(directory, filename)
+            except StorageError as e:
+                log.warning("Can't fetch '%s' into base cache: %s" % (
+                    filename, e))
+                return False
+            if not name:
+                return False
+            try:
+                utils.mount_overlay(cache.entry_path(name), upperdir,
+                                    overlay_workdir, workdir,
+                                    timeout=self.config.commands.timelimit,
+                                    registry=self.mounts)
+            except commands.CommandError as e:
+                log.warning("Can't mount overlay, unpacking archive instead: "
+                            "%s" % e)
+                return False
+        return True
+
+    def umount_overlay(self, workdir):
+        if os.path.ismount(workdir):
+            utils.umount_filesystems(workdir,
+                                     timeout=self.config.commands.timelimit,
+                                     registry=self.mounts)
+            utils.umount(workdir, timeout=self.config.commands.timelimit,
+                         registry=self.mounts)
+
+    def chroot_dir(self, workdir, path):
+        """
+        Return host path of a directory inside the chroot, directory is
+        created if missing. Returns None if path resolves outside of the
+        chroot, chroot content comes from application repository and parent
+        package, so any path component might be a symlink to host directory.
+        """
+        try:
+            target = utils.chroot_path(workdir, path)
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            # path might have been changed while directories were created
+            if utils.chroot_path(workdir, path) != target:
+                raise ValueError("'%s' changed while it was created" % path)
+        except (OSError, ValueError) as e:
+            log.warning("Can't use '%s' inside the chroot: %s" % (path, e))
+            return None
+        return target
+
+    @contextmanager
+    def mount_package_cache(self, workdir):
+        """
+        Bind mount shared package cache directory into the chroot for the
+        duration of package installation. Cache is enabled only if
+        package_cache.dir (cache directory on builder host) and
+        package_cache.path (package manager cache path inside chroot) are
+        set, optional package_cache.max_size sets cache size limit in MB.
+        Builds hold shared cache lock while cache is mounted, so many builds
+        can install packages at once (package manager serializes access to
+        its own cache files), cache is cleaned up once no build is using it.
+        """
+        cache_dir = utils.get_config_option(self.config, 'package_cache.dir')
+        cache_path = utils.get_config_option(self.config,
+                                             'package_cache.path')
+        if not cache_dir or not cache_path:
+            yield
+            return
+
+        max_size = utils.get_config_option(self.config,
+                                           'package_cache.max_size')
+        cache = CacheDirectory(cache_dir,
+                               max_size=max_size and max_size * 1024 * 1024)
+        target = self.chroot_dir(workdir, cache_path)
+        if not target:
+            yield
+            return
+        lock = cache.lock(shared=True)
+        lock.acquire()
+        mounted = False
+        try:
+            utils.bind_mount(cache.path, target,
+                             timeout=self.config.commands.timelimit,
+                             registry=self.mounts)
+        except commands.CommandError as e:
+            log.warning("Can't mount shared package cache: %s" % e)
+        else:
+            mounted = True
+
+        try:
+            yield
+        finally:
+            try:
+                if mounted:
+                    try:
+                        utils.umount(target,
+                                     timeout=self.config.commands.timelimit,
+                                     registry=self.mounts)
+                    except commands.CommandError as e:
+                        log.error("Can't unmount shared package cache: "
+                                  "%s" % e)
+            finally:
+                lock.release()
+            cache.cleanup()
+
     def install_packages(self, workdir, packages):
-        with Chroot(workdir):
-            for name in packages:
-                cmd = self.config.commands.install.cmd.replace("%package%",
-                                                               name)
-                try:
-                    commands.execute(cmd,
+        """
+        Install all given OS packages. If batch install command is configured
+        (either as commands.install.batch_cmd or by using %packages%
+        placeholder in commands.install.cmd) all packages are installed with
+        single command, packages are installed one by one only if it fails,
+        so we know which package is broken.
+        """
+        packages = sorted(packages)
+        if not packages:
+            return True
+        cmd = self.config.commands.install.cmd
+        batch_cmd = utils.get_config_option(self.config,
+                                            'commands.install.batch_cmd')
+        if not batch_cmd and '%packages%' in cmd:
+            batch_cmd = cmd
+        with self.mount_package_cache(workdir):
+            with Chroot(workdir):
+                if batch_cmd:
+                    log.info("Installing %d package(s): %s" % (
+                        len(packages), ', '.join(packages)))
+                    try:
+                        self.execute(batch_cmd.replace("%packages%",
+                                                       " ".join(packages)),
                                      timeout=self.config.commands.timelimit,
                                      env=self.config.commands.install.env,
                                      output_loglevel=logging.INFO,
                                      strip_envs=True)
-                except commands.CommandTimeout:
-                    log.error("Installing package '%s' is taking to long, "
-                              "aborting" % name)
-                    return False
-                except commands.CommandFailed:
-                    log.error("Installing package '%s' failed" % name)
-                    return False
+                    except commands.CommandTimeout:
+                        log.error("Installing packages is taking to long, "
+                                  "aborting")
+                        return False
+                    except commands.CommandFailed:
+                        log.warning("Installing packages failed, retrying "
+                                    "one by one")
+                    else:
+                        return True
+                for name in packages:
+                    package_cmd = cmd.replace("%package%", name).replace(
+                        "%packages%", name)
+                    try:
+                        self.execute(package_cmd,
+                                     timeout=self.config.commands.timelimit,
+                                     env=self.config.commands.install.env,
+                                     output_loglevel=logging.INFO,
+                                     strip_envs=True)
+                    except commands.CommandTimeout:
+                        log.error("Installing package '%s' is taking to "
+                                  "long, aborting" % name)
+                        return False
+                    except commands.CommandFailed:
+                        log.error("Installing package '%s' failed" % name)
+                        return False
+        return True
+
+    def mirror_cache(self):
+        """
+        Return local cache of repository mirrors if it's enabled in builder
+        config (mirror_cache.dir, optional mirror_cache.max_size in MB).
+        """
+        cache_dir = utils.get_config_option(self.config, 'mirror_cache.dir')
+        if cache_dir:
+            max_size = utils.get_config_option(self.config,
+                                               'mirror_cache.max_size')
+            return CacheDirectory(
+                cache_dir, max_size=max_size and max_size * 1024 * 1024)
+
+    def mirror_mount_path(self):
+        return utils.get_config_option(self.config, 'mirror_cache.path',
+                                       default='/var/cache/upaas/mirror')
+
+    def mirror_placeholders(self, cmd, mirror):
+        """
+        Replace mirror placeholders in repository command. %reference% is
+        replaced with mirror path (it doesn't exist if mirror is not
+        available, so git should use --reference-if-able, together with
+        --dissociate since mirror is not included in the package), %mirror%
+        with mirror path or repository url if mirror is not available.
+        """
+        url = self.metadata.repository.get('url') or ''
+        reference = mirror or os.path.join(self.mirror_mount_path(), 'repo')
+        return cmd.replace("%reference%", reference).replace(
+            "%mirror%", mirror or url)
+
+    def mirror_allowed(self, url):
+        """
+        Check if repository url uses one of mirror_cache.protocols (remote
+        protocols by default), mirror is updated on the builder host, so it
+        must never point to a local path. Urls with whitespace, shell
+        metacharacters or leading '-' are never mirrored.
+        """
+        if not self.mirror_url_re.match(url):
+            return False
+        protocols = utils.get_config_option(
+            self.config, 'mirror_cache.protocols',
+            default=self.mirror_protocols)
+        match = re.match(r'^([a-z0-9+.-]+)://', url, re.IGNORECASE)
+        if match:
+            return match.group(1).lower() in protocols
+        # scp-like syntax, user@host:path
+        return 'ssh' in protocols and bool(
+            re.match(r'^[\w.-]+@[\w.-]+:', url))
+
+    def mirror_env(self):
+        """
+        Env variables for mirror commands executed on the builder host,
+        repository env from metadata is not used there. Extra variables can
+        be set with mirror_cache.env.
+        """
+        protocols = utils.get_config_option(
+            self.config, 'mirror_cache.protocols',
+            default=self.mirror_protocols)
+        env = {'GIT_TERMINAL_PROMPT': '0',
+               'GIT_ALLOW_PROTOCOL': ':'.join(protocols)}
+        env.update(utils.get_config_option(self.config, 'mirror_cache.env',
+                                           default={}))
+        return env
+
+    def check_repository_access(self, workdir, url):
+        """
+        Check that application can access repository using its own
+        credentials, mirror is shared by all applications using the same url
+        and it's updated with builder host credentials.
+        """
+        cmd = self.mirror_access_commands[self.metadata.repository.vcs]
+        try:
+            with Chroot(workdir):
+                self.execute(cmd.replace('%url%', quote(url)),
+                             timeout=self.config.commands.timelimit,
+                             env=self.metadata.repository.env,
+                             output_loglevel=logging.INFO, strip_envs=True)
+        except commands.CommandError as e:
+            log.warning("Can't access repository, not using mirror: %s" % e)
+            return False
+        return True
+
+    @contextmanager
+    def repository_mirror(self, workdir, cmds):
+        """
+        Bind mount up to date local mirror of application repository into the
+        chroot (read-only), yields mirror path inside chroot or None if mirror
+        can't be used. Mirror is used only if mirror cache is enabled,
+        repository url is set in metadata, repository commands use %mirror%
+        or %reference% placeholders and application can access repository
+        itself. Mirror is updated on the builder host, if update fails mirror
+        is not used. Mirror is mounted at mirror_cache.path.
+        """
+        url = self.metadata.repository.get('url')
+        vcs = self.metadata.repository.vcs
+        cache = self.mirror_cache()
+        if not cache or not url or not [c for c in cmds if '%mirror%' in c or
+                                        '%reference%' in c]:
+            yield None
+            return
+        if vcs not in self.mirror_commands:
+            log.warning("Repository mirror is not supported for %s" % vcs)
+            yield None
+            return
+        if not self.mirror_allowed(url):
+            log.warning("Repository url '%s' can't be mirrored" % url)
+            yield None
+            return
+
+        path = self.mirror_mount_path()
+        target = self.chroot_dir(workdir, path)
+        if not target or not self.check_repository_access(workdir, url):
+            yield None
+            return
+
+        name = calculate_string_sha256(('%s:%s' % (vcs, url)).encode('utf-8'))
+        mirror = None
+        mounted = False
+        lock = cache.lock(shared=True)
+        lock.acquire()
+        try:
+            if not os.path.isdir(cache.entry_path(name)):
+                os.mkdir(cache.entry_path(name))
+            # only one build can update given mirror at a time
+            with FileLock(os.path.join(cache.entry_path(name), 'lock')):
+                updated = self.update_mirror(url, os.path.join(
+                    cache.entry_path(name), 'repo'))
+            if updated:
+                utils.bind_mount(cache.entry_path(name), target,
+                                 timeout=self.config.commands.timelimit,
+                                 registry=self.mounts, readonly=True)
+                mounted = True
+                mirror = os.path.join(path, 'repo')
+                cache.touch(name)
+        except (OSError, commands.CommandError) as e:
+            log.warning("Can't use repository mirror: %s" % e)
+
+        try:
+            yield mirror
+        finally:
+            if mounted:
+                try:
+                    utils.umount(target,
+                                 timeout=self.config.commands.timelimit,
+                                 registry=self.mounts)
+                except commands.CommandError as e:
+                    log.error("Can't unmount repository mirror: %s" % e)
+            lock.release()
+            cache.cleanup()
+
+    def update_mirror(self, url, host_path):
+        """
+        Create or update repository mirror on the builder host, returns False
+        if it failed, stale mirror is never used.
+
+        :param host_path: Mirror path on the builder host.
+        """
+        (create_cmd, update_cmd) = self.mirror_commands[
+            self.metadata.repository.vcs]
+        exists = os.path.isdir(host_path)
+        if exists:
+            log.info("Updating repository mirror of %s" % url)
+            cmd = update_cmd
+        else:
+            log.info("Creating repository mirror of %s" % url)
+            cmd = create_cmd
+        try:
+            self.execute(cmd.replace('%url%', quote(url)).replace(
+                '%mirror%', quote(host_path)),
+                         timeout=self.config.commands.timelimit,
+                         env=self.mirror_env(), output_loglevel=logging.INFO,
+                         strip_envs=True)
+        except commands.CommandError as e:
+            log.warning("Updating repository mirror failed, not using it: "
+                        "%s" % e)
+            if not exists and os.path.isdir(host_path):
+                shutil.rmtree(host_path)
+            return False
         return True
 
     def clone(self, workdir, homedir):
         log.info("Updating repository to '%s'" % homedir)
-        with Chroot(workdir):
-            for cmd in self.metadata.repository.clone:
+        with self.repository_mirror(
+                workdir, self.metadata.repository.clone) as mirror:
+            return self.run_repository_commands(
+                workdir, '/', self.metadata.repository.clone, homedir, mirror)
+
+    def run_repository_commands(self, workdir, cwd, cmds, homedir, mirror):
+        """
+        Execute repository clone or update commands inside the chroot.
+        """
+        with Chroot(workdir, workdir=cwd):
+            for cmd in cmds:
                 cmd = cmd.replace("%destination%", homedir)
+                cmd = self.mirror_placeholders(cmd, mirror)
                 try:
-                    commands.execute(cmd,
-                                     timeout=self.config.commands.timelimit,
-                                     env=self.metadata.repository.env,
-                                     output_loglevel=logging.INFO,
-                                     strip_envs=True)
+                    self.execute(cmd,
+                                 timeout=self.config.commands.timelimit,
+                                 env=self.metadata.repository.env,
+                                 output_loglevel=logging.INFO,
+                                 strip_envs=True)
                 except commands.CommandTimeout:
                     log.error("Command is taking too long, aborting")
                     return False
@@ -508,11 +1721,26 @@ class Builder(object):
                     return False
         return True
 
+    def vcs_info_overridden(self):
+        """
+        Check if metadata sets custom command for any revision field, all
+        fields are extracted with single command only if none is set (unless
+        repository.revision.info command is also set).
+        """
+        try:
+            revision = self.metadata.content['repository']['revision'] or {}
+        except (KeyError, TypeError):
+            return False
+        if revision.get('info'):
+            return False
+        return any([revision.get(name) for name in VCSInfoEntry.fields])
+
     def vcs_info(self, workdir, homedir):
         ret = {}
         log.info("Extracting information about last commit")
+        revision = self.metadata.repository.revision
         with Chroot(workdir, workdir=homedir):
-            def vcs_cmd(name, cmd, replace=None):
+            def vcs_cmd(name, cmd, replace=None, output_limit=None):
                 name = 'repository.revision.%s' % name
                 if hasattr(cmd, '__call__'):
                     cmd = cmd()
@@ -523,36 +1751,47 @@ class Builder(object):
                 env['LANG'] = 'C.UTF-8'
                 env['LC_ALL'] = 'C.UTF-8'
                 try:
-                    _, output = commands.execute(
+                    _, output = self.execute(
                         cmd, timeout=self.config.commands.timelimit, env=env,
-                        output_loglevel=logging.INFO, strip_envs=True)
+                        output_loglevel=logging.INFO, strip_envs=True,
+                        output_limit=output_limit)
                 except commands.CommandTimeout:
                     log.error("%s command is taking too long, aborting" % name)
                 except commands.CommandFailed:
                     log.error("%s command failed" % name)
                 else:
-                    return ''.encode('utf-8').join(output).rstrip(
-                        '\n'.encode('utf-8'))
-
-            ret = {
-                'id': vcs_cmd('id', self.metadata.repository.revision.id),
-                'author': vcs_cmd('author',
-                                  self.metadata.repository.revision.author),
-                'date': vcs_cmd('date',
-                                self.metadata.repository.revision.date),
-                'description': vcs_cmd(
-                    'description',
-                    self.metadata.repository.revision.description),
-            }
-
-            if self.current_revision and self.current_revision != ret['id']:
+                    return ''.join(output).rstrip('\n')
+
+            if not self.vcs_info_overridden():
+                info = vcs_cmd('info', revision.info)
+                fields = (info or '').split(VCSInfoEntry.separator)
+                if len(fields) == len(VCSInfoEntry.fields):
+                    for (name, value) in zip(VCSInfoEntry.fields, fields):
+                        ret[name] = value.strip('\n')
+                elif info is not None:
+                    log.warning("Unexpected output of revision info command, "
+                                "extracting fields one by one")
+
+            if not ret:
+                ret = {
+                    'id': vcs_cmd('id', revision.id),
+                    'author': vcs_cmd('author', revision.author),
+                    'date': vcs_cmd('date', revision.date),
+                    'description': vcs_cmd('description',
+                                           revision.description),
+                }
+
+            if self.current_revision and ret['id'] and \
+                    self.current_revision != ret['id']:
                 ret['changelog'] = vcs_cmd(
-                    'changelog',
-                    self.metadata.repository.revision.changelog,
+                    'changelog', revision.changelog,
                     replace=[
                         ('%old%', self.current_revision.rstrip('\n')),
                         ('%new%', ret['id'].rstrip('\n')),
-                    ])
+                    ],
+                    output_limit=utils.get_config_option(
+                        self.config, 'commands.changelog_limit',
+                        default=64 * 1024))
 
         if 'date' in ret:
             try:
@@ -563,32 +1802,175 @@ class Builder(object):
 
         return ret
 
+    def dependency_cache(self):
+        """
+        Return local dependency cache if it's enabled in builder config
+        (dependency_cache.dir, optional dependency_cache.max_size in MB).
+        """
+        cache_dir = utils.get_config_option(self.config,
+                                            'dependency_cache.dir')
+        if cache_dir:
+            max_size = utils.get_config_option(self.config,
+                                               'dependency_cache.max_size')
+            return CacheDirectory(
+                cache_dir, max_size=max_size and max_size * 1024 * 1024)
+
+    def app_identity(self):
+        """
+        Return string identifying application, repository url or clone
+        commands if url is not set in metadata.
+        """
+        return self.metadata.repository.get('url') or '\n'.join(
+            self.metadata.repository.clone)
+
+    def dependency_cache_key(self, workdir, homedir, path, key_files):
+        """
+        Return cache key for dependency directory, cached content is never
+        shared between applications.
+        """
+        parts = [self.app_identity(), self.metadata.interpreter.type,
+                 self.interpreter_version, path]
+        for name in key_files:
+            try:
+                key_path = utils.chroot_path(workdir,
+                                             os.path.join(homedir, name))
+                parts.append("%s:%s" % (name,
+                                        calculate_file_sha256(key_path)))
+            except (IOError, ValueError):
+                log.warning("Cache key file '%s' not found" % name)
+                parts.append("%s:missing" % name)
+        return calculate_string_sha256('\n'.join(parts).encode('utf-8'))
+
+    def restore_dependency_caches(self, workdir, homedir):
+        """
+        Unpack cached dependency directories into the chroot. Directories
+        resolving outside of the chroot are never cached.
+        """
+        cache = self.dependency_cache()
+        if not cache:
+            return
+        self.dependency_caches = []
+        with cache.lock(shared=True):
+            for (path, key_files) in self.parse_dependency_caches(
+                    self.metadata):
+                name = '%s.tar.gz' % self.dependency_cache_key(
+                    workdir, homedir, path, key_files)
+                chroot_path = os.path.join(homedir, path)
+                target = self.chroot_dir(workdir, chroot_path)
+                if not target:
+                    continue
+                self.dependency_caches.append((workdir, chroot_path, name))
+                if not os.path.isfile(cache.entry_path(name)):
+                    log.info("No cached content for '%s'" % path)
+                    continue
+                log.info("Restoring cached content of '%s'" % path)
+                usage = commands.CommandUsage('tar')
+                if tar.unpack_tar(cache.entry_path(name), target,
+                                  timeout=self.config.commands.timelimit,
+                                  usage=usage):
+                    cache.touch(name)
+                else:
+                    log.warning("Failed to restore cached content of "
+                                "'%s'" % path)
+                self.account_usage(usage)
+
+    def save_dependency_caches(self):
+        """
+        Store dependency directories in cache, only directories without
+        cached content for the same key are saved. Paths are resolved again
+        since app actions could have replaced them with symlinks.
+        """
+        cache = self.dependency_cache()
+        if not cache or not self.dependency_caches:
+            return
+        with cache.lock(shared=True):
+            for (workdir, chroot_path, name) in self.dependency_caches:
+                if os.path.isfile(cache.entry_path(name)):
+                    continue
+                try:
+                    target = utils.chroot_path(workdir, chroot_path)
+                except ValueError as e:
+                    log.warning("Not caching '%s': %s" % (chroot_path, e))
+                    continue
+                if not os.path.isdir(target) or not os.listdir(target):
+                    log.info("Nothing to cache in '%s'" % target)
+                    continue
+                log.info("Saving '%s' in dependency cache" % target)
+                tmp_path = cache.entry_path('.%s.%d' % (name, os.getpid()))
+                usage = commands.CommandUsage('tar')
+                # one_file_system also makes tar pack '.' instead of shell
+                # expanded file names, which are controlled by application
+                if tar.pack_tar(target, tmp_path,
+                                timeout=self.config.commands.timelimit,
+                                usage=usage, one_file_system=True):
+                    os.rename(tmp_path, cache.entry_path(name))
+                else:
+                    log.warning("Failed to save '%s' in dependency "
+                                "cache" % target)
+                self.account_usage(usage)
+        cache.cleanup()
+
     def update(self, workdir, homedir):
         log.info("Updating repository in '%s'" % homedir)
+        with self.repository_mirror(
+                workdir, self.metadata.repository.update) as mirror:
+            return self.run_repository_commands(
+                workdir, homedir, self.metadata.repository.update, homedir,
+                mirror)
+
+    def run_session_actions(self, name, workdir, homedir='/'):
+        """
+        Execute all commands of given action using single shell session.
+        Returns None if session could not be started, in that case commands
+        should be executed one by one.
+        """
         with Chroot(workdir, workdir=homedir):
-            for cmd in self.metadata.repository.update:
-                cmd = cmd.replace("%destination%", homedir)
-                try:
-                    commands.execute(cmd,
-                                     timeout=self.config.commands.timelimit,
-                                     env=self.metadata.repository.env,
-                                     output_loglevel=logging.INFO,
-                                     strip_envs=True)
-                except commands.CommandTimeout:
-                    log.error("Command is taking too long, aborting")
-                    return False
-                except commands.CommandFailed:
-                    log.error("Command failed")
-                    return False
+            session = commands.ShellSession(env=self.envs, strip_envs=True,
+                                            output_loglevel=logging.INFO,
+                                            cgroup=self.cgroup)
+            try:
+                session.start()
+            except OSError as e:
+                log.warning("Can't start shell session, falling back to "
+                            "executing commands one by one: %s" % e)
+                return None
+            try:
+                for cmd in self.actions[name]:
+                    usage = commands.CommandUsage(cmd)
+                    try:
+                        session.execute(
+                            cmd, timeout=self.config.commands.timelimit,
+                            usage=usage)
+                    except commands.CommandTimeout:
+                        log.error("Command is taking too long to execute, "
+                                  "aborting")
+                        return False
+                    except commands.CommandFailed as e:
+                        log.error("Execution failed: %s" % e)
+                        return False
+                    finally:
+                        self.account_usage(usage)
+            finally:
+                session.close()
+                # CPU and I/O usage is only known for the whole session
+                self.account_usage(session.usage)
         return True
 
     def run_actions(self, actions, workdir, homedir='/'):
+        use_session = utils.get_config_option(self.config, 'commands.session',
+                                              default=False)
         for name in actions:
             log.info("Executing '%s' setup actions" % name)
+            if use_session and self.actions[name]:
+                ret = self.run_session_actions(name, workdir, homedir=homedir)
+                if ret is False:
+                    return False
+                elif ret:
+                    continue
             for cmd in self.actions[name]:
                 with Chroot(workdir, workdir=homedir):
                     try:
-                        commands.execute(
+                        self.execute(
                             cmd, timeout=self.config.commands.timelimit,
                             env=self.envs, output_loglevel=logging.INFO,
                             strip_envs=True)
@@ -606,8 +1988,8 @@ class Builder(object):
                                      self.config.apps.gid, homedir)
         with Chroot(workdir):
             try:
-                commands.execute(cmd, timeout=self.config.commands.timelimit,
-                                 output_loglevel=logging.INFO, strip_envs=True)
+                self.execute(cmd, timeout=self.config.commands.timelimit,
+                             output_loglevel=logging.INFO, strip_envs=True)
             except commands.CommandTimeout:
                 log.error("chown is taking too long to execute, aborting")
                 return False
@@ -616,26 +1998,99 @@ class Builder(object):
                 return False
         return True
 
-    def has_valid_os_image(self):
+    def has_valid_os_image(self, broken=None):
         """
         Check if OS image exists and is fresh enough.
+
+        :param broken: Modification time of OS image that was found to be
+                       broken, such image is not valid.
         """
         if not self.storage.exists(distro.distro_image_filename()):
             return False
 
         os_mtime = self.storage.mtime(distro.distro_image_filename())
+        if broken is not None and os_mtime == broken:
+            return False
         delta = datetime.datetime.now() - os_mtime
         if delta > datetime.timedelta(days=self.config.bootstrap.maxage):
             log.info("OS image is too old (%d days)" % delta.days)
-            self.storage.delete(distro.distro_image_filename())
             return False
 
         return True
 
-    def bootstrap_os(self):
+    def os_image_needs_refresh(self):
+        """
+        Check if OS image is older than bootstrap.soft_maxage (in days), such
+        image is still valid, but new one should be bootstrapped in
+        background.
+        """
+        soft_maxage = utils.get_config_option(self.config,
+                                              'bootstrap.soft_maxage')
+        if not soft_maxage:
+            return False
+        delta = datetime.datetime.now() - self.storage.mtime(
+            distro.distro_image_filename())
+        if delta > datetime.timedelta(days=soft_maxage):
+            log.info("OS image needs refresh (%d days old)" % delta.days)
+            return True
+        return False
+
+    def bootstrap_lock_path(self):
+        return os.path.join(self.config.paths.workdir, 'upaas_bootstrap.lock')
+
+    def bootstrap_lease(self):
+        """
+        Return storage lease taken by the builder bootstrapping OS image.
+        Lease expires after bootstrap.lease_ttl seconds (twice the bootstrap
+        time limit by default), it's renewed after every bootstrap step.
+        """
+        ttl = utils.get_config_option(
+            self.config, 'bootstrap.lease_ttl',
+            default=self.config.bootstrap.timelimit * 2)
+        return StorageLease(self.storage,
+                            '%s.lease' % distro.distro_image_filename(),
+                            ttl=ttl)
+
+    def ensure_os_image(self, broken=None):
+        """
+        Bootstrap OS image unless it's valid. Only one builder bootstraps new
+        image at a time, builders on the same host are serialized using local
+        lock and builders on different hosts using storage lease. Other
+        builders wait for the lease and use image it bootstrapped.
+
+        :param broken: Modification time of OS image that was found to be
+                       broken, it will be replaced.
+        :returns: bool -- True if new image was bootstrapped.
+        """
+        lease = self.bootstrap_lease()
+        with FileLock(self.bootstrap_lock_path()):
+            while True:
+                if self.has_valid_os_image(broken=broken):
+                    log.info("Valid OS image is available")
+                    return False
+                if lease.acquire():
+                    break
+                lease.wait()
+            try:
+                self.bootstrap_os(lease=lease)
+            finally:
+                lease.release()
+        return True
+
+    def bootstrap_os(self, lease=None):
         """
         Bootstrap base OS image.
+
+        :param lease: Storage lease held while bootstrapping, it will be
+                      renewed after every step. Bootstrap is aborted if
+                      lease was taken over by other builder.
         """
+        def renew():
+            if lease and not lease.renew():
+                kill_and_remove_dir(directory, trash=self.trash)
+                raise exceptions.OSBootstrapError(
+                    "Bootstrap lease was taken over by other builder")
+
         log.info("Bootstrapping new OS image")
 
         # directory is encoded into string to prevent unicode errors
@@ -647,38 +2102,47 @@ class Builder(object):
         for cmd in self.config.bootstrap.commands:
             cmd = cmd.replace("%workdir%", directory)
             try:
-                commands.execute(cmd, timeout=self.config.bootstrap.timelimit,
-                                 cwd=directory, env=self.config.bootstrap.env,
-                                 strip_envs=True)
+                self.execute(cmd, timeout=self.config.bootstrap.timelimit,
+                             cwd=directory, env=self.config.bootstrap.env,
+                             strip_envs=True)
             except commands.CommandTimeout as e:
                 log.error("Bootstrap was taking too long and it was killed")
-                kill_and_remove_dir(directory)
+                kill_and_remove_dir(directory, trash=self.trash)
                 raise exceptions.OSBootstrapError(e)
             except commands.CommandFailed as e:
                 log.error("Bootstrap command failed")
-                kill_and_remove_dir(directory)
+                kill_and_remove_dir(directory, trash=self.trash)
                 raise exceptions.OSBootstrapError(e)
+            renew()
         log.info("All commands completed, installing packages")
 
-        self.install_packages(directory, self.config.bootstrap.packages)
+        if not self.install_packages(directory,
+                                     self.config.bootstrap.packages):
+            kill_and_remove_dir(directory, trash=self.trash)
+            raise exceptions.OSBootstrapError("Failed to install packages")
         log.info("Bootstrap done, packing image")
+        renew()
 
         archive_path = os.path.join(directory, "image.tar.gz")
         if not tar.pack_tar(directory, archive_path,
                             timeout=self.config.bootstrap.timelimit):
-            kill_and_remove_dir(directory)
+            kill_and_remove_dir(directory, trash=self.trash)
             raise exceptions.OSBootstrapError("Tar error")
         else:
             log.info("Image packed, uploading")
+            renew()
 
         try:
-            self.storage.put(archive_path, distro.distro_image_filename())
+            # replace current image (if any) atomically, builds using it will
+            # not fail while it's uploaded
+            self.storage.replace(archive_path,
+                                 distro.distro_image_filename())
         except Exception as e:
             log.error("Upload failed: %s" % e)
             raise
 
         log.info("Image uploaded")
-        kill_and_remove_dir(directory)
+        kill_and_remove_dir(directory, trash=self.trash)
         log.info("All done")
 
     def write_files(self, workdir, chroot_homedir):
@@ -706,8 +2170,12 @@ class Builder(object):
 
     def umount_filesystems(self, workdir):
         try:
-            utils.umount_filesystems(workdir,
-                                     timeout=self.config.bootstrap.timelimit)
+            utils.umount_filesystems(
+                workdir, timeout=self.config.bootstrap.timelimit,
+                lazy=utils.get_config_option(self.config,
+                                             'commands.lazy_umount',
+                                             default=False),
+                registry=self.mounts)
         except commands.CommandTimeout as e:
             log.error("Can't umount filesystem, timeout reached")
             return False
@@ -726,3 +2194,238 @@ class OSBuilder(Builder):
         self.config = builder_config
         self.storage = load_handler(self.config.storage.handler,
                                     self.config.storage.settings)
+        self.stage = None
+        self.usage = {}
+        self.stage_usage = {}
+        self.cgroup = None
+        self.mounts = utils.MountRegistry()
+        self.events = EventStream()
+        self.trash = build_trash(self.config)
+
+        # build directory mounted as tmpfs, its size in bytes and
+        # TmpfsMonitor watching it while build commands are running
+        self.tmpfs = None
+        self.tmpfs_size = None
+        self.tmpfs_monitor = None
+
+    def refresh_os_image(self, force=False):
+        """
+        Bootstrap new OS image and replace current one, builds can use current
+        image while it's running. Can be called by scheduler to refresh image
+        before it expires.
+
+        :param force: Refresh image even if it's not older than
+                      bootstrap.soft_maxage.
+        :returns: bool -- False if refresh was not needed or other builder is
+                  already doing it.
+        """
+        lock = FileLock(self.bootstrap_lock_path(), blocking=False)
+        if not lock.acquire():
+            log.info("OS image is already being bootstrapped on this host")
+            return False
+        lease = self.bootstrap_lease()
+        try:
+            if not lease.acquire():
+                log.info("OS image is already being bootstrapped")
+                return False
+            try:
+                if not force and self.has_valid_os_image() and \
+                        not self.os_image_needs_refresh():
+                    log.info("OS image was already refreshed")
+                    return False
+                self.bootstrap_os(lease=lease)
+            finally:
+                lease.release()
+        finally:
+            lock.release()
+        return True
+
+    @classmethod
+    def refresher(cls, builder_config):
+        try:
+            cls(builder_config).refresh_os_image()
+        except Exception as e:
+            log.error("OS image refresh failed: %s" % e)
+
+    @classmethod
+    def start_refresh(cls, builder_config):
+        """
+        Start OS image refresh in background process, it uses its own
+        storage handler and doesn't share anything with running builds.
+
+        :returns: multiprocessing.Process instance.
+        """
+        process = multiprocessing.Process(target=cls.refresher,
+                                          args=(builder_config,))
+        process.daemon = True
+        process.start()
+        log.info("Started OS image refresh with pid %d" % process.pid)
+        return process
+
+
+class PoolBuilder(Builder):
+    """
+    Prepares chroots for the warm pool: OS image is unpacked, packages from
+    builder config are installed and interpreter actions are executed.
+    Application metadata is not used, so pooled chroots can be shared by all
+    applications using the same interpreter version.
+    """
+
+    def __init__(self, builder_config, interpreter_type, interpreter_version):
+        """
+        :param builder_config: Builder configuration.
+        :param interpreter_type: Interpreter name, example: ruby.
+        :param interpreter_version: Interpreter version, example: 2.1.2.
+        """
+        metadata = MetadataConfig({
+            'interpreter': {
+                'type': interpreter_type,
+                'versions': [interpreter_version],
+            },
+            'repository': {'clone': '/bin/true', 'update': '/bin/true'},
+        })
+        super(PoolBuilder, self).__init__(builder_config, metadata)
+        self.interpreter_version = interpreter_version
+        self.storage = load_handler(self.config.storage.handler,
+                                    self.config.storage.settings)
+        # pooled chroots are only used for fresh packages, actions must run
+        # the same way as in unpooled build
+        self.envs['UPAAS_FRESH_PACKAGE'] = 'true'
+        self.actions.update(self.parse_actions(metadata))
+        self.envs.update(self.parse_envs(metadata))
+        self.envs['HOME'] = self.config.apps.home
+        self.os_packages += self.parse_packages(metadata)
+
+    @classmethod
+    def configured(cls, builder_config):
+        """
+        List (interpreter type, version) tuples that should be kept in warm
+        pool (pool.interpreters, dictionary with list of versions for every
+        interpreter type).
+        """
+        interpreters = utils.get_config_option(builder_config,
+                                               'pool.interpreters') or {}
+        ret = []
+        for (name, versions) in interpreters.items():
+            for version in versions:
+                ret.append((name, '%s' % version))
+        return sorted(ret)
+
+    @classmethod
+    def refill(cls, builder_config):
+        """
+        Add missing chroots to warm pool for all configured interpreters,
+        returns number of added chroots. Refill is skipped if other process
+        is already doing it.
+        """
+        pool = warm_pool(builder_config)
+        if not pool:
+            return 0
+        lock = pool.lock(blocking=False)
+        if not lock.acquire():
+            log.info("Warm pool is already being refilled")
+            return 0
+        added = 0
+        try:
+            builders = [cls(builder_config, name, version) for
+                        (name, version) in cls.configured(builder_config)]
+            try:
+                keys = [b.pool_key() for b in builders]
+            except StorageError as e:
+                log.warning("Can't refill warm pool, OS image is not "
+                            "available: %s" % e)
+                return 0
+            pool.cleanup(keep=keys)
+            for (builder, key) in zip(builders, keys):
+                for _ in range(pool.missing(key)):
+                    if not builder.provision(pool, key):
+                        break
+                    added += 1
+        finally:
+            lock.release()
+        return added
+
+    @classmethod
+    def refiller(cls, builder_config, interval=60):
+        """
+        Refill warm pool every *interval* seconds, never returns.
+        """
+        while True:
+            try:
+                cls.refill(builder_config)
+            except Exception as e:
+                log.error("Warm pool refill failed: %s" % e)
+            time.sleep(interval)
+
+    @classmethod
+    def start_refiller(cls, builder_config, interval=60):
+        """
+        Start background process keeping warm pool filled. Chroots are
+        prepared in a separate process since entering chroot affects the
+        whole process.
+
+        :returns: multiprocessing.Process instance.
+        """
+        process = multiprocessing.Process(target=cls.refiller,
+                                          args=(builder_config, interval))
+        process.daemon = True
+        process.start()
+        log.info("Started warm pool refiller with pid %d" % process.pid)
+        return process
+
+    def pool_key(self):
+        """
+        Return warm pool key for chroots prepared by this builder, it changes
+        every time OS image or any builder setting used to prepare chroot is
+        updated. Env variables include UPAAS_FRESH_PACKAGE flag, so chroots
+        prepared without it are never used.
+        """
+        image = distro.distro_image_filename()
+        names = self.builder_action_names + self.interpreter_action_names
+        inputs = {
+            'image': [image, '%s' % self.storage.mtime(image)],
+            'packages': sorted(self.os_packages),
+            'actions': dict([(n, self.actions.get(n, [])) for n in names]),
+            'env': self.envs,
+            'install': [self.config.commands.install.cmd,
+                        utils.get_config_option(
+                            self.config, 'commands.install.batch_cmd'),
+                        self.config.commands.install.env],
+        }
+        return '%s-%s-%s' % (self.metadata.interpreter.type,
+                             self.interpreter_version,
+                             calculate_string_sha256(json.dumps(
+                                 inputs, sort_keys=True).encode('utf-8')))
+
+    def mount_overlay(self, directory, workdir, filename):
+        # pooled chroots are moved between directories, so they can't be
+        # overlay mounts
+        return False
+
+    def provision(self, pool, key):
+        """
+        Prepare new chroot and add it to the pool, returns False if it failed.
+        """
+        directory = pool.tmp_dir(key)
+        workdir = os.path.join(directory, "workdir")
+        os.mkdir(workdir, 0o755)
+        log.info("Preparing pooled chroot for %s %s at '%s'" % (
+            self.metadata.interpreter.type, self.interpreter_version,
+            workdir))
+        if not self.unpack_os(directory, workdir):
+            log.error("Unpacking OS image for pooled chroot failed")
+        elif not self.run_actions(self.builder_action_names, workdir):
+            log.error("System actions for pooled chroot failed")
+        elif not self.install_packages(workdir, self.os_packages):
+            log.error("Installing packages in pooled chroot failed")
+        elif not self.run_actions(self.interpreter_action_names, workdir,
+                                  '/'):
+            log.error("Interpreter actions for pooled chroot failed")
+        elif not self.umount_filesystems(workdir):
+            log.error("Can't unmount filesystems in pooled chroot")
+        else:
+            pool.add(key, workdir)
+            kill_and_remove_dir(directory, trash=self.trash)
+            return True
+        kill_and_remove_dir(directory, trash=self.trash)
+        return False
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import time
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+def mbps(nbytes, seconds):
+    """
+    Return throughput in MB/s or None if it can't be calculated.
+    """
+    if not nbytes or not seconds:
+        return None
+    return nbytes / 1024.0 / 1024.0 / seconds
+
+
+class BuildEvent(object):
+    """
+    Single build event, every event has a type, timestamp and optional name
+    of the build stage it belongs to. Other attributes depend on the event
+    type.
+    """
+
+    # stage was started, 'progress' is set to build progress in %
+    STAGE_STARTED = 'stage_started'
+    # stage was finished, 'status', 'duration', 'bytes' and 'mbps' are set
+    STAGE_FINISHED = 'stage_finished'
+    # build progress changed, 'progress' is set
+    PROGRESS = 'progress'
+    # data was processed by transfer stage, 'bytes', 'total', 'mbps' and
+    # 'progress' are set
+    TRANSFER = 'transfer'
+    # build finished, 'filename', 'checksum', 'bytes' and 'reused' are set
+    FINISHED = 'finished'
+    # build failed, 'error' and 'user_error' are set
+    FAILED = 'failed'
+
+    def __init__(self, type, stage=None, **data):
+        self.type = type
+        self.timestamp = time.time()
+        self.stage = stage
+        self.data = data
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def dump(self):
+        ret = dict(self.data)
+        ret.update({'type': self.type, 'timestamp': self.timestamp,
+                    'stage': self.stage})
+        return ret
+
+
+class EventStream(object):
+    """
+    Dispatches build events to registered listeners, listener is either a
+    callback called with BuildEvent instance or a queue (anything with put()
+    method) receiving dumped events.
+    """
+
+    def __init__(self):
+        self.listeners = []
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def add_queue(self, queue):
+        self.listeners.append(lambda event: queue.put(event.dump()))
+
+    def emit(self, type, stage=None, **data):
+        event = BuildEvent(type, stage=stage, **data)
+        for callback in self.listeners:
+            try:
+                callback(event)
+            except Exception as e:
+                log.error("Event listener %s failed: %s" % (callback, e))
+        return event
+
+
+class TransferMeter(object):
+    """
+    Counts bytes processed by a build stage and emits transfer events with
+    current throughput, at most once every *interval* seconds. Instance can
+    be passed directly as a progress callback accepting number of bytes.
+    """
+
+    def __init__(self, events, stage, total=None, progress=(0, 0),
+                 interval=1.0):
+        """
+        :param events: EventStream instance.
+        :param stage: Build stage name.
+        :param total: Expected number of bytes, if known.
+        :param progress: Tuple with build progress (in %) at the start and
+                         at the end of this stage, progress reported with
+                         transfer events is interpolated between them.
+        :param interval: Minimum number of seconds between events.
+        """
+        self.events = events
+        self.stage = stage
+        self.total = total
+        self.progress = progress
+        self.interval = interval
+        self.bytes = 0
+        self.started = time.time()
+        self.last_event = 0
+
+    def __call__(self, nbytes):
+        self.bytes += nbytes
+        if time.time() - self.last_event >= self.interval:
+            self.emit()
+
+    def current_progress(self):
+        (start, end) = self.progress
+        if not self.total:
+            return start
+        return start + int((end - start) * min(
+            float(self.bytes) / self.total, 1))
+
+    def emit(self):
+        self.last_event = time.time()
+        return self.events.emit(
+            BuildEvent.TRANSFER, stage=self.stage, bytes=self.bytes,
+            total=self.total, progress=self.current_progress(),
+            mbps=mbps(self.bytes, self.last_event - self.started))
+
+    def finish(self):
+        """
+        Emit final transfer event, returns it.
+        """
+        return self.emit()
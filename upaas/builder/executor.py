@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import time
+import logging
+import multiprocessing
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from upaas import utils
+from upaas.builder import exceptions
+from upaas.builder.builder import Builder, OSBuilder
+from upaas.builder.events import BuildEvent
+from upaas.storage.exceptions import StorageError
+
+
+log = logging.getLogger(__name__)
+
+
+# builds must be forked, child process inherits builder config and metadata
+# objects, entering chroot in the child doesn't affect parent process
+if hasattr(multiprocessing, 'get_context'):
+    mp = multiprocessing.get_context('fork')
+else:
+    mp = multiprocessing
+
+
+def run_build(queue, build_id, builder_config, metadata, kwargs):
+    """
+    Build package and report progress to the queue, executed in child
+    process.
+    """
+    def send(event, **data):
+        data['build'] = build_id
+        data['event'] = event
+        queue.put(data)
+
+    def send_transfer(event):
+        if event.type == BuildEvent.TRANSFER:
+            send('transfer', transfer=event.dump())
+
+    try:
+        builder = Builder(builder_config, metadata)
+        builder.add_stage_hook(lambda stage: send('stage',
+                                                  stage=stage.dump()))
+        builder.events.add_listener(send_transfer)
+        result = None
+        for result in builder.build_package(**kwargs):
+            send('progress', progress=result.progress)
+    except exceptions.BuildError as e:
+        send('failed', error='%s' % e, user_error=isinstance(
+            e, exceptions.PackageUserError))
+    except Exception as e:
+        log.exception("Build %s failed with unexpected error" % build_id)
+        send('failed', error='%s' % e, user_error=False)
+    else:
+        send('finished', result=result.dump())
+
+
+class BuildExecutor(object):
+    """
+    Runs many builds at once, every build is executed in a separate forked
+    process since Builder enters chroot and modifies process environment.
+    New builds are started only if the number of running builds is below
+    executor.workers (defaults to number of CPUs) and host isn't overloaded:
+    load average per CPU must be below executor.max_load and available
+    memory above executor.min_memory (in MB), if those options are set.
+    One build is always allowed to run, so that queued builds are never
+    starved by other processes running on the host.
+
+    OS image older than bootstrap.soft_maxage is refreshed in a separate
+    background process started by executor, it's checked at most once every
+    executor.refresh_interval seconds (5 minutes by default) while builds
+    are being started.
+
+    Usage:
+
+        executor = BuildExecutor(builder_config)
+        executor.submit(metadata, system_filename=filename)
+        for event in executor.events():
+            print(event['build'], event['event'])
+
+    Every event is a dictionary with 'build' (id returned by submit()) and
+    'event' keys:
+    - started - build process was started, 'pid' key is set
+    - stage - build stage was started or finished, 'stage' key is set to
+              the dump of BuildStage instance
+    - progress - 'progress' key is set to build progress in %
+    - transfer - data processed by transfer stage, 'transfer' key is set to
+                 the dump of BuildEvent instance with byte counters and
+                 throughput
+    - finished - build completed, 'result' key is set to the dump of
+                 BuildResult instance
+    - failed - build failed, 'error' key contains error message and
+               'user_error' is True if it was caused by the application
+    """
+
+    def __init__(self, builder_config):
+        """
+        :param builder_config: Builder configuration.
+        """
+        self.config = builder_config
+        self.workers = utils.get_config_option(
+            builder_config, 'executor.workers',
+            default=multiprocessing.cpu_count())
+        self.max_load = utils.get_config_option(builder_config,
+                                                'executor.max_load')
+        min_memory = utils.get_config_option(builder_config,
+                                             'executor.min_memory')
+        self.min_memory = min_memory and min_memory * 1024 * 1024
+        self.queue = mp.Queue()
+        self.last_id = 0
+        # list of (build id, metadata, build_package kwargs) tuples
+        self.pending = []
+        # build id -> Process instance
+        self.running = {}
+        self.refresh_interval = utils.get_config_option(
+            builder_config, 'executor.refresh_interval', default=300)
+        self.refresh_checked = None
+        self.refresh_process = None
+
+    def submit(self, metadata, **kwargs):
+        """
+        Queue new build, all keyword arguments are passed to
+        Builder.build_package(). Returns build id.
+        """
+        self.last_id += 1
+        self.pending.append((self.last_id, metadata, kwargs))
+        log.info("Build %d queued, %d build(s) pending" % (
+            self.last_id, len(self.pending)))
+        return self.last_id
+
+    def admit(self):
+        """
+        Check if new build can be started.
+        """
+        if not self.running:
+            return True
+        if len(self.running) >= self.workers:
+            return False
+        if self.max_load:
+            load = utils.backend_load()
+            if load > self.max_load:
+                log.debug("Load is too high to start new build: %.2f" % load)
+                return False
+        if self.min_memory:
+            available = utils.backend_available_memory()
+            if available is not None and available < self.min_memory:
+                log.debug("Not enough memory available to start new build: "
+                          "%s" % utils.bytes_to_human(available))
+                return False
+        return True
+
+    def schedule(self):
+        """
+        Start as many pending builds as allowed, returns list of 'started'
+        events.
+        """
+        ret = []
+        if self.pending:
+            self.refresh_os_image()
+        while self.pending and self.admit():
+            (build_id, metadata, kwargs) = self.pending.pop(0)
+            process = mp.Process(target=run_build,
+                                 args=(self.queue, build_id, self.config,
+                                       metadata, kwargs))
+            process.start()
+            log.info("Build %d started with pid %d" % (build_id, process.pid))
+            self.running[build_id] = process
+            ret.append({'build': build_id, 'event': 'started',
+                        'pid': process.pid})
+        return ret
+
+    def refresh_os_image(self):
+        """
+        Start OS image refresh in background if current image needs it and
+        refresh is not already running.
+        """
+        if self.refresh_process is not None:
+            if self.refresh_process.is_alive():
+                return
+            self.refresh_process.join()
+            self.refresh_process = None
+        if self.refresh_checked is not None and \
+                time.time() - self.refresh_checked < self.refresh_interval:
+            return
+        self.refresh_checked = time.time()
+        try:
+            builder = OSBuilder(self.config)
+            if not builder.has_valid_os_image() or \
+                    not builder.os_image_needs_refresh():
+                return
+        except StorageError as e:
+            log.error("Can't check OS image age: %s" % e)
+            return
+        self.refresh_process = OSBuilder.start_refresh(self.config)
+
+    def finish(self, build_id):
+        process = self.running.pop(build_id, None)
+        if process:
+            process.join()
+
+    def handle(self, event):
+        """
+        Process event received from build process, returns None if event
+        should be dropped since its build is already completed.
+        """
+        if event['build'] not in self.running:
+            log.debug("Dropping %s event of completed build %d" % (
+                event['event'], event['build']))
+            return None
+        if event['event'] in ['finished', 'failed']:
+            self.finish(event['build'])
+        return event
+
+    def reap(self):
+        """
+        Collect build processes that exited, returns list of events they
+        reported before exiting. 'failed' event is added for every build that
+        exited without reporting the outcome.
+        """
+        # processes are checked before reading the queue, so events put by
+        # build that exited in the meantime are never missed
+        exited = [build_id for (build_id, process) in self.running.items()
+                  if not process.is_alive()]
+        ret = []
+        while True:
+            try:
+                event = self.handle(self.queue.get_nowait())
+            except Empty:
+                break
+            if event is not None:
+                ret.append(event)
+        for build_id in exited:
+            process = self.running.get(build_id)
+            if process is None:
+                # outcome was already reported
+                continue
+            self.finish(build_id)
+            log.error("Build %d process exited unexpectedly with code "
+                      "%s" % (build_id, process.exitcode))
+            ret.append({'build': build_id, 'event': 'failed',
+                        'error': 'Build process exited with code %s' % (
+                            process.exitcode),
+                        'user_error': False})
+        return ret
+
+    def events(self, timeout=1):
+        """
+        Run all submitted builds and yield their events until all builds are
+        completed. Builds can be submitted while iterating.
+
+        :param timeout: Number of seconds to wait for events before checking
+                        for crashed builds and pending builds that can be
+                        started.
+        """
+        while self.pending or self.running:
+            for event in self.schedule():
+                yield event
+            try:
+                event = self.queue.get(timeout=timeout)
+            except Empty:
+                for event in self.reap():
+                    yield event
+                continue
+            event = self.handle(event)
+            if event is not None:
+                yield event
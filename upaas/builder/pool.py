@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import errno
+import shutil
+import tempfile
+import logging
+
+from upaas.cache import FileLock, path_size
+from upaas.processes import kill_and_remove_dir
+
+
+log = logging.getLogger(__name__)
+
+
+class WarmPool(object):
+    """
+    Pool of ready to use build chroots, every chroot belongs to a key
+    describing how it was prepared (distribution, interpreter and builder
+    config fingerprint). Build claims chroot by renaming it into its own
+    working directory, so pool directory must be on the same filesystem as
+    builder workdir.
+
+    Layout: <path>/<key>/<creation timestamp>-<pid>-<size in bytes>, chroots
+    that are still being prepared are kept in temporary directories starting
+    with '.'. Size is stored in the name, so pool size is known without
+    walking all chroots.
+    """
+
+    def __init__(self, path, size=1, ttl=None, max_size=None):
+        """
+        :param path: Pool directory path, it will be created if missing.
+        :param size: Number of ready chroots to keep for every key.
+        :param ttl: Chroots older than this number of seconds are not used
+                    and will be removed during cleanup.
+        :param max_size: Maximum size of all pooled chroots in bytes, no
+                         limit if None.
+        """
+        self.path = path.rstrip('/')
+        self.size = size
+        self.ttl = ttl
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            log.info("Creating warm pool directory at '%s'" % self.path)
+            os.makedirs(self.path)
+
+    def key_path(self, key):
+        return os.path.join(self.path, key)
+
+    def lock(self, blocking=True):
+        """
+        Lock held while pool is refilled, only one process should be adding
+        chroots at a time.
+        """
+        return FileLock('%s.lock' % self.path, blocking=blocking)
+
+    def keys(self):
+        return [name for name in os.listdir(self.path)
+                if os.path.isdir(self.key_path(name))]
+
+    def entries(self, key):
+        """
+        List all ready chroots for given key, oldest first.
+
+        :returns: list of tuples -- [(creation timestamp, path), ...]
+        """
+        ret = []
+        if not os.path.isdir(self.key_path(key)):
+            return ret
+        for name in os.listdir(self.key_path(key)):
+            if name.startswith('.'):
+                continue
+            try:
+                created = int(name.split('-')[0])
+            except ValueError:
+                continue
+            ret.append((created, os.path.join(self.key_path(key), name)))
+        return sorted(ret)
+
+    def expired(self, created):
+        return bool(self.ttl) and time.time() - created > self.ttl
+
+    def claim(self, key, destination):
+        """
+        Move ready chroot for given key into destination directory (which
+        must be empty). Returns False if there is no chroot available.
+        """
+        for (created, path) in self.entries(key):
+            if self.expired(created):
+                continue
+            try:
+                os.rename(path, destination)
+            except OSError as e:
+                if e.errno == errno.EXDEV:
+                    log.warning("Warm pool at '%s' is not on the same "
+                                "filesystem as '%s', it can't be used" % (
+                                    self.path, destination))
+                    return False
+                # claimed by other build
+                continue
+            log.info("Claimed pooled chroot '%s'" % path)
+            return True
+        log.info("No pooled chroot available for '%s'" % key)
+        return False
+
+    def key_size(self, key):
+        """
+        Return total size (in bytes) of all ready chroots for given key.
+        """
+        ret = 0
+        for (_, path) in self.entries(key):
+            try:
+                ret += int(os.path.basename(path).split('-')[2])
+            except (IndexError, ValueError):
+                ret += path_size(path)
+        return ret
+
+    def total_size(self):
+        return sum([self.key_size(key) for key in self.keys()])
+
+    def missing(self, key):
+        """
+        Return number of chroots that should be added for given key.
+        """
+        if self.max_size and self.total_size() >= self.max_size:
+            log.info("Warm pool at '%s' is over its size limit" % self.path)
+            return 0
+        ready = [c for (c, _) in self.entries(key) if not self.expired(c)]
+        return max(self.size - len(ready), 0)
+
+    def tmp_dir(self, key):
+        """
+        Create temporary directory for preparing new chroot for given key.
+        """
+        if not os.path.isdir(self.key_path(key)):
+            os.makedirs(self.key_path(key))
+        return tempfile.mkdtemp(dir=self.key_path(key), prefix='.')
+
+    def add(self, key, workdir):
+        """
+        Move prepared chroot into the pool. Filesystems mounted inside it
+        must be unmounted first.
+        """
+        path = os.path.join(self.key_path(key), '%d-%d-%d' % (
+            time.time(), os.getpid(), path_size(workdir)))
+        os.rename(workdir, path)
+        log.info("Added chroot '%s' to warm pool" % path)
+        return path
+
+    def cleanup(self, keep=None):
+        """
+        Remove expired chroots, leftovers from interrupted refills and, if
+        list of valid keys is given, all chroots for other keys. Should be
+        called only while holding pool lock.
+        """
+        for key in self.keys():
+            if keep is not None and key not in keep:
+                log.info("Removing stale warm pool entries for '%s'" % key)
+                kill_and_remove_dir(self.key_path(key))
+                continue
+            for name in os.listdir(self.key_path(key)):
+                path = os.path.join(self.key_path(key), name)
+                if not name.startswith('.'):
+                    try:
+                        if not self.expired(int(name.split('-')[0])):
+                            continue
+                    except ValueError:
+                        pass
+                log.info("Removing expired warm pool entry '%s'" % path)
+                try:
+                    kill_and_remove_dir(path)
+                except OSError as e:
+                    log.error("Can't remove '%s': %s" % (path, e))
+            if not os.listdir(self.key_path(key)):
+                shutil.rmtree(self.key_path(key))
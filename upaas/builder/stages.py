@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import datetime
+import logging
+
+from upaas.cache import FileLock
+
+
+log = logging.getLogger(__name__)
+
+
+class BuildStage(object):
+    """
+    Single build stage, records timing, amount of processed data and outcome.
+    """
+
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self.finished = None
+        # duration in seconds
+        self.duration = None
+        # number of bytes processed by this stage (if known)
+        self.bytes = 0
+        self.status = None
+        self.skipped = False
+        self._started_ts = None
+
+    def start(self):
+        log.debug("Starting build stage '%s'" % self.name)
+        self.started = datetime.datetime.now()
+        self._started_ts = time.time()
+        self.status = self.RUNNING
+
+    def skip(self):
+        """
+        Mark stage as skipped, it will not be used in duration statistics.
+        """
+        self.skipped = True
+
+    def finish(self, status):
+        self.finished = datetime.datetime.now()
+        self.duration = time.time() - self._started_ts
+        self.status = status
+        log.info("Build stage '%s' finished in %.2f seconds, status: "
+                 "%s" % (self.name, self.duration, status))
+
+    def dump(self):
+        return {
+            'name': self.name,
+            'started': self.started,
+            'finished': self.finished,
+            'duration': self.duration,
+            'bytes': self.bytes,
+            'status': self.status,
+        }
+
+
+class StageStats(object):
+    """
+    Historical durations of build stages stored in json file as moving
+    averages, used to estimate build progress.
+    """
+
+    def __init__(self, path, smoothing=0.3):
+        """
+        :param path: Path to the json file with stage durations, if None
+                     statistics are not stored and default stage weights are
+                     always used.
+        :param smoothing: Weight of the most recent duration in the average.
+        """
+        self.path = path
+        self.smoothing = smoothing
+
+    def load(self):
+        """
+        Return dictionary with average duration (in seconds) of every stage.
+        """
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as stats:
+                return json.load(stats)
+        except (IOError, ValueError) as e:
+            log.debug("Can't load stage statistics from %s: %s" % (self.path,
+                                                                   e))
+            return {}
+
+    def update(self, stages):
+        """
+        Add durations of successfully finished stages to statistics.
+
+        :param stages: List of BuildStage instances.
+        """
+        if not self.path:
+            return
+        with FileLock('%s.lock' % self.path):
+            averages = self.load()
+            for stage in stages:
+                if stage.status != BuildStage.SUCCESS:
+                    continue
+                if stage.name in averages:
+                    averages[stage.name] = (
+                        self.smoothing * stage.duration +
+                        (1 - self.smoothing) * averages[stage.name])
+                else:
+                    averages[stage.name] = stage.duration
+            tmp_path = '%s.%d' % (self.path, os.getpid())
+            try:
+                with open(tmp_path, 'w') as stats:
+                    json.dump(averages, stats)
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                log.error("Can't save stage statistics to %s: %s" % (
+                    self.path, e))
+
+    def progress(self, stages):
+        """
+        Return dictionary with build progress (in %) reached after each stage.
+        Historical durations are used if there are statistics for all stages,
+        default stage weights are used otherwise.
+
+        :param stages: Ordered list of (stage name, default weight) tuples.
+        """
+        averages = self.load()
+        if all([name in averages for (name, _) in stages]):
+            weights = [(name, averages[name]) for (name, _) in stages]
+        else:
+            weights = stages
+        total = sum([weight for (_, weight) in weights]) or 1
+        ret = {}
+        elapsed = 0
+        for (name, weight) in weights:
+            elapsed += weight
+            ret[name] = min(int(100.0 * elapsed / total), 99)
+        if weights:
+            ret[weights[-1][0]] = 100
+        return ret
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import logging
+import multiprocessing
+
+from upaas import utils
+from upaas import commands
+
+
+log = logging.getLogger(__name__)
+
+
+# monitor must be forked, builder process might be inside chroot at any time
+# so it can't check tmpfs usage itself while build commands are running
+if hasattr(multiprocessing, 'get_context'):
+    mp = multiprocessing.get_context('fork')
+else:
+    mp = multiprocessing
+
+
+class TmpfsMonitor(object):
+    """
+    Watches usage of build directory mounted as tmpfs while build commands
+    are running. tmpfs is grown twice every time it's more than threshold
+    full, if there is not enough memory for that (or tmpfs was filled up
+    before it could be grown, so some writes might have failed) it's marked
+    as exhausted and build directory should be moved to disk.
+    """
+
+    # tmpfs this full is treated as filled up, writes might have failed
+    full_ratio = 0.99
+
+    def __init__(self, path, max_size, threshold=0.75, interval=1,
+                 timeout=60):
+        """
+        :param path: tmpfs mount point.
+        :param max_size: tmpfs is never grown above this size (in bytes).
+        :param threshold: Grow tmpfs if it's more than this fraction full.
+        :param interval: Usage check interval (in seconds).
+        :param timeout: Resize command timeout (in seconds).
+        """
+        self.path = path
+        self.max_size = max_size
+        self.threshold = threshold
+        self.interval = interval
+        self.timeout = timeout
+        self.process = None
+        # shared with monitor process
+        self._exhausted = mp.Value('b', 0)
+
+    @property
+    def exhausted(self):
+        return bool(self._exhausted.value)
+
+    def check(self):
+        """
+        Check tmpfs usage and grow it if needed. Returns False if tmpfs is no
+        longer mounted.
+        """
+        if not os.path.ismount(self.path):
+            return False
+        (size, used) = utils.filesystem_usage(self.path)
+        if used < size * self.threshold:
+            return True
+        if used >= size * self.full_ratio and not self.exhausted:
+            log.warning("tmpfs at '%s' was filled up" % self.path)
+            self._exhausted.value = 1
+        new_size = max(size, used) * 2
+        available = utils.backend_available_memory()
+        if new_size <= self.max_size and (
+                available is None or new_size - used <= available):
+            try:
+                utils.resize_tmpfs(self.path, new_size, timeout=self.timeout)
+            except commands.CommandError as e:
+                log.warning("Can't resize tmpfs: %s" % e)
+            else:
+                return True
+        if not self.exhausted:
+            log.warning("tmpfs at '%s' can't be grown" % self.path)
+            self._exhausted.value = 1
+        return True
+
+    def run(self, parent):
+        while os.getppid() == parent:
+            try:
+                if not self.check():
+                    return
+            except OSError as e:
+                log.error("Can't check tmpfs usage: %s" % e)
+                return
+            time.sleep(self.interval)
+
+    def start(self):
+        """
+        Start monitor process, it exits once tmpfs is unmounted or builder
+        process is gone.
+        """
+        self.process = mp.Process(target=self.run, args=(os.getpid(),))
+        self.process.daemon = True
+        self.process.start()
+        log.debug("Started tmpfs monitor with pid %d" % self.process.pid)
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
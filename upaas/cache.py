@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import fcntl
+import shutil
+import logging
+
+from upaas import tar
+from upaas import commands
+from upaas.checksum import calculate_string_sha256
+from upaas.utils import bytes_to_human
+
+
+log = logging.getLogger(__name__)
+
+
+def path_size(path):
+    """
+    Return disk usage of given file or directory in bytes.
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    ret = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                ret += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return ret
+
+
+class FileLock(object):
+    """
+    Advisory lock based on flock(), can be used as a context manager.
+    Shared locks can be held by many processes at once, exclusive lock can be
+    acquired only if there are no other locks held.
+    """
+
+    def __init__(self, path, shared=False, blocking=True):
+        """
+        :param path: Path to the lock file, it will be created if missing.
+        :param shared: Acquire shared lock instead of exclusive one.
+        :param blocking: Wait for the lock if it's held by other process.
+        """
+        self.path = path
+        self.shared = shared
+        self.blocking = blocking
+        self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+    @property
+    def locked(self):
+        return self.fd is not None
+
+    def acquire(self):
+        """
+        Acquire lock, returns False if lock is non blocking and it's already
+        held by other process.
+        """
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, flags)
+        except (IOError, OSError):
+            os.close(fd)
+            if self.blocking:
+                raise
+            log.debug("Lock %s is already held" % self.path)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+class CacheDirectory(object):
+    """
+    Directory with cached entries shared between builds. Every top level
+    file or directory is a single entry, least recently used entries are
+    removed once total size exceeds the limit.
+
+    Processes using cache should hold shared lock, cleanup is performed only
+    when no other process holds it. Processes holding exclusive lock can
+    call purge() directly before releasing it.
+    """
+
+    def __init__(self, path, max_size=None):
+        """
+        :param path: Cache directory path, it will be created if missing.
+        :param max_size: Maximum size of all cache entries in bytes, no limit
+                         if None.
+        """
+        self.path = path.rstrip('/')
+        self.max_size = max_size
+        self.lock_path = '%s.lock' % self.path
+        if not os.path.isdir(self.path):
+            log.info("Creating cache directory at '%s'" % self.path)
+            os.makedirs(self.path)
+
+    def entry_path(self, name):
+        return os.path.join(self.path, name)
+
+    def lock(self, shared=True, blocking=True):
+        return FileLock(self.lock_path, shared=shared, blocking=blocking)
+
+    def touch(self, name):
+        """
+        Mark entry as recently used.
+        """
+        try:
+            os.utime(self.entry_path(name), None)
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        List all entries, least recently used first.
+
+        :returns: list of tuples -- [(last used timestamp, size, name), ...]
+        """
+        ret = []
+        for name in os.listdir(self.path):
+            path = self.entry_path(name)
+            try:
+                stat = os.lstat(path)
+                size = path_size(path)
+            except OSError:
+                continue
+            ret.append((max(stat.st_atime, stat.st_mtime), size, name))
+        return sorted(ret)
+
+    def in_use(self, name):
+        """
+        Entries in use are never removed during cleanup.
+        """
+        return False
+
+    def expired(self, name, last_used):
+        """
+        Expired entries are always removed during cleanup.
+        """
+        return False
+
+    def remove(self, name):
+        path = self.entry_path(name)
+        log.info("Removing cache entry '%s'" % path)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def cleanup(self):
+        """
+        Remove expired entries and least recently used entries until cache
+        fits in size limit. Cleanup is skipped if cache is in use by other
+        process.
+        """
+        lock = self.lock(shared=False, blocking=False)
+        if not lock.acquire():
+            log.info("Cache at '%s' is in use, skipping cleanup" % self.path)
+            return
+        try:
+            self.purge()
+        finally:
+            lock.release()
+
+    def purge(self):
+        """
+        Remove expired entries and least recently used entries until cache
+        fits in size limit, caller must hold exclusive cache lock.
+        """
+        entries = self.entries()
+        total = sum([size for (_, size, _) in entries])
+        log.debug("Cache at '%s' is using %s" % (self.path,
+                                                 bytes_to_human(total)))
+        for (last_used, size, name) in entries:
+            if self.in_use(name):
+                continue
+            if not self.expired(name, last_used) and (
+                    not self.max_size or total <= self.max_size):
+                continue
+            try:
+                self.remove(name)
+            except OSError as e:
+                log.error("Can't remove cache entry '%s': %s" % (name, e))
+            else:
+                total -= size
+
+
+class TreeCache(CacheDirectory):
+    """
+    Cache of unpacked archives (OS images and packages), every entry is a
+    directory with archive content. Entries must be treated as read-only,
+    build workdirs are created by copying entry content (using reflinks if
+    filesystem supports them) or by mounting an overlay on top of it.
+    Entries used as overlay lower layer are never removed.
+    """
+
+    def __init__(self, path, max_size=None, max_age=None):
+        """
+        :param path: Cache directory path, it will be created if missing.
+        :param max_size: Maximum size of all cache entries in bytes, no limit
+                         if None.
+        :param max_age: Entries for archives older than this number of
+                        seconds are removed during cleanup.
+        """
+        super(TreeCache, self).__init__(path, max_size=max_size)
+        self.max_age = max_age
+
+    @staticmethod
+    def entry_name(filename, mtime):
+        """
+        Return cache entry name for given storage file.
+
+        :param filename: Storage filename.
+        :param mtime: Storage file modification time (datetime object).
+        """
+        return '%d-%s' % (time.mktime(mtime.timetuple()),
+                          calculate_string_sha256(('%s:%s' % (
+                              filename, mtime)).encode('utf-8')))
+
+    def in_use(self, name):
+        path = self.entry_path(name)
+        try:
+            with open('/proc/mounts') as mounts:
+                return 'lowerdir=%s,' % path in mounts.read()
+        except IOError:
+            return False
+
+    def expired(self, name, last_used):
+        if name.startswith('.'):
+            # leftover from interrupted add()
+            return True
+        if not self.max_age:
+            return False
+        try:
+            mtime = int(name.split('-')[0])
+        except ValueError:
+            return True
+        return time.time() - mtime > self.max_age
+
+    def copy(self, name, destination, timeout=None, usage=None):
+        """
+        Copy content of cache entry into destination directory, reflinks are
+        used if filesystem supports them.
+        """
+        log.info("Copying cached content from '%s' to '%s'" % (
+            self.entry_path(name), destination))
+        try:
+            commands.execute("cp -a --reflink=auto %s/. %s" % (
+                self.entry_path(name), destination), timeout=timeout,
+                usage=usage)
+        except commands.CommandError as e:
+            log.error("Copying cached content failed: %s" % e)
+            return False
+        return True
+
+    def get(self, name):
+        """
+        Return path to cache entry or None if there is no such entry.
+        """
+        path = self.entry_path(name)
+        if os.path.isdir(path):
+            self.touch(name)
+            return path
+
+    def add(self, name, archive_path, timeout=None, usage=None):
+        """
+        Unpack archive as a new cache entry, returns path to the entry or None
+        if unpacking failed.
+        """
+        path = self.entry_path(name)
+        tmp_path = self.entry_path('.%s.%d' % (name, os.getpid()))
+        os.mkdir(tmp_path, 0o755)
+        log.info("Unpacking '%s' into cache at '%s'" % (archive_path, path))
+        if not tar.unpack_tar(archive_path, tmp_path, timeout=timeout,
+                              usage=usage):
+            shutil.rmtree(tmp_path)
+            return None
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # other process added the same entry in the meantime
+            log.debug("Cache entry '%s' already exists" % path)
+            shutil.rmtree(tmp_path)
+        return path
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import errno
+import signal
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# controllers enabled for build cgroups (if supported by the kernel)
+CONTROLLERS = ['cpu', 'memory', 'io', 'pids']
+
+# cgroups created for directories, see register()
+_directories = {}
+
+
+class CGroupError(Exception):
+    """
+    Generic cgroup error.
+    """
+    pass
+
+
+def cgroup_available(root=CGROUP_ROOT):
+    """
+    Check if cgroup v2 (unified hierarchy) is mounted at given path.
+    """
+    return os.path.isfile(os.path.join(root, 'cgroup.controllers'))
+
+
+def register(directory, cgroup):
+    """
+    Mark cgroup as the one tracking all processes running inside given
+    directory.
+    """
+    _directories[os.path.realpath(directory)] = cgroup
+
+
+def unregister(directory):
+    return _directories.pop(os.path.realpath(directory), None)
+
+
+def directory_cgroup(directory):
+    """
+    Return cgroup registered for given directory or None.
+    """
+    return _directories.get(os.path.realpath(directory))
+
+
+class CGroup(object):
+    """
+    cgroup v2 group used to track all processes started for a single build.
+    Processes are added to the group when they are started, so all their
+    children are tracked too, even if they move out of build directory or
+    daemonize.
+    """
+
+    # cpu.max period in microseconds
+    cpu_period = 100000
+
+    def __init__(self, name, parent=None, root=CGROUP_ROOT):
+        """
+        :param name: Name of this cgroup.
+        :param parent: Path of the parent cgroup (relative to root), it will
+                       be created if missing.
+        :param root: Path at which cgroup v2 hierarchy is mounted.
+        """
+        self.root = root.rstrip('/')
+        self.parent = os.path.join(self.root, (parent or '').strip('/'))
+        self.name = name
+        self.path = os.path.join(self.parent, name)
+        self.procs_fd = None
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def read(self, name):
+        with open(self.file_path(name)) as cgroup_file:
+            return cgroup_file.read()
+
+    def write(self, name, value, path=None):
+        with open(os.path.join(path or self.path, name), 'w') as cgroup_file:
+            cgroup_file.write(value)
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def enable_controllers(self):
+        """
+        Enable controllers in all cgroups between root and this cgroup, it's
+        needed to be able to set resource limits.
+        """
+        path = self.root
+        for name in os.path.relpath(self.path, self.root).split(os.sep):
+            try:
+                with open(os.path.join(path, 'cgroup.controllers')) as ctrls:
+                    available = ctrls.read().split()
+                self.write('cgroup.subtree_control', ' '.join(
+                    ['+%s' % c for c in CONTROLLERS if c in available]),
+                    path=path)
+            except (IOError, OSError) as e:
+                log.debug("Can't enable controllers for %s: %s" % (path, e))
+            path = os.path.join(path, name)
+
+    def create(self):
+        """
+        Create cgroup directory. File descriptor for adding processes is kept
+        open, so that processes can be added even from inside a chroot.
+        """
+        log.info("Creating cgroup at '%s'" % self.path)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.enable_controllers()
+            self.procs_fd = os.open(self.file_path('cgroup.procs'),
+                                    os.O_WRONLY)
+        except OSError as e:
+            raise CGroupError("Can't create cgroup at '%s': %s" % (self.path,
+                                                                  e))
+
+    def add(self, pid):
+        self.write('cgroup.procs', '%d' % pid)
+
+    def attach(self):
+        """
+        Move current process into this cgroup, used as preexec_fn for
+        commands.
+        """
+        try:
+            os.write(self.procs_fd, '0'.encode('ascii'))
+        except (OSError, TypeError):
+            # processes outside of cgroup will still be found by scanning
+            # build directory
+            pass
+
+    def pids(self):
+        try:
+            return sorted([int(pid) for pid in
+                           self.read('cgroup.procs').split()])
+        except (IOError, OSError):
+            return []
+
+    def populated(self):
+        try:
+            for line in self.read('cgroup.events').splitlines():
+                if line.startswith('populated '):
+                    return line.split()[1] == '1'
+        except (IOError, OSError):
+            pass
+        return bool(self.pids())
+
+    def set_limits(self, cpu=None, memory=None, io=None):
+        """
+        Set resource limits for all processes in this cgroup.
+
+        :param cpu: Number of CPUs that can be used (can be fractional).
+        :param memory: Memory limit in bytes.
+        :param io: List of io.max entries, for example
+                   ['8:0 rbps=1048576 wbps=1048576'].
+        """
+        try:
+            if cpu:
+                self.write('cpu.max', '%d %d' % (
+                    cpu * self.cpu_period, self.cpu_period))
+            if memory:
+                self.write('memory.max', '%d' % memory)
+            for entry in io or []:
+                self.write('io.max', entry)
+        except (IOError, OSError) as e:
+            raise CGroupError("Can't set cgroup limits: %s" % e)
+
+    def stats(self):
+        """
+        Return resources used by all processes that were running in this
+        cgroup. CPU time is in seconds, memory and I/O in bytes.
+        """
+        ret = {}
+        try:
+            for line in self.read('cpu.stat').splitlines():
+                (key, value) = line.split()
+                if key in ['usage_usec', 'user_usec', 'system_usec']:
+                    ret['cpu_%s' % key[:-5]] = int(value) / 1000000.0
+        except (IOError, OSError, ValueError):
+            pass
+        for name in ['current', 'peak']:
+            try:
+                ret['memory_%s' % name] = int(self.read('memory.%s' % name))
+            except (IOError, OSError, ValueError):
+                pass
+        try:
+            io_stats = self.read('io.stat')
+        except (IOError, OSError):
+            pass
+        else:
+            for key in ['rbytes', 'wbytes', 'rios', 'wios']:
+                ret['io_%s' % key] = 0
+            for line in io_stats.splitlines():
+                for entry in line.split()[1:]:
+                    (key, _, value) = entry.partition('=')
+                    if 'io_%s' % key in ret:
+                        ret['io_%s' % key] += int(value)
+        return ret
+
+    def kill(self, timeout=10):
+        """
+        Kill all processes in this cgroup with SIGKILL and wait for them to
+        exit. cgroup.kill is used if kernel supports it (5.14+), otherwise
+        cgroup is frozen and processes are killed one by one.
+        Returns True if cgroup is empty.
+        """
+        if not self.exists():
+            return True
+        if os.path.isfile(self.file_path('cgroup.kill')):
+            log.info("Killing all processes in cgroup '%s'" % self.path)
+            self.write('cgroup.kill', '1')
+        else:
+            self._kill_frozen()
+        deadline = time.time() + timeout
+        delay = 0.01
+        while self.populated():
+            if time.time() >= deadline:
+                log.error("Processes still running in cgroup '%s': %s" % (
+                    self.path, ', '.join([str(p) for p in self.pids()])))
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+        return True
+
+    def _kill_frozen(self):
+        frozen = os.path.isfile(self.file_path('cgroup.freeze'))
+        if frozen:
+            self.write('cgroup.freeze', '1')
+        for pid in self.pids():
+            if pid == os.getpid():
+                continue
+            log.info("Killing pid %d from cgroup '%s'" % (pid, self.path))
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        if frozen:
+            self.write('cgroup.freeze', '0')
+
+    def remove(self, timeout=10):
+        """
+        Kill all processes in this cgroup and remove it.
+        """
+        if self.procs_fd is not None:
+            os.close(self.procs_fd)
+            self.procs_fd = None
+        if not self.kill(timeout=timeout):
+            return False
+        log.info("Removing cgroup '%s'" % self.path)
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.error("Can't remove cgroup '%s': %s" % (self.path, e))
+                return False
+        return True
@@ -8,14 +8,20 @@
 from hashlib import sha256
 
 
-def calculate_file_sha256(path):
+def calculate_file_sha256(path, callback=None):
+    """
+    Return sha256 checksum of file content, optional callback is called with
+    the number of bytes read after every chunk.
+    """
     hasher = sha256()
     with open(path, "rb") as sfile:
         while True:
-            data = sfile.read(4096)
+            data = sfile.read(65536)
             if not data:
                 break
             hasher.update(data)
+            if callback is not None:
+                callback(len(data))
     return hasher.hexdigest()
 
 
@@ -8,6 +8,9 @@
 from __future__ import unicode_literals
 
 import os
+import time
+import uuid
+import fcntl
 import subprocess
 import signal
 import logging
@@ -51,8 +54,94 @@ class CommandFailed(CommandError):
     pass
 
 
+class CommandUsage(object):
+    """
+    Resources used by executed command (or a group of commands if multiple
+    usage objects are added together).
+    """
+
+    fields = ['wall', 'utime', 'stime', 'maxrss', 'inblock', 'oublock',
+              'nvcsw', 'nivcsw']
+
+    def __init__(self, cmd=None):
+        self.cmd = cmd
+        self.count = 0
+        # wall clock, user and system CPU time in seconds
+        self.wall = 0.0
+        self.utime = 0.0
+        self.stime = 0.0
+        # maximum resident set size in bytes
+        self.maxrss = 0
+        # number of blocks read and written by filesystem
+        self.inblock = 0
+        self.oublock = 0
+        # number of voluntary and involuntary context switches
+        self.nvcsw = 0
+        self.nivcsw = 0
+
+    def update(self, rusage):
+        """
+        Fill resource usage from resource.struct_rusage object.
+        """
+        self.count = max(self.count, 1)
+        self.utime = rusage.ru_utime
+        self.stime = rusage.ru_stime
+        self.maxrss = rusage.ru_maxrss * 1024
+        self.inblock = rusage.ru_inblock
+        self.oublock = rusage.ru_oublock
+        self.nvcsw = rusage.ru_nvcsw
+        self.nivcsw = rusage.ru_nivcsw
+
+    def add(self, other):
+        """
+        Add resources used by other command to this object.
+        """
+        self.count += max(other.count, 1)
+        for name in self.fields:
+            if name == 'maxrss':
+                self.maxrss = max(self.maxrss, other.maxrss)
+            else:
+                setattr(self, name, getattr(self, name) + getattr(other,
+                                                                  name))
+
+    def dump(self):
+        ret = {'count': self.count}
+        if self.cmd is not None:
+            ret['cmd'] = self.cmd
+        for name in self.fields:
+            ret[name] = getattr(self, name)
+        return ret
+
+
+def _exit_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _wait4(process, usage=None, block=False):
+    """
+    Reap process using wait4() so that resources it used can be collected.
+    Returns process return code or None if it is still running.
+    """
+    if process.returncode is not None:
+        return process.returncode
+    try:
+        pid, status, rusage = os.wait4(process.pid, 0 if block else
+                                       os.WNOHANG)
+    except OSError:
+        return process.poll()
+    if pid == 0:
+        return None
+    process.returncode = _exit_status(status)
+    if usage is not None:
+        usage.update(rusage)
+    return process.returncode
+
+
 def execute(cmd, timeout=None, cwd=None, output_loglevel=logging.DEBUG, env={},
-            valid_retcodes=[0], strip_envs=False):
+            valid_retcodes=[0], strip_envs=False, usage=None,
+            output_limit=None, cgroup=None):
     """
     Execute given command in shell.
 
@@ -67,6 +156,12 @@ def execute(cmd, timeout=None, cwd=None, output_loglevel=logging.DEBUG, env={},
                            error and exception will be raised.
     :param strip_envs: If True all unsafe env variables will be removed
                        before executing command.
+    :param usage: CommandUsage instance that will be filled with resources
+                  used by this command.
+    :param output_limit: Maximum size of returned output in bytes, lines
+                         after this limit is reached are discarded. No limit
+                         if None.
+    :param cgroup: CGroup instance, command will be started inside it.
     :returns: tuple -- (return code, output as list of strings)
     """
     def _alarm_handler(signum, frame):
@@ -118,21 +213,49 @@ def execute(cmd, timeout=None, cwd=None, output_loglevel=logging.DEBUG, env={},
         log.debug("Timeout for command is %d seconds" % timeout)
 
     output = []
+    # size of collected output and number of discarded bytes
+    collected = [0, 0]
+
+    def _collect(line):
+        if output_limit is not None and \
+                collected[0] + len(line) > output_limit:
+            collected[1] += len(line)
+            return
+        collected[0] += len(line)
+        output.append(line)
+        log.log(output_loglevel, line.rstrip(os.linesep))
+
     log.debug("Running ...")
+    started = time.time()
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                         shell=True)
+                         shell=True,
+                         preexec_fn=cgroup.attach if cgroup else None)
     try:
         while True:
-            retcode = p.poll()
+            retcode = _wait4(p, usage=usage)
             line = p.stdout.readline().decode('utf-8')
             if line:
-                output.append(line)
-                log.log(output_loglevel, line.rstrip(os.linesep))
+                _collect(line)
             if retcode is not None:
+                # read output that is still buffered, but don't wait for
+                # processes started in background that inherited stdout
+                fd = p.stdout.fileno()
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                while True:
+                    try:
+                        line = p.stdout.readline()
+                    except IOError:
+                        break
+                    if not line:
+                        break
+                    _collect(line.decode('utf-8', 'replace'))
                 break
     except CommandTimeout:
         os.kill(p.pid, signal.SIGKILL)
         _cleanup(wd, original_env)
+        if usage is not None:
+            usage.wall = time.time() - started
         raise CommandTimeout("Command timeout reached")
     except KeyboardInterrupt as e:
         if timeout:
@@ -149,9 +272,180 @@ def execute(cmd, timeout=None, cwd=None, output_loglevel=logging.DEBUG, env={},
 
     _cleanup(wd, original_env)
 
+    if collected[1]:
+        log.warning("Command output exceeded %d bytes, %d bytes "
+                    "discarded" % (output_limit, collected[1]))
+
+    if usage is not None:
+        usage.wall = time.time() - started
+        log.debug("Command used %.2fs wall, %.2fs user, %.2fs system CPU "
+                  "time, max RSS %d bytes" % (usage.wall, usage.utime,
+                                              usage.stime, usage.maxrss))
+
     if retcode not in valid_retcodes:
         msg = "Command failed with status %d" % retcode
         log.error(msg)
         raise CommandFailed(msg)
 
     return retcode, output
+
+
+class ShellSession(object):
+    """
+    Long running shell used to execute multiple commands without spawning new
+    shell process for each of them. Every command is evaluated in a subshell,
+    so it can't alter session state (working directory, variables) and its
+    return code is reported back using unique marker line.
+
+    Only wall clock time can be measured for single command, resources used
+    by all commands are available in *usage* attribute after session is
+    closed.
+    """
+
+    def __init__(self, env={}, strip_envs=False,
+                 output_loglevel=logging.DEBUG, shell='/bin/sh',
+                 cgroup=None):
+        """
+        :param env: Dictionary with environment variables for this session.
+        :param strip_envs: If True all unsafe env variables will be removed
+                           from session environment.
+        :param output_loglevel: Logging level at which commands output will be
+                                logged.
+        :param shell: Path to the shell binary used for this session.
+        :param cgroup: CGroup instance, session will be started inside it.
+        """
+        self.env = env
+        self.strip_envs = strip_envs
+        self.output_loglevel = output_loglevel
+        self.shell = shell
+        self.cgroup = cgroup
+        self.marker = '__UPAAS_SESSION_%s__' % uuid.uuid4().hex
+        self.process = None
+        self.usage = CommandUsage(shell)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def start(self):
+        environ = {}
+        for ename, evalue in list(os.environ.items()):
+            if not self.strip_envs or ename in SAFE_ENVS + list(
+                    self.env.keys()):
+                environ[ename] = evalue
+        environ.update(self.env)
+        log.info("Starting shell session using %s" % self.shell)
+        self.process = subprocess.Popen([self.shell], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        env=environ,
+                                        preexec_fn=self._preexec)
+
+    def _preexec(self):
+        os.setsid()
+        if self.cgroup is not None:
+            self.cgroup.attach()
+
+    def is_running(self):
+        return self.process is not None and _wait4(
+            self.process, usage=self.usage) is None
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        _wait4(self.process, usage=self.usage, block=True)
+
+    def close(self):
+        if not self.is_running():
+            return
+        log.debug("Closing shell session")
+        try:
+            self.process.stdin.write('exit\n'.encode('utf-8'))
+            self.process.stdin.close()
+        except (IOError, OSError):
+            self.kill()
+        else:
+            _wait4(self.process, usage=self.usage, block=True)
+
+    def execute(self, cmd, timeout=None, valid_retcodes=[0], usage=None):
+        """
+        Execute given command in this session.
+
+        :param timeout: Maximum time (in seconds) command can take to execute,
+                        if it takes longer whole session will be killed. No
+                        timeout if None.
+        :param valid_retcodes: List of return codes that can be returned by
+                               this command. Other return codes will be
+                               interpreted as error and exception will be
+                               raised.
+        :param usage: CommandUsage instance, only wall clock time will be set.
+        :returns: tuple -- (return code, output as list of strings)
+        """
+        def _alarm_handler(signum, frame):
+            raise CommandTimeout("Command timeout reached")
+
+        if not self.is_running():
+            raise CommandFailed("Shell session is not running")
+
+        log.info("Executing command: %s" % cmd, extra={"force_flush": True})
+
+        script = "( eval '%s' ) </dev/null 2>&1\necho \"%s$?\"\n" % (
+            cmd.replace("'", "'\\''"), self.marker)
+
+        if timeout:
+            signal.signal(signal.SIGALRM, _alarm_handler)
+            signal.alarm(timeout)
+            log.debug("Timeout for command is %d seconds" % timeout)
+
+        output = []
+        retcode = None
+        started = time.time()
+        try:
+            self.process.stdin.write(script.encode('utf-8'))
+            self.process.stdin.flush()
+            while retcode is None:
+                line = self.process.stdout.readline().decode('utf-8')
+                if not line:
+                    if timeout:
+                        signal.alarm(0)
+                    self.kill()
+                    raise CommandFailed("Shell session terminated "
+                                        "unexpectedly")
+                if self.marker in line:
+                    line, _, status = line.partition(self.marker)
+                    retcode = int(status)
+                if line:
+                    output.append(line)
+                    log.log(self.output_loglevel, line.rstrip(os.linesep))
+        except CommandTimeout:
+            self.kill()
+            raise CommandTimeout("Command timeout reached")
+        except KeyboardInterrupt as e:
+            if timeout:
+                signal.alarm(0)
+            self.kill()
+            raise CommandFailed(e)
+        except (IOError, OSError) as e:
+            if timeout:
+                signal.alarm(0)
+            self.kill()
+            raise CommandFailed("Shell session error: %s" % e)
+
+        finally:
+            if usage is not None:
+                usage.wall = time.time() - started
+
+        if timeout:
+            signal.alarm(0)
+
+        if retcode not in valid_retcodes:
+            msg = "Command failed with status %d" % retcode
+            log.error(msg)
+            raise CommandFailed(msg)
+
+        return retcode, output
@@ -8,11 +8,21 @@
 from __future__ import unicode_literals
 
 import os
+import copy
 import logging
+import threading
 
 import yaml
 from yaml import Loader, SafeLoader, YAMLError
 
+# libyaml based loader and dumper are much faster, use them if available
+try:
+    from yaml import CSafeLoader as YAMLSafeLoader
+    from yaml import CSafeDumper as YAMLSafeDumper
+except ImportError:
+    from yaml import SafeLoader as YAMLSafeLoader
+    from yaml import SafeDumper as YAMLSafeDumper
+
 from upaas.compat import unicode
 
 
@@ -35,6 +45,59 @@ def construct_yaml_str(self, node):
     return self.construct_scalar(node)
 Loader.add_constructor('tag:yaml.org,2002:str', construct_yaml_str)
 SafeLoader.add_constructor('tag:yaml.org,2002:str', construct_yaml_str)
+YAMLSafeLoader.add_constructor('tag:yaml.org,2002:str', construct_yaml_str)
+
+
+# absolute path -> (file stat key, parsed content, list of (included file
+# path, stat key) tuples)
+_parsed_files = {}
+
+# stack of (path, included files) tuples for files being parsed, used to
+# resolve relative includes and to track include dependencies
+_parsing = threading.local()
+
+
+def _stat_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+def _parsing_stack():
+    if not hasattr(_parsing, 'stack'):
+        _parsing.stack = []
+    return _parsing.stack
+
+
+def load_yaml_file(path):
+    """
+    Parse yaml file. Parsed content is cached until the file or any file
+    it includes is modified. Copy of the cached content is returned, so it
+    can be modified by the caller.
+    """
+    path = os.path.abspath(path)
+    key = _stat_key(path)
+    cached = _parsed_files.get(path)
+    if cached and key and cached[0] == key and all(
+            [_stat_key(p) == k for (p, k) in cached[2]]):
+        (_, content, included) = cached
+    else:
+        included = []
+        stack = _parsing_stack()
+        stack.append((path, included))
+        try:
+            with open(path) as inputfile:
+                content = yaml.load(inputfile, Loader=YAMLSafeLoader)
+        finally:
+            stack.pop()
+        _parsed_files[path] = (key, content, included)
+    stack = _parsing_stack()
+    if stack:
+        # file is included by other file that is being parsed
+        stack[-1][1].extend([(path, key)] + included)
+    return copy.deepcopy(content)
 
 
 def yaml_include(loader, node):
@@ -43,11 +106,12 @@ def yaml_include(loader, node):
     """
     path = node.value
     log.debug("Loading included configuration from %s" % path)
-    if not os.path.exists(path):
-        path = os.path.join(os.path.dirname(loader.stream.name), node.value)
-    with open(path) as inputfile:
-        return yaml.safe_load(inputfile)
-yaml.SafeLoader.add_constructor("!include", yaml_include)
+    stack = _parsing_stack()
+    if not os.path.exists(path) and stack:
+        path = os.path.join(os.path.dirname(stack[-1][0]), node.value)
+    return load_yaml_file(path)
+SafeLoader.add_constructor("!include", yaml_include)
+YAMLSafeLoader.add_constructor("!include", yaml_include)
 
 
 class ConfigurationError(Exception):
@@ -254,6 +318,63 @@ class ConfigDictEntry(NestedConfigEntry):
         return ret
 
 
+# kinds of compiled schema steps
+_NESTED = 0
+_WILDCARD = 1
+_ENTRY = 2
+_INVALID = 3
+
+# id(schema) -> (schema, compiled schema)
+_compiled_schemas = {}
+
+
+def _overridden(entry, name):
+    """
+    Return bound method of entry if it's overridden in entry class, None if
+    it's inherited from ConfigEntry (and does nothing).
+    """
+    method = getattr(type(entry), name)
+    base_method = getattr(ConfigEntry, name)
+    if getattr(method, '__func__', method) is getattr(base_method, '__func__',
+                                                      base_method):
+        return None
+    return getattr(entry, name)
+
+
+def _compile_entry(entry):
+    """
+    :returns: tuple -- (required, clean, validate, clean_late, nested), no-op
+              methods are replaced with None.
+    """
+    return (entry.required, _overridden(entry, 'clean'),
+            _overridden(entry, 'validate'), _overridden(entry, 'clean_late'),
+            isinstance(entry, NestedConfigEntry))
+
+
+def compile_schema(schema):
+    """
+    Compile schema into a flat list of (key, kind, schema value, compiled
+    entry) tuples, so that type of every schema value is checked only once.
+    Compiled schemas are cached, schemas must not be modified after they
+    are used.
+    """
+    cached = _compiled_schemas.get(id(schema))
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+    steps = []
+    for key, value in list(schema.items()):
+        if isinstance(value, dict):
+            steps.append((key, _NESTED, value, None))
+        elif isinstance(value, WildcardEntry):
+            steps.append((key, _WILDCARD, value, None))
+        elif isinstance(value, ConfigEntry):
+            steps.append((key, _ENTRY, value, _compile_entry(value)))
+        else:
+            steps.append((key, _INVALID, value, None))
+    _compiled_schemas[id(schema)] = (schema, steps)
+    return steps
+
+
 class Config(object):
     """
     Configuration object, it will parse all entries and check if they are valid
@@ -277,9 +398,8 @@ class Config(object):
     @classmethod
     def from_file(cls, path):
         try:
-            with open(path) as config_file:
-                content = yaml.safe_load(config_file)
-        except IOError as e:
+            content = load_yaml_file(path)
+        except (IOError, OSError) as e:
             msg = "Can't open configuration file '%s': %s" % (path, e)
             log.error(msg)
             raise ConfigurationError(msg)
@@ -292,16 +412,16 @@ class Config(object):
 
     @classmethod
     def from_string(cls, string):
-        return cls(yaml.safe_load(string))
+        return cls(yaml.load(string, Loader=YAMLSafeLoader))
 
     def __init__(self, content, schema=None, name=''):
         if schema:
             self.schema = schema
         self.name = name
 
-        log.debug("Parsing key '%s', settings %s, schema %s" % (self.name,
-                                                                content,
-                                                                self.schema))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Parsing key '%s', settings %s, schema %s" % (
+                self.name, content, self.schema))
 
         if not isinstance(content, (dict, type(None))):
             self.fail("Invalid configuration, expected dict but got "
@@ -311,20 +431,22 @@ class Config(object):
         self.entries = {}
         self.children = set()
 
-        for key, value in list(self.schema.items()):
-            if content is None and isinstance(value, ConfigEntry) \
-                    and value.required:
-                self.fail("Empty configuration")
-            if isinstance(value, dict):
+        values = content or {}
+        for key, kind, value, compiled in compile_schema(self.schema):
+            if kind == _ENTRY:
+                if content is None and compiled[0]:
+                    self.fail("Empty configuration")
+                self._parse_entry(key, value, compiled, values.get(key))
+            elif kind == _NESTED:
                 cfg = Config(content.get(key, {}), schema=value,
                              name=self.child_name(key))
                 setattr(self, key, cfg)
                 self.children.add(key)
                 self.entries[key] = cfg
-            elif isinstance(value, WildcardEntry):
-                self.entries[key] = (content or {}).get(key)
-            elif isinstance(value, ConfigEntry):
-                self.parse_entry(key, value, (content or {}).get(key))
+            elif kind == _WILDCARD:
+                if content is None and value.required:
+                    self.fail("Empty configuration")
+                self.entries[key] = values.get(key)
             else:
                 log.warning("Invalid configuration entry: "
                             "%s" % self.child_name(key))
@@ -375,39 +497,47 @@ class Config(object):
         """
         Dump all entries as string.
         """
-        return yaml.safe_dump(self.content)
+        return yaml.dump(self.content, Dumper=YAMLSafeDumper)
 
     def parse_entry(self, name, entry_schema, value):
         """
         Parse and validate single configuration entry using schema.
         """
-        log.debug("Parsing configuration entry '%s'" % self.child_name(name))
-        if entry_schema.required and value is None and \
-                entry_schema.default is None:
+        self._parse_entry(name, entry_schema, _compile_entry(entry_schema),
+                          value)
+
+    def _parse_entry(self, name, entry_schema, compiled, value):
+        (required, clean, validate, clean_late, nested) = compiled
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug("Parsing configuration entry '%s'" % self.child_name(
+                name))
+        if required and value is None and entry_schema.default is None:
             self.fail("Missing required configuration entry: "
                       "%s" % self.child_name(name))
-        log.debug("Cleaning configuration entry '%s'" % self.child_name(name))
-        value = entry_schema.clean(value)
-        log.debug("Validating configuration entry "
-                  "'%s'" % self.child_name(name))
-        try:
-            entry_schema.validate(value)
-        except ConfigurationError as e:
-            self.fail("Configuration entry %s is invalid: %s" % (
-                self.child_name(name), e))
-        else:
-            value = entry_schema.clean_late(value)
-            if value is not None:
-                self.entries[name] = value
+        if clean is not None:
+            value = clean(value)
+        if validate is not None:
+            try:
+                validate(value)
+            except ConfigurationError as e:
+                self.fail("Configuration entry %s is invalid: %s" % (
+                    self.child_name(name), e))
+        if clean_late is not None:
+            value = clean_late(value)
+        if value is not None:
+            self.entries[name] = value
+            if debug:
                 log.debug("Configuration entry %s with value "
                           "'%s'" % (self.child_name(name), value))
-            elif entry_schema.default is not None:
+        elif entry_schema.default is not None:
+            if debug:
                 log.debug("Configuration entry %s is missing, using default"
                           " value: %s" % (self.child_name(name),
                                           entry_schema.default))
-                self.entries[name] = entry_schema.default
-            if isinstance(entry_schema, NestedConfigEntry):
-                self.children.add(name)
+            self.entries[name] = entry_schema.default
+        if nested:
+            self.children.add(name)
 
 
 def load_config(cls, filename, directories=UPAAS_CONFIG_DIRS):
@@ -120,6 +120,51 @@ class VCSChangeLogEntry(VCSLazyEntry):
     }
 
 
+def _join_commands(vcs):
+    """
+    Join revision id, author, date and description commands for given VCS
+    into one shell command, output of each command is separated with ASCII
+    record separator character.
+    """
+    return " ; printf '\\036' ; ".join([
+        '( %s )' % entry.commands[vcs] for entry in [
+            VCSRevisionIDEntry, VCSAuthorEntry, VCSDateEntry,
+            VCSDescriptionEntry]])
+
+
+class VCSInfoEntry(VCSLazyEntry):
+    """
+    Single command printing revision id, author, date and description
+    separated with ASCII record separator character, used instead of running
+    separate command for every field.
+    """
+
+    entry_name = 'repository.info'
+
+    separator = '\x1e'
+
+    fields = ['id', 'author', 'date', 'description']
+
+    commands = {
+        'git': "git log -1 --pretty='%H%x1e%aN <%aE>%x1e%at%x1e%B'",
+        'svn': _join_commands('svn'),
+        'bzr': _join_commands('bzr'),
+        'hg': _join_commands('hg'),
+        'unknown': _join_commands('unknown'),
+    }
+
+
+class DependencyCacheConfig(base.Config):
+
+    schema = {
+        # directory to cache, relative to application directory
+        "path": base.StringEntry(required=True),
+        # files used to calculate cache key (relative to application
+        # directory), example: Gemfile.lock
+        "key": base.ListEntry(value_type=unicode),
+    }
+
+
 class MetadataConfig(base.Config):
 
     schema = {
@@ -130,6 +175,9 @@ class MetadataConfig(base.Config):
             "settings": base.DictEntry(value_type=unicode),
         },
         "repository": {
+            # remote repository url and type, needed only for mirror cache
+            "url": base.StringEntry(),
+            "vcs": base.StringEntry(default="git"),
             "env": base.DictEntry(value_type=unicode),
             "clone": base.ScriptEntry(required=True),
             "update": base.ScriptEntry(required=True),
@@ -139,6 +187,7 @@ class MetadataConfig(base.Config):
                 "date": VCSDateEntry(),
                 "description": VCSDescriptionEntry(),
                 "changelog": VCSChangeLogEntry(),
+                "info": VCSInfoEntry(),
             }
         },
         "env": base.DictEntry(value_type=unicode),
@@ -154,4 +203,5 @@ class MetadataConfig(base.Config):
             "settings": base.ListEntry(value_type=unicode)
         },
         "features": base.WildcardEntry(),
+        "cache": base.ConfigListEntry(DependencyCacheConfig),
     }
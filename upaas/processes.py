@@ -9,19 +9,51 @@ from __future__ import unicode_literals
 
 import os
 import time
+import errno
 import signal
+import select
 import shutil
 import logging
 
+from upaas import cgroup
 from upaas.commands import execute
-from upaas.utils import umount_filesystems
+from upaas.utils import umount, umount_filesystems
 
 log = logging.getLogger(__name__)
 
 
+def _link_inside(link, directory):
+    """
+    Check if symlink from /proc points to given directory or anything
+    inside it.
+    """
+    try:
+        target = os.readlink(link)
+    except OSError:
+        return False
+    return target == directory or target.startswith(directory + '/')
+
+
+def _pid_uses_directory(pid, directory):
+    base = '/proc/%s' % pid
+    for name in ['root', 'cwd', 'exe']:
+        if _link_inside(os.path.join(base, name), directory):
+            return True
+    try:
+        fds = os.listdir(os.path.join(base, 'fd'))
+    except OSError:
+        return False
+    for fd in fds:
+        if _link_inside(os.path.join(base, 'fd', fd), directory):
+            return True
+    return False
+
+
 def directory_pids(directory):
     """
-    List pid of all processes running inside given directory.
+    List pid of all processes running inside given directory. Process is
+    running inside directory if its root (chroot), working directory,
+    executable or any open file is inside it.
     List will contain integers and will use ascending sorting.
 
     :param directory: Directory to scan for running processes.
@@ -30,21 +62,35 @@ def directory_pids(directory):
     :returns: list of int -- [134, 245, 673, 964]
     """
     log.debug("Scanning for processes running in %s" % directory)
-    ret = set()
-    if os.path.exists(directory):
-        (rcode, output) = execute('lsof -t +d %s' % directory,
-                                  valid_retcodes=[0, 1])
-        if output:
-            for line in output:
-                try:
-                    ret.add(int(line))
-                except ValueError:
-                    log.debug("Could not convert PID value to int: "
-                              "'%s'" % line)
-            return sorted(list(ret))
-    else:
+    if not os.path.exists(directory):
         log.debug("No such directory: %s" % directory)
-    return []
+        return []
+    if not os.path.isdir('/proc/self'):
+        return _lsof_directory_pids(directory)
+    directory = os.path.realpath(directory).rstrip('/')
+    ret = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        if _pid_uses_directory(name, directory):
+            ret.append(int(name))
+    return sorted(ret)
+
+
+def _lsof_directory_pids(directory):
+    """
+    List pids of processes using given directory with lsof, used if /proc is
+    not mounted.
+    """
+    ret = set()
+    (rcode, output) = execute('lsof -t +d %s' % directory,
+                              valid_retcodes=[0, 1])
+    for line in output:
+        try:
+            ret.add(int(line))
+        except ValueError:
+            log.debug("Could not convert PID value to int: '%s'" % line)
+    return sorted(list(ret))
 
 
 def is_pid_running(pid):
@@ -81,11 +127,92 @@ def get_pid_command(pid):
         log.debug("Exception during /proc file parsing: %s" % e)
 
 
+def is_pid_alive(pid):
+    """
+    Like is_pid_running() but zombie processes (already terminated, waiting
+    to be reaped by parent) are reported as dead.
+    """
+    if not is_pid_running(pid):
+        return False
+    try:
+        with open('/proc/%d/stat' % pid) as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, IndexError):
+        return True
+
+
+def _open_pidfd(pid):
+    """
+    Return pidfd for given process, None if pidfds are not supported or False
+    if process is already gone.
+    """
+    if not hasattr(os, 'pidfd_open') or not hasattr(select, 'poll'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        return None
+
+
+def wait_for_pids(pids, timeout):
+    """
+    Wait for all given processes to terminate, waiting is done concurrently,
+    so it takes at most *timeout* seconds no matter how many processes are
+    given. pidfds are used if available, otherwise processes are polled with
+    exponential backoff.
+
+    :param pids: List of PIDs to wait for.
+    :type pids: list
+
+    :param timeout: Number of seconds to wait.
+    :type timeout: int
+
+    :returns: list of int -- PIDs still running after timeout.
+    """
+    deadline = time.time() + timeout
+    poller = None
+    pidfds = {}
+    polled = []
+    for pid in pids:
+        fd = _open_pidfd(pid)
+        if fd is False:
+            continue
+        if fd is None:
+            polled.append(pid)
+            continue
+        if poller is None:
+            poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        pidfds[fd] = pid
+
+    delay = 0.01
+    try:
+        while pidfds or polled:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            wait = min(delay, remaining) if polled else remaining
+            if pidfds:
+                for (fd, _) in poller.poll(int(wait * 1000) + 1):
+                    poller.unregister(fd)
+                    os.close(fd)
+                    log.debug("PID %s terminated" % pidfds.pop(fd))
+            else:
+                time.sleep(wait)
+            polled = [pid for pid in polled if is_pid_alive(pid)]
+            delay = min(delay * 2, 1)
+    finally:
+        for fd in pidfds:
+            os.close(fd)
+    return sorted(list(pidfds.values()) + polled)
+
+
 def wait_for_pid(pid, kill_after=600):
     """
     Wait for process to die, if it takes more than *kill_after* seconds than
-    kill this process. Process is killed by sending SIGTERM and waiting 10
-    seconds, if it's alive after that time SIGKILL is sent.
+    kill this process with SIGKILL.
 
     :param pid: PID of process we wait to die.
     :type pid: int
@@ -94,21 +221,56 @@ def wait_for_pid(pid, kill_after=600):
                        time it will be killed. Default is 600 seconds.
     :type kill_after: int
     """
-    elapsed = 0
-    while True:
-        if is_pid_running(pid):
-            log.debug("Waiting for pid %s to terminate (%s seconds "
-                      "elapsed)" % (pid, elapsed))
-            time.sleep(1)
-            elapsed += 1
-            if elapsed >= kill_after:
-                log.info("%s seconds elapsed, killing process %s" % (elapsed,
-                                                                     pid))
-                os.kill(pid, signal.SIGKILL)
-                elapsed = 0
-                kill_after = 10
+    if wait_for_pids([pid], kill_after):
+        log.info("%s seconds elapsed, killing process %s" % (kill_after, pid))
+        _signal_pids([pid], signal.SIGKILL)
+        wait_for_pids([pid], 10)
+
+
+def _signal_pids(pids, signum):
+    """
+    Send signal to all given processes, returns list of processes that
+    received it.
+    """
+    ret = []
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            log.debug("PID %s already died" % pid)
         else:
-            break
+            ret.append(pid)
+    return ret
+
+
+def kill_pids(pids, timeout=60):
+    """
+    Kill running processes by sending SIGTERM to all of them at once. All
+    processes share single grace period of *timeout* seconds, processes still
+    running after that are killed with SIGKILL signal.
+
+    :param pids: List of PIDs to kill.
+    :type pids: list
+
+    :param timeout: Number of seconds to wait before sending SIGKILL.
+    :type timeout: int
+    """
+    targets = []
+    for pid in pids:
+        if pid == os.getpid():
+            log.debug("%d is my own PID, will not kill" % pid)
+            continue
+        log.info("Sending SIGTERM to %s [%s]" % (
+            pid, get_pid_command(pid) or 'N/A'))
+        targets.append(pid)
+    alive = wait_for_pids(_signal_pids(targets, signal.SIGTERM), timeout)
+    if alive:
+        log.info("%s seconds elapsed, killing processes: %s" % (
+            timeout, ', '.join([str(pid) for pid in alive])))
+        alive = wait_for_pids(_signal_pids(alive, signal.SIGKILL), 10)
+        if alive:
+            log.error("Processes still running after SIGKILL: %s" % (
+                ', '.join([str(pid) for pid in alive])))
 
 
 def kill_pid(pid, timeout=60):
@@ -119,36 +281,47 @@ def kill_pid(pid, timeout=60):
     :param timeout: Number of seconds to wait before sending SIGKILL.
     :type timeout: int
     """
-    if pid == os.getpid():
-        log.debug("%d is my own PID, will not kill" % pid)
-        return
-    cmdline = get_pid_command(pid)
-    log.info("Sending SIGTERM to %s [%s]" % (pid, cmdline or 'N/A'))
-    try:
-        os.kill(pid, signal.SIGTERM)
-    except OSError:
-        log.debug("PID %s already died" % pid)
-    else:
-        wait_for_pid(pid, kill_after=timeout)
+    kill_pids([pid], timeout=timeout)
 
 
-def kill_and_remove_dir(directory):
+def kill_and_remove_dir(directory, trash=None):
     """
     Kill all processes running inside given directory and remove it.
-    Used mostly for removing temporary directories.
+    Used mostly for removing temporary directories. If there is a cgroup
+    registered for this directory all processes in it are killed first,
+    directory is scanned for remaining processes after that.
+
+    :param trash: Trash instance, if given directory is moved into it and
+                  deleted in background instead of being removed before this
+                  function returns.
     """
-    found = True
-    while found:
-        for pid in directory_pids(directory):
-            kill_pid(pid)
-        else:
-            found = False
+    group = cgroup.unregister(directory)
+    if group is not None:
+        group.remove()
+    pids = directory_pids(directory)
+    while pids:
+        kill_pids(pids)
+        # processes might have been forked while we were killing others
+        remaining = [pid for pid in directory_pids(directory)
+                     if pid != os.getpid() and is_pid_alive(pid)]
+        if remaining == pids:
+            log.error("Can't kill processes running in %s" % directory)
+            break
+        pids = remaining
 
     try:
-        umount_filesystems(directory)
+        # busy filesystems are detached, so that removing directory never
+        # descends into them
+        umount_filesystems(directory, lazy=True)
+        if os.path.ismount(directory):
+            # directory itself is a mount point, for example tmpfs
+            umount(directory, lazy=True)
     except Exception as e:
         log.error("Error while unmounting filesystem inside "
                   "package: %s" % e)
     else:
+        if trash is not None and trash.put(directory):
+            trash.start()
+            return
         log.info("Removing directory: %s" % directory)
         shutil.rmtree(directory.encode('utf-8'))
@@ -25,15 +25,30 @@ class BaseStorage(object):
         """
         raise NotImplementedError
 
-    def put(self, local_path, remote_path):
+    def put(self, local_path, remote_path, callback=None):
         """
         Upload file to storage.
 
         :param local_path: Path of the file to upload.
         :param remote_path: Path under uploaded file should be available.
+        :param callback: Progress callback, called with the number of bytes
+                         uploaded after every chunk.
         """
         raise NotImplementedError
 
+    def replace(self, local_path, remote_path):
+        """
+        Upload file to storage replacing existing file, readers should see
+        either old or new file content. Default implementation is not atomic,
+        storage handlers should override it.
+
+        :param local_path: Path of the file to upload.
+        :param remote_path: Path of the remote file to be replaced.
+        """
+        if self.exists(remote_path):
+            self.delete(remote_path)
+        self.put(local_path, remote_path)
+
     def delete(self, remote_path):
         """
         Delete file from storage.
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+from uuid import uuid4
+
+from upaas.storage.exceptions import StorageError, FileNotFound
+
+
+log = logging.getLogger(__name__)
+
+
+class StorageLease(object):
+    """
+    Lease shared by all processes using the same storage, stored as a small
+    json file with holder id and expiration timestamp. Leases of crashed
+    holders expire after ttl seconds, holder should renew lease if it needs
+    it for longer.
+
+    Acquisition is best-effort, storage has no compare-and-swap operation:
+    lease file is atomically replaced (last writer wins) and read back after
+    a short delay to verify that it wasn't overwritten by other process.
+    Lease file is never deleted while it's held, so there is no window in
+    which other process would see no lease. Holder should check the result
+    of renew() and stop if lease was lost.
+    """
+
+    def __init__(self, storage, path, ttl=600, settle=1):
+        """
+        :param storage: Storage handler instance.
+        :param path: Storage path of the lease file.
+        :param ttl: Number of seconds after which lease expires.
+        :param settle: Number of seconds to wait before verifying that lease
+                       was taken.
+        """
+        self.storage = storage
+        self.path = path
+        self.ttl = ttl
+        self.settle = settle
+        self.holder = '%s:%d:%s' % (socket.gethostname(), os.getpid(),
+                                    uuid4().hex)
+        self.acquired = False
+
+    def read(self):
+        """
+        Return lease content (dictionary with holder and expires keys) or None
+        if there is no lease.
+        """
+        if not self.storage.exists(self.path):
+            return None
+        (fd, tmp_path) = tempfile.mkstemp(prefix='upaas_lease_')
+        os.close(fd)
+        try:
+            self.storage.get(self.path, tmp_path)
+            with open(tmp_path) as lease_file:
+                return json.load(lease_file)
+        except FileNotFound:
+            return None
+        except ValueError:
+            log.warning("Invalid lease file '%s'" % self.path)
+            return {'holder': None, 'expires': 0}
+        finally:
+            os.remove(tmp_path)
+
+    def write(self):
+        (fd, tmp_path) = tempfile.mkstemp(prefix='upaas_lease_')
+        try:
+            with os.fdopen(fd, 'w') as lease_file:
+                json.dump({'holder': self.holder,
+                           'expires': time.time() + self.ttl}, lease_file)
+            self.storage.replace(tmp_path, self.path)
+        finally:
+            os.remove(tmp_path)
+
+    def remove(self):
+        try:
+            self.storage.delete(self.path)
+        except FileNotFound:
+            pass
+
+    def acquire(self):
+        """
+        Try to take the lease, returns False if it's held by other process.
+        Expired lease is overwritten, not removed first.
+        """
+        lease = self.read()
+        if lease and lease['expires'] > time.time():
+            return lease['holder'] == self.holder
+        if lease:
+            log.info("Lease '%s' held by %s expired, taking over" % (
+                self.path, lease['holder']))
+        try:
+            self.write()
+        except StorageError as e:
+            log.debug("Can't write lease '%s': %s" % (self.path, e))
+            return False
+        time.sleep(self.settle)
+        if self.verify():
+            log.info("Lease '%s' acquired" % self.path)
+        return self.acquired
+
+    def verify(self):
+        """
+        Read lease back and check that it's still held by this process.
+        """
+        lease = self.read()
+        self.acquired = bool(lease) and lease['holder'] == self.holder
+        return self.acquired
+
+    def renew(self):
+        """
+        Extend lease by ttl seconds from now, lease file is replaced
+        atomically. Lease is read back before and after replacing it, returns
+        False if lease is not held or it was taken over by other process.
+        """
+        if self.acquired and self.verify():
+            self.write()
+            self.verify()
+        if not self.acquired:
+            log.error("Lease '%s' was taken over by other process" %
+                      self.path)
+        return self.acquired
+
+    def release(self):
+        if not self.acquired:
+            return
+        self.acquired = False
+        try:
+            lease = self.read()
+            if lease and lease['holder'] == self.holder:
+                self.remove()
+                log.info("Lease '%s' released" % self.path)
+        except StorageError as e:
+            log.error("Can't release lease '%s': %s" % (self.path, e))
+
+    def wait(self, poll=5):
+        """
+        Wait until lease is released or expires.
+        """
+        while True:
+            lease = self.read()
+            if not lease or lease['expires'] <= time.time():
+                return
+            log.info("Waiting for lease '%s' held by %s" % (self.path,
+                                                            lease['holder']))
+            time.sleep(poll)
@@ -41,14 +41,46 @@ class LocalStorage(BaseStorage):
         except Exception as e:
             raise StorageError(e)
 
-    def put(self, local_path, remote_path):
+    def put(self, local_path, remote_path, callback=None):
         log.info("[PUT] Copying %s to %s" % (local_path,
                                              self._join_paths(remote_path)))
         try:
-            shutil.copy(local_path, self._join_paths(remote_path))
+            if callback is None:
+                shutil.copy(local_path, self._join_paths(remote_path))
+            else:
+                self._copy(local_path, self._join_paths(remote_path),
+                           callback)
         except Exception as e:
             raise StorageError(e)
 
+    @staticmethod
+    def _copy(source, destination, callback):
+        """
+        Copy file content and permissions like shutil.copy() does, callback
+        is called with the number of bytes copied after every chunk.
+        """
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                while True:
+                    data = src.read(65536)
+                    if not data:
+                        break
+                    dst.write(data)
+                    callback(len(data))
+        shutil.copymode(source, destination)
+
+    def replace(self, local_path, remote_path):
+        target = self._join_paths(remote_path)
+        tmp_path = '%s.%d.tmp' % (target, os.getpid())
+        log.info("[REPLACE] Copying %s to %s" % (local_path, target))
+        try:
+            shutil.copy(local_path, tmp_path)
+            os.rename(tmp_path, target)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise StorageError(e)
+
     def delete(self, remote_path):
         if not self.exists(remote_path):
             log.error("[DELETE] File not found: %s" % remote_path)
@@ -66,7 +66,7 @@ class MongoDBStorage(BaseStorage):
             client.close()
             raise StorageError(e)
 
-    def put(self, local_path, remote_path):
+    def put(self, local_path, remote_path, callback=None):
         client = self.connect()
         fs = GridFS(client[self.settings.database])
 
@@ -83,6 +83,8 @@ class MongoDBStorage(BaseStorage):
                     if not data:
                         break
                     gridin.write(data)
+                    if callback is not None:
+                        callback(len(data))
                 gridin.close()
             client.close()
         except Exception as e:
@@ -90,12 +92,45 @@ class MongoDBStorage(BaseStorage):
             client.close()
             raise StorageError(e)
 
+    def replace(self, local_path, remote_path):
+        client = self.connect()
+        fs = GridFS(client[self.settings.database])
+
+        # new version is uploaded first, readers always get last version so
+        # they will see old file until upload is complete, previous version
+        # is kept until next replace, so that readers that started reading
+        # it before can finish
+        gridin = fs.new_file(filename=remote_path)
+        try:
+            with open(local_path, "rb") as source:
+                log.info("[REPLACE] Copying %s to mongodb:%s" % (local_path,
+                                                                 remote_path))
+                while True:
+                    data = source.read(4096)
+                    if not data:
+                        break
+                    gridin.write(data)
+                gridin.close()
+            versions = sorted([f for f in fs.find({'filename': remote_path})
+                               if f._id != gridin._id],
+                              key=lambda f: f.upload_date, reverse=True)
+            for fsfile in versions[1:]:
+                fs.delete(fsfile._id)
+            client.close()
+        except Exception as e:
+            log.error("[REPLACE] Unhandled error: %s" % e)
+            client.close()
+            raise StorageError(e)
+
     def delete(self, remote_path):
         client = self.connect()
         fs = GridFS(client[self.settings.database])
         try:
-            fsfile = fs.get_last_version(filename=remote_path)
-            fs.delete(fsfile._id)
+            # raises NoFile if there is no such file
+            fs.get_last_version(filename=remote_path)
+            # replaced files also have previous version
+            for fsfile in fs.find({'filename': remote_path}):
+                fs.delete(fsfile._id)
             log.info("[DELETE] File deleted: mongodb:%s" % remote_path)
         except NoFile:
             client.close()
@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 
 import os
 import logging
+import threading
 
 from upaas import commands
 
@@ -16,13 +17,54 @@ from upaas import commands
 log = logging.getLogger(__name__)
 
 
-def pack_tar(source, archive_path, timeout=None):
+class _SizeWatcher(threading.Thread):
+    """
+    Checks size of a file that is being written by other process every
+    interval seconds and calls callback with the number of bytes it grew by.
+    """
+
+    def __init__(self, path, callback, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.size = 0
+        self.stopped = threading.Event()
+
+    def check(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size > self.size:
+            self.callback(size - self.size)
+            self.size = size
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def pack_tar(source, archive_path, timeout=None, usage=None,
+             one_file_system=False, callback=None, interval=1.0):
     """
     Pack files at given directory into tar archive.
 
     :param source: Directory which content should be packed.
     :param archive_path: Path at which tar archive file will be created.
     :param timeout: Timeout in seconds.
+    :param usage: CommandUsage instance that will be filled with resources
+                  used by tar.
+    :param one_file_system: Skip content of all filesystems mounted inside
+                            source directory.
+    :param callback: Progress callback, archive size is checked every
+                     interval seconds while tar is running and callback is
+                     called with the number of bytes written since last call.
     """
     def _cleanup(archive_path):
         try:
@@ -32,7 +74,13 @@ def pack_tar(source, archive_path, timeout=None):
         except OSError:
             pass
 
-    cmd = "tar -czpf %s *" % archive_path
+    options = ""
+    files = "*"
+    if one_file_system:
+        options = "--one-file-system "
+        files = "."
+
+    cmd = "tar %s-czpf %s %s" % (options, archive_path, files)
 
     # check if pigz is installed
     try:
@@ -40,11 +88,20 @@ def pack_tar(source, archive_path, timeout=None):
     except commands.CommandError:
         pass
     else:
-        cmd = "tar --use-compress-program=pigz -cpf %s *" % archive_path
+        cmd = "tar %s--use-compress-program=pigz -cpf %s %s" % (
+            options, archive_path, files)
         log.info("Using pigz for parallel compression")
 
+    watcher = None
+    if callback is not None:
+        watcher = _SizeWatcher(archive_path, callback, interval=interval)
+        watcher.start()
     try:
-        commands.execute(cmd, timeout=timeout, cwd=source)
+        try:
+            commands.execute(cmd, timeout=timeout, cwd=source, usage=usage)
+        finally:
+            if watcher is not None:
+                watcher.stop()
     except commands.CommandTimeout:
         log.error("Tar command was taking too long and it was killed")
         _cleanup(archive_path)
@@ -54,20 +111,25 @@ def pack_tar(source, archive_path, timeout=None):
         _cleanup(archive_path)
         return False
     else:
+        if watcher is not None:
+            # account bytes written since last check
+            watcher.check()
         return True
 
 
-def unpack_tar(archive_path, destination, timeout=None):
+def unpack_tar(archive_path, destination, timeout=None, usage=None):
     """
     Unpack tar archive in destination directory.
 
     :param archive_path: Path to tar file.
     :param destination: Destination directory in which we will unpack tar file.
     :param timeout: Timeout in seconds.
+    :param usage: CommandUsage instance that will be filled with resources
+                  used by tar.
     """
     try:
         commands.execute("tar -xzpf %s" % archive_path, timeout=timeout,
-                         cwd=destination)
+                         cwd=destination, usage=usage)
     except commands.CommandTimeout:
         log.error("Tar command was taking too long and it was killed")
         return False
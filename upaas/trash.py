@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    :copyright: Copyright 2013-2014 by Łukasz Mierzwa
+    :contact: l.mierzwa@gmail.com
+"""
+
+
+from __future__ import unicode_literals
+
+import os
+import time
+import logging
+
+from upaas import commands
+from upaas.cache import FileLock
+from upaas.utils import bytes_to_human
+
+
+log = logging.getLogger(__name__)
+
+
+class Trash(object):
+    """
+    Directory with removed build directories waiting to be deleted. Build
+    directory is moved into trash with a single rename, so trash must be on
+    the same filesystem as builder workdir. Content of the trash is deleted
+    by a low priority background process, only one such process is running
+    at a time.
+    """
+
+    def __init__(self, path, rate=None, nice=19, ionice=True):
+        """
+        :param path: Trash directory path, it will be created if missing.
+        :param rate: Maximum number of bytes deleted per second, no limit if
+                     None.
+        :param nice: Nice level for the deleting process.
+        :param ionice: Use idle I/O scheduling class for deleting process.
+        """
+        self.path = path.rstrip('/')
+        self.rate = rate
+        self.nice = nice
+        self.ionice = ionice
+        if not os.path.isdir(self.path):
+            log.info("Creating trash directory at '%s'" % self.path)
+            os.makedirs(self.path)
+
+    def lock(self):
+        return FileLock('%s.lock' % self.path, blocking=False)
+
+    def entries(self):
+        return sorted(os.listdir(self.path))
+
+    def put(self, directory):
+        """
+        Move directory into trash, returns False if it can't be moved there,
+        in that case it must be removed by the caller.
+        """
+        name = '%s.%d.%d' % (os.path.basename(directory.rstrip('/')),
+                             time.time(), os.getpid())
+        try:
+            os.rename(directory, os.path.join(self.path, name))
+        except OSError as e:
+            log.warning("Can't move '%s' into trash: %s" % (directory, e))
+            return False
+        log.info("Moved '%s' into trash" % directory)
+        return True
+
+    def lower_priority(self):
+        """
+        Lower CPU and I/O priority of current process.
+        """
+        try:
+            os.nice(self.nice)
+        except OSError as e:
+            log.debug("Can't change nice level: %s" % e)
+        if self.ionice:
+            try:
+                commands.execute('ionice -c 3 -p %d' % os.getpid(),
+                                 timeout=10)
+            except commands.CommandError as e:
+                log.debug("Can't change I/O priority: %s" % e)
+
+    def delete(self, name):
+        """
+        Delete single trash entry, files are removed one by one, so that
+        deletion rate can be limited.
+        """
+        path = os.path.join(self.path, name).encode('utf-8')
+        started = time.time()
+        deleted = 0
+        for (root, dirs, files) in os.walk(path, topdown=False):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                try:
+                    deleted += os.lstat(filepath).st_size
+                    os.unlink(filepath)
+                except OSError as e:
+                    log.error("Can't delete '%s': %s" % (filepath, e))
+                if self.rate:
+                    delay = deleted / float(self.rate) - (time.time() -
+                                                          started)
+                    if delay > 0:
+                        time.sleep(delay)
+            for dirname in dirs:
+                dirpath = os.path.join(root, dirname)
+                try:
+                    if os.path.islink(dirpath):
+                        os.unlink(dirpath)
+                    else:
+                        os.rmdir(dirpath)
+                except OSError as e:
+                    log.error("Can't delete '%s': %s" % (dirpath, e))
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.unlink(path)
+        except OSError as e:
+            log.error("Can't delete '%s': %s" % (path, e))
+            return False
+        log.info("Deleted '%s' from trash (%s in %.2f seconds)" % (
+            name, bytes_to_human(deleted), time.time() - started))
+        return True
+
+    def empty(self):
+        """
+        Delete all trash entries, including those added while deleting.
+        Returns False if trash is already being emptied by other process.
+        """
+        lock = self.lock()
+        failed = []
+        while lock.acquire():
+            try:
+                while True:
+                    names = [n for n in self.entries() if n not in failed]
+                    if not names:
+                        break
+                    for name in names:
+                        if not self.delete(name):
+                            failed.append(name)
+            finally:
+                lock.release()
+            # entry might have been added after last check, but before lock
+            # was released, new worker would not be able to take the lock
+            if not [n for n in self.entries() if n not in failed]:
+                return True
+        log.debug("Trash at '%s' is already being emptied" % self.path)
+        return False
+
+    def start(self):
+        """
+        Empty trash in detached background process with lowered priority.
+        """
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+        try:
+            # fork again so that worker is not our child and it will not be
+            # killed once build is finished
+            if os.fork() == 0:
+                os.setsid()
+                self.lower_priority()
+                self.empty()
+        except Exception as e:
+            log.error("Emptying trash failed: %s" % e)
+        finally:
+            os._exit(0)
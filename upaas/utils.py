@@ -8,9 +8,13 @@
 from __future__ import unicode_literals
 
 import os
+import errno
 import shutil
 import re
+import ctypes
+import ctypes.util
 import logging
+import multiprocessing
 
 from upaas import commands
 from upaas.config.base import ConfigurationError
@@ -80,21 +84,227 @@ def rmdirs(*args):
             shutil.rmtree(directory)
 
 
-def umount_filesystems(workdir, timeout=60):
+# umount2() flags
+MNT_FORCE = 1
+MNT_DETACH = 2
+
+_libc = None
+
+
+def _umount2(target, flags=0):
+    """
+    Call umount2() syscall, raises OSError on failure and NotImplementedError
+    if libc can't be loaded.
+    """
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                use_errno=True)
+            _libc.umount2
+        except (OSError, AttributeError) as e:
+            log.debug("Can't use umount2() syscall: %s" % e)
+            _libc = False
+    if _libc is False:
+        raise NotImplementedError("umount2() is not available")
+    if _libc.umount2(target.encode('utf-8'), flags) != 0:
+        errnum = ctypes.get_errno()
+        raise OSError(errnum, os.strerror(errnum), target)
+
+
+def _unescape_mount_path(path):
+    """
+    Decode octal escapes (used for spaces and other whitespace) in paths from
+    /proc/self/mountinfo.
+    """
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+
+def mounted_filesystems(prefix=None):
+    """
+    Return list of mount points in mount order, if prefix is given only mount
+    points inside it are returned. Stacked mounts are listed multiple times.
+    """
+    ret = []
+    if os.path.isfile('/proc/self/mountinfo'):
+        (path, field) = ('/proc/self/mountinfo', 4)
+    elif os.path.isfile('/proc/mounts'):
+        (path, field) = ('/proc/mounts', 1)
+    else:
+        return ret
+    with open(path) as mtab:
+        content = mtab.read()
+    for line in content.splitlines():
+        try:
+            mount = _unescape_mount_path(line.split()[field])
+        except IndexError:
+            continue
+        if prefix is None or mount.startswith(prefix.rstrip('/') + '/'):
+            ret.append(mount)
+    return ret
+
+
+class MountRegistry(object):
+    """
+    Filesystems mounted by a single build, used to unmount them all without
+    relying only on system mount table.
+    """
+
+    def __init__(self):
+        self.mounts = []
+
+    def add(self, path):
+        self.mounts.append(path.rstrip('/'))
+
+    def discard(self, path):
+        path = path.rstrip('/')
+        if path in self.mounts:
+            self.mounts.reverse()
+            self.mounts.remove(path)
+            self.mounts.reverse()
+
+    def under(self, directory):
+        """
+        Return list of registered mount points inside given directory.
+        """
+        prefix = directory.rstrip('/') + '/'
+        return [m for m in self.mounts if m.startswith(prefix)]
+
+
+def _depth_order(mounts):
+    """
+    Sort mount points deepest first, mounts with equal depth are sorted in
+    reversed mount order.
+    """
+    return sorted(reversed(mounts), key=lambda m: -m.rstrip('/').count('/'))
+
+
+def umount_filesystems(workdir, timeout=60, lazy=False, registry=None,
+                       scan=True):
+    """
+    Unmount all filesystems mounted inside workdir, deepest mounts first.
+
+    :param lazy: Detach filesystems that are busy instead of failing.
+    :param registry: MountRegistry with mounts created by the build.
+    :param scan: Read system mount table to find mounts not present in
+                 registry (for example mounted by build commands).
+    """
     mounts = []
-    if os.path.isfile("/proc/mounts"):
-        with open("/proc/mounts") as mtab:
-            for line in mtab:
-                try:
-                    mount = line.split()[1]
-                except IndexError:
-                    pass
-                else:
-                    if mount.startswith(workdir.rstrip('/') + '/'):
-                        mounts.append(mount)
-    for mount in mounts:
+    if scan or registry is None:
+        mounts = mounted_filesystems(workdir)
+    if registry is not None:
+        mounts += [m for m in registry.under(workdir) if m not in mounts]
+    for mount in _depth_order(mounts):
         log.info("Found mounted filesystem at '%s', unmounting" % mount)
-        commands.execute("umount %s" % mount, timeout=timeout)
+        umount(mount, timeout=timeout, lazy=lazy, registry=registry)
+
+
+def chroot_path(root, path):
+    """
+    Return host path for given path inside chroot directory, with all
+    symlinks resolved. Raises ValueError if it resolves to a location outside
+    of the chroot, chroot content is not trusted and any path component might
+    be a symlink pointing to a host directory.
+    """
+    root = os.path.realpath(root)
+    ret = os.path.realpath(os.path.join(root, path.lstrip('/')))
+    if ret != root and not ret.startswith(root + os.sep):
+        raise ValueError("'%s' resolves to '%s', outside of '%s'" % (
+            path, ret, root))
+    return ret
+
+
+def bind_mount(source, target, timeout=60, registry=None, readonly=False):
+    """
+    Bind mount source directory at target path.
+
+    :param readonly: Make the mount read-only, source directory can't be
+                     modified through it.
+    """
+    log.info("Bind mounting '%s' at '%s'" % (source, target))
+    commands.execute("mount --bind %s %s" % (source, target), timeout=timeout)
+    if registry is not None:
+        registry.add(target)
+    if readonly:
+        try:
+            commands.execute("mount -o remount,bind,ro %s" % target,
+                             timeout=timeout)
+        except commands.CommandError:
+            umount(target, timeout=timeout, registry=registry)
+            raise
+
+
+def mount_overlay(lowerdir, upperdir, workdir, target, timeout=60,
+                  registry=None):
+    """
+    Mount overlay filesystem at target path, all changes are written to
+    upperdir, lowerdir is never modified.
+    """
+    log.info("Mounting overlay of '%s' at '%s'" % (lowerdir, target))
+    commands.execute("mount -t overlay overlay -o lowerdir=%s,upperdir=%s,"
+                     "workdir=%s %s" % (lowerdir, upperdir, workdir, target),
+                     timeout=timeout)
+    if registry is not None:
+        registry.add(target)
+
+
+def mount_tmpfs(target, size, timeout=60, registry=None):
+    """
+    Mount tmpfs filesystem limited to size bytes at target path.
+    """
+    log.info("Mounting %s tmpfs at '%s'" % (bytes_to_human(size), target))
+    commands.execute("mount -t tmpfs -o size=%d,mode=0755 tmpfs %s" % (
+        size, target), timeout=timeout)
+    if registry is not None:
+        registry.add(target)
+
+
+def resize_tmpfs(target, size, timeout=60):
+    """
+    Change size limit of tmpfs mounted at target path.
+    """
+    log.info("Resizing tmpfs at '%s' to %s" % (target, bytes_to_human(size)))
+    commands.execute("mount -o remount,size=%d %s" % (size, target),
+                     timeout=timeout)
+
+
+def filesystem_usage(path):
+    """
+    Return tuple with size and used space (in bytes) of filesystem at given
+    path.
+    """
+    stat = os.statvfs(path)
+    return (stat.f_blocks * stat.f_frsize,
+            (stat.f_blocks - stat.f_bfree) * stat.f_frsize)
+
+
+def umount(mount, timeout=60, lazy=False, registry=None):
+    """
+    Unmount filesystem using umount2() syscall, umount command is used if
+    syscall is not available. Raises commands.CommandFailed on error.
+
+    :param lazy: Detach filesystem if it's busy.
+    :param registry: MountRegistry this mount will be removed from.
+    """
+    log.info("Unmounting '%s'" % mount)
+    try:
+        try:
+            _umount2(mount)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                log.debug("'%s' is not mounted" % mount)
+            elif e.errno == errno.EBUSY and lazy:
+                log.warning("'%s' is busy, detaching it" % mount)
+                _umount2(mount, MNT_DETACH)
+            else:
+                raise
+    except NotImplementedError:
+        commands.execute("umount %s%s" % ('-l ' if lazy else '', mount),
+                         timeout=timeout)
+    except OSError as e:
+        raise commands.CommandFailed("Can't unmount '%s': %s" % (mount, e))
+    if registry is not None:
+        registry.discard(mount)
 
 
 def backend_total_memory():
@@ -111,6 +321,49 @@ def backend_total_memory():
     return 0
 
 
+def backend_available_memory():
+    """
+    Amount of memory available for new processes without swapping, in bytes.
+    Returns None if kernel doesn't report it.
+    """
+    with open('/proc/meminfo') as meminfo:
+        matched = re.search(r'^MemAvailable:\s+(\d+)', meminfo.read(),
+                            re.MULTILINE)
+        if matched:
+            return int(matched.groups()[0]) * 1024
+    return None
+
+
+def backend_load():
+    """
+    Local backend load average (1 minute) divided by number of CPUs.
+    """
+    return os.getloadavg()[0] / multiprocessing.cpu_count()
+
+
+def get_config_option(config, path, default=None):
+    """
+    Return value of optional configuration entry or default if it is not set.
+
+    :param config: Configuration object, nested entries can be either objects
+                   or dictionaries.
+    :param path: Dotted path to the entry, for example 'commands.timelimit'.
+    :param default: Value returned if entry is not set.
+    """
+    value = config
+    for key in path.split('.'):
+        try:
+            if isinstance(value, dict):
+                value = value[key]
+            else:
+                value = getattr(value, key)
+        except (AttributeError, KeyError):
+            return default
+    if value is None:
+        return default
+    return value
+
+
 def load_handler(name, *args, **kwargs):
     """
     Will try to find storage handler class user has set in configuration,